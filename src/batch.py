@@ -0,0 +1,210 @@
+"""
+Batch verification of a directory (or glob) of Excel templates
+- Each template is processed and its verification document created in a pool of worker processes
+- Workers are started once and import the heavy libraries once, then handle many templates each
+- Linked workbooks are pooled per worker (external_links.shared_pool), not for the whole batch: a workbook linked
+  from many templates is read once by every worker verifying one of them, and again by a worker replaced after a
+  timeout.  The manifest entries count the pool of the worker that verified the template.
+- A template that fails or runs past the timeout is recorded in the manifest without stopping the batch, the
+  worker stuck on it is killed and replaced
+- Ends by writing a JSON manifest of the formulas, names, timings and failures of every template
+"""
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from multiprocessing.connection import wait
+
+
+def find_templates(source: str) -> list:
+    """
+    Lists the templates to verify
+    :param source: directory (searched for .xlsx files) or glob pattern
+    :return: sorted list of file names, Excel lock files (~$...) excluded
+    """
+    pattern = os.path.join(source, '*.xlsx') if os.path.isdir(source) else source
+    return sorted(f for f in glob.glob(pattern) if not os.path.basename(f).startswith('~$'))
+
+
+def verify_templates(source: str, out_dir: str, workers: int = None, timeout: float = 900.0,
+                     template_desc: str = 'Formula verification', queue_timeout: float = None) -> dict:
+    """
+    Creates the verification document of every template in source
+    :param source: directory or glob pattern of the templates
+    :param out_dir: directory for the documents and the manifest
+    :param workers: number of worker processes, defaults to the number of CPU cores
+    :param timeout: seconds a single template may take before it is recorded as failed, its worker is killed and
+                    replaced
+    :param template_desc: description written in the header of every document
+    :param queue_timeout: seconds after the start of the batch the templates still waiting for a worker are
+                          recorded as failed, no limit when None
+    :return: the manifest written to out_dir
+    """
+    files = find_templates(source)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {'source': source, 'started': datetime.now().isoformat(timespec='seconds'), 'templates': []}
+    results = [None] * len(files)
+    batch_start = time.perf_counter()
+
+    waiting = deque(range(len(files)))
+    pool = [_Worker() for _ in range(min(workers or os.cpu_count() or 1, len(files)))]
+    running = {}    # worker -> (index of its template, time it was handed the template)
+    try:
+        while waiting or running:
+            for worker in pool:
+                if worker.ready and worker not in running and waiting:
+                    i = waiting.popleft()
+                    worker.connection.send((files[i], out_dir, template_desc))
+                    running[worker] = (i, time.perf_counter())
+
+            for connection in wait([w.connection for w in pool], 0.05):
+                worker = next(w for w in pool if w.connection is connection)
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    # The worker died, e.g. killed by the system for using too much memory
+                    if worker in running:
+                        i, _ = running.pop(worker)
+                        results[i] = {'template': files[i], 'status': 'error',
+                                      'error': f'Worker stopped with exit code {worker.process.exitcode}'}
+                    pool[pool.index(worker)] = worker.replace()
+                    continue
+                if message is None:
+                    worker.ready = True
+                else:
+                    i, _ = running.pop(worker)
+                    results[i] = message
+
+            now = time.perf_counter()
+            for worker, (i, started) in list(running.items()):
+                if now - started > timeout:
+                    results[i] = {'template': files[i], 'status': 'timeout',
+                                  'error': f'Did not finish within {timeout} seconds'}
+                    del running[worker]
+                    pool[pool.index(worker)] = worker.replace()
+
+            if queue_timeout is not None and now - batch_start > queue_timeout:
+                while waiting:
+                    i = waiting.popleft()
+                    results[i] = {'template': files[i], 'status': 'timeout',
+                                  'error': f'Did not start within {queue_timeout} seconds'}
+    finally:
+        for worker in pool:
+            worker.stop()
+
+    manifest['templates'] = results
+    manifest['seconds'] = round(time.perf_counter() - batch_start, 3)
+    manifest['failures'] = sum(r['status'] != 'ok' for r in results)
+
+    filename = os.path.join(out_dir, f"manifest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+class _Worker(object):
+    """
+    A worker process and the connection it takes templates from and sends its manifest entries back on.  Each
+    worker has its own connection, killing a worker cannot leave a lock shared with the others held.
+    """
+
+    def __init__(self):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_work, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        # Set once the worker has imported the pipeline
+        self.ready = False
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+    def replace(self) -> '_Worker':
+        """
+        Kills the worker
+        :return: a new worker taking its place
+        """
+        self.stop()
+        return _Worker()
+
+
+def _work(connection):
+    """
+    Main loop of a worker: the pipeline modules (pandas, python-docx, openpyxl) are imported here once instead of
+    once per template, then templates are verified until the connection is closed
+    """
+    import template_file
+    import verification_document
+
+    connection.send(None)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        connection.send(_verify_one(*task))
+
+
+def _verify_one(filename: str, out_dir: str, template_desc: str) -> dict:
+    """
+    Processes a single template inside a worker, any error is caught and reported in the manifest entry
+    """
+    from template_file import process_template_file
+    from verification_document import create_document
+    from output_files import create_filename
+
+    entry = {'template': filename, 'status': 'ok'}
+    timings = {}
+    try:
+        start = time.perf_counter()
+        # Already inside a worker process, the sheets are read serially
+        template_data = process_template_file(filename, workers=1)
+        timings['extract'] = time.perf_counter() - start
+
+        template_name = os.path.splitext(os.path.basename(filename))[0]
+        start = time.perf_counter()
+        document = create_document(template_data, template_name, template_desc)
+        timings['document'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        entry['document'] = create_filename(os.path.join(out_dir, ''), template_name)
+        document.save(entry['document'])
+        timings['save'] = time.perf_counter() - start
+
+        entry['formulas'] = len(template_data['formulas'])
+        entry['names'] = len(template_data['names'])
+        entry['constants'] = len(template_data['constants'])
+
+        # Linked workbooks are shared by the templates handled by this worker, the counts are cumulative
+        from external_links import shared_pool
+        entry['linked_workbooks'] = shared_pool().stats()
+    except (Exception, SystemExit):
+        entry['status'] = 'error'
+        entry['error'] = traceback.format_exc()
+
+    entry['timings'] = {k: round(v, 3) for k, v in timings.items()}
+    return entry
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Create verification documents for a directory of templates')
+    parser.add_argument('source', help='directory or glob pattern of .xlsx templates')
+    parser.add_argument('out_dir', help='directory for the documents and the manifest')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=900.0)
+    parser.add_argument('--queue-timeout', type=float, default=None)
+    args = parser.parse_args()
+
+    result = verify_templates(args.source, args.out_dir, args.workers, args.timeout,
+                              queue_timeout=args.queue_timeout)
+    print(f"{len(result['templates'])} templates, {result['failures']} failures, {result['seconds']}s")
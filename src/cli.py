@@ -0,0 +1,222 @@
+"""
+Command line interface of the verification pipeline
+- extract: reads a template and reports its formulas, named ranges, constants and tables
+- export: writes the formulas, named ranges and constants of a template to an Excel workbook, or one record per
+  formula to a JSON Lines or Parquet file
+- document: writes the verification test document of a template
+- perturb: recomputes the formulas of a template for many what-if input scenarios, see perturbation
+- Every subcommand imports only the modules it needs when it runs, --help imports none of the pipeline.
+  openpyxl is needed to read a template, python-docx only by document.
+
+Usage:
+    python src/cli.py extract Template.xlsx
+    python src/cli.py export Template.xlsx --out-dir results/
+    python src/cli.py document Template.xlsx --out-dir results/ --description "Cell counts" --group
+    python src/cli.py perturb Template.xlsx --scenarios 5000 --expect "Calc!C5=Volume*Conc/1000"
+    python src/cli.py perturb Template.xlsx --mode given --given "Inputs!B2=0,0.5,1" --given "Rate=0.1,0.1,0.2"
+"""
+import argparse
+import json
+import os
+import sys
+
+
+def main(argv: list = None) -> int:
+    """
+    Runs a subcommand
+    :param argv: command line arguments, those of the process by default
+    :return: exit status
+    """
+    args = _parser().parse_args(argv)
+    if not os.path.isfile(args.template):
+        print(f'No such template: {args.template}')
+        return 1
+    return args.run(args)
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='cli.py', description='Excel formula verification')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # Options every subcommand has
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('template', help='Excel template (.xlsx)')
+    common.add_argument('--workers', type=int, help='processes reading the worksheets and rendering the '
+                                                         'tables, one per CPU by default')
+    common.add_argument('--cache-dir', help='reuse the unchanged sheets of the previous run kept in this directory')
+
+    extract = commands.add_parser('extract', parents=[common], help='list what the template holds')
+    extract.add_argument('--records', action='store_true', help='print every record, not only the counts')
+    extract.set_defaults(run=_extract)
+
+    export = commands.add_parser('export', parents=[common], help='write the formulas, names and constants '
+                                                                  'to an Excel workbook')
+    export.add_argument('--out-dir', help='directory of the workbook, the folder of the template by default')
+    export.add_argument('--format', default='xlsx', choices=['xlsx', 'jsonl', 'parquet'])
+    export.add_argument('--no-evaluate', action='store_true', help='do not evaluate the formulas')
+    export.set_defaults(run=_export)
+
+    document = commands.add_parser('document', parents=[common], help='write the verification test document')
+    document.add_argument('--out-dir', help='directory of the document, the folder of the template by default')
+    document.add_argument('--name', help='template name in the header, the file name by default')
+    document.add_argument('--description', default='Formula verification', help='template description in the '
+                                                                                  'header')
+    document.add_argument('--order', default='sheet', choices=['sheet', 'dependency'])
+    document.add_argument('--group', action='store_true', help='one test per group of copied formulas')
+    document.add_argument('--samples', type=int, default=0, help='additional tests per group')
+    document.add_argument('--no-evaluate', action='store_true', help='do not evaluate the formulas')
+    document.add_argument('--pipeline', action='store_true',
+                          help='render the tables while the template is read (sheet order, no evaluation)')
+    document.set_defaults(run=_document)
+
+    perturb = commands.add_parser('perturb', parents=[common], help='recompute the formulas for what-if scenarios')
+    perturb.add_argument('--scenarios', type=int, default=1000)
+    perturb.add_argument('--mode', default='random', choices=['random', 'boundary', 'given'],
+                         help='given: only the inputs of --given vary, one scenario per value')
+    perturb.add_argument('--spread', type=float, default=0.5, help='relative change of the inputs')
+    perturb.add_argument('--seed', type=int)
+    perturb.add_argument('--expect', action='append', default=[], metavar='CELL=EXPRESSION',
+                         help='what a formula should give, as an Excel expression: "Calc!C5=Volume*Conc/1000"')
+    perturb.add_argument('--given', action='append', default=[], metavar='INPUT=VALUES',
+                         help='the values of an input, one per scenario: "Inputs!B2=0,0.5,1"')
+    perturb.add_argument('--report', help='JSON file for the findings')
+    perturb.set_defaults(run=_perturb)
+    return parser
+
+
+def _extract(args) -> int:
+    template_data = _read(args)
+    if args.records:
+        for key, records in template_data.items():
+            if isinstance(records, dict):
+                # The values Excel cached for the cells, not records
+                continue
+            print(f'{key}:')
+            for r in records:
+                print(f'  {r!r}')
+    print(', '.join(f'{len(records)} {key}' for key, records in template_data.items()))
+    return 0
+
+
+def _export(args) -> int:
+    from output_files import create_filename
+
+    if args.format != 'xlsx':
+        from formula_export import check_format
+        try:
+            check_format(args.format)
+        except ImportError as e:
+            print(e)
+            return 1
+
+    if args.format == 'xlsx':
+        filename = create_filename(_out_dir(args), f'{_name(args)} formulas and names', extension='xlsx')
+    else:
+        filename = create_filename(_out_dir(args), f'{_name(args)} formulas', extension=args.format)
+
+    if args.format != 'xlsx' and args.no_evaluate and not args.cache_dir:
+        # Nothing needs every formula first, the records are written while the template is read
+        from formula_export import export_template
+        export_template(args.template, filename, args.format, workers=args.workers)
+        print(filename)
+        return 0
+
+    template_data = _read(args)
+    if not args.no_evaluate:
+        from evaluator import evaluate_template
+        evaluate_template(args.template, template_data)
+
+    if args.format == 'xlsx':
+        from output_files import output_formulas_to_excel
+        output_formulas_to_excel(filename, template_data)
+    else:
+        from formula_export import write_records
+        write_records(template_data, filename, args.format)
+    print(filename)
+    return 0
+
+
+def _document(args) -> int:
+    from output_files import create_filename
+
+    filename = create_filename(_out_dir(args), _name(args))
+    options = {'template_name': _name(args), 'template_description': args.description, 'group': args.group,
+               'samples': args.samples}
+
+    if args.pipeline:
+        from pipeline import pipeline_document
+        pipeline_document(args.template, filename, workers=args.workers, **options)
+    else:
+        from verification_document import stream_document
+
+        template_data = _read(args)
+        if not args.no_evaluate:
+            from evaluator import evaluate_template
+            evaluate_template(args.template, template_data)
+        stream_document(template_data, filename, order=args.order, workers=args.workers, **options)
+    print(filename)
+    return 0
+
+
+def _perturb(args) -> int:
+    from perturbation import perturb_template
+
+    expectations = {}
+    for expect in args.expect:
+        label, _, expression = expect.partition('=')
+        if not expression:
+            print(f'Expected CELL=EXPRESSION, not {expect}')
+            return 1
+        expectations[label.strip()] = expression.strip()
+
+    given = {}
+    for values in args.given:
+        label, _, text = values.partition('=')
+        try:
+            given[label.strip()] = [float(v) for v in text.split(',')]
+        except ValueError:
+            print(f'Expected INPUT=VALUES (numbers separated by commas), not {values}')
+            return 1
+
+    try:
+        report = perturb_template(args.template, _read(args), args.scenarios, args.mode, args.spread, given,
+                                  expectations, args.seed)
+    except ValueError as e:
+        print(e)
+        return 1
+    for finding in report.findings:
+        print(f'{finding.label}: {finding.kind} in {len(finding.scenarios)} scenarios, e.g. {finding.results}'
+              + (f' instead of {finding.expected}' if finding.expected else ''))
+    print(report.summary())
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report.to_dict(), f, indent=2, default=str)
+    return 0
+
+
+def _read(args) -> dict:
+    """
+    Extracts the template, through the revision cache when a cache directory is given
+    """
+    if args.cache_dir:
+        from extraction_cache import process_template_revision
+        template_data, changes = process_template_revision(args.template, args.cache_dir)
+        print(changes.summary())
+        return template_data
+
+    from template_file import process_template_file
+    return process_template_file(args.template, workers=args.workers)
+
+
+def _out_dir(args) -> str:
+    out_dir = os.path.abspath(args.out_dir or os.path.dirname(os.path.abspath(args.template)))
+    os.makedirs(out_dir, exist_ok=True)
+    return os.path.join(out_dir, '')
+
+
+def _name(args) -> str:
+    return getattr(args, 'name', None) or os.path.splitext(os.path.basename(args.template))[0]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+Precedent/dependent graph of the records extracted from a template
+- One node per constant, formula and named range, edges run from a precedent to the records that use it
+- Topological ordering so inputs can be verified before the formulas that use them
+- Cycle detection and downstream/upstream queries, all linear in the number of nodes and edges
+"""
+from bisect import bisect_left, bisect_right
+from collections import deque
+from name_index import TableIndex
+
+
+class DependencyGraph(object):
+    """
+    Builds the graph from the parsed references of every formula.  Nodes are numbered constants first, then
+    named ranges, then formulas, each in extraction (sheet scan) order; ties in the topological order keep
+    that numbering so the ordering is deterministic.
+    """
+
+    def __init__(self, template_data: dict):
+        self.nodes: list = []               # node id -> record
+        self.precedents: list = []          # node id -> node ids it uses
+        self.dependents: list = []          # node id -> node ids using it
+
+        self.__ids: dict = {}               # id(record) -> node id
+        self.__cells: dict = {}             # (sheet, row, col) -> node id of the constant/formula in the cell
+        self.__columns: dict = {}           # sheet -> column -> sorted rows holding a constant/formula
+        self.__names: dict = {}             # name -> node ids of the named ranges with that name
+        self.__tables = TableIndex(template_data.get('tables', ()))
+
+        for key in ('constants', 'names', 'formulas'):
+            for record in template_data[key]:
+                self.__add_node(record)
+
+        self.__index_cells(template_data['constants'] + template_data['formulas'])
+
+        for n in template_data['names']:
+            self.__names.setdefault(n.name, []).append(self.__ids[id(n)])
+            # A named range takes its values from whatever sits in its cells
+            if n.row is not None:
+                for cell in self.__cells_in_range(n.sheet, n.row, n.col, n.last_row, n.last_col):
+                    self.__add_edge(cell, self.__ids[id(n)])
+
+        for f in template_data['formulas']:
+            node = self.__ids[id(f)]
+            for precedent in self.__formula_precedents(f):
+                self.__add_edge(precedent, node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __add_node(self, record):
+        self.__ids[id(record)] = len(self.nodes)
+        self.nodes.append(record)
+        self.precedents.append([])
+        self.dependents.append([])
+
+    def __add_edge(self, precedent: int, dependent: int):
+        self.precedents[dependent].append(precedent)
+        self.dependents[precedent].append(dependent)
+
+    def __index_cells(self, records: list):
+        for r in records:
+            self.__cells[(r.sheet, r.row, r.col)] = self.__ids[id(r)]
+            self.__columns.setdefault(r.sheet, {}).setdefault(r.col, []).append(r.row)
+
+        for columns in self.__columns.values():
+            for rows in columns.values():
+                rows.sort()
+
+    def __formula_precedents(self, formula) -> set:
+        """
+        Finds the nodes a formula uses: the named ranges it names and the populated cells it references
+        :param formula: formula to look up
+        :return: set of node ids
+        """
+        precedents = set()
+        if formula.parsed is None:
+            return precedents
+
+        for name in formula.parsed.names:
+            precedents.update(self.__names.get(name, ()))
+
+        for ref in formula.parsed.references:
+            if ref.book is not None:
+                continue
+            sheet = ref.sheet or formula.sheet
+            row1, col1, row2, col2 = ref.anchor(formula.row, formula.col)
+            if ref.is_cell():
+                node = self.__cells.get((sheet, row1, col1))
+                if node is not None:
+                    precedents.add(node)
+            else:
+                precedents.update(self.__cells_in_range(sheet, row1, col1, row2, col2))
+
+        for ref in formula.parsed.tables:
+            area = self.__tables.resolve(ref, formula.sheet, formula.row, formula.col)
+            if area is not None:
+                precedents.update(self.__cells_in_range(*area))
+
+        return precedents
+
+    def __cells_in_range(self, sheet: str, row1, col1, row2, col2):
+        """
+        Yields the populated cells inside a range, whole-row/column ranges have no column/row bounds
+        """
+        columns = self.__columns.get(sheet, {})
+        if col1 is None:
+            col_range = columns.keys()
+        elif col2 - col1 + 1 < len(columns):
+            col_range = range(min(col1, col2), max(col1, col2) + 1)
+        else:
+            col_range = [c for c in columns if min(col1, col2) <= c <= max(col1, col2)]
+
+        for col in col_range:
+            rows = columns.get(col)
+            if not rows:
+                continue
+            if row1 is None:
+                selected = rows
+            else:
+                selected = rows[bisect_left(rows, min(row1, row2)):bisect_right(rows, max(row1, row2))]
+            for row in selected:
+                yield self.__cells[(sheet, row, col)]
+
+    def node(self, record) -> int:
+        return self.__ids[id(record)]
+
+    def topological_order(self) -> list:
+        """
+        Orders the nodes so every precedent comes before the records that use it (Kahn's algorithm).
+        Nodes that are part of, or downstream of, a cycle cannot be ordered and are appended at the end
+        in node order.
+        :return: list of node ids
+        """
+        in_degree = [len(p) for p in self.precedents]
+        queue = deque(i for i, d in enumerate(in_degree) if d == 0)
+        order = []
+
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for dependent in self.dependents[node]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    queue.append(dependent)
+
+        if len(order) < len(self.nodes):
+            order.extend(i for i, d in enumerate(in_degree) if d > 0)
+        return order
+
+    def ordered(self, records: list) -> list:
+        """
+        Sorts records in topological order
+        :param records: records to sort, all must be nodes of the graph
+        :return: sorted list of records
+        """
+        wanted = set(map(id, records))
+        return [self.nodes[i] for i in self.topological_order() if id(self.nodes[i]) in wanted]
+
+    def cycles(self) -> list:
+        """
+        Finds the circular references of the workbook (Tarjan's strongly connected components, iterative)
+        :return: list of cycles, each a list of records
+        """
+        index = [-1] * len(self.nodes)
+        low = [0] * len(self.nodes)
+        on_stack = [False] * len(self.nodes)
+        stack = []
+        cycles = []
+        counter = 0
+
+        for start in range(len(self.nodes)):
+            if index[start] != -1:
+                continue
+            work = [(start, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+
+                dependents = self.dependents[node]
+                while i < len(dependents):
+                    nxt = dependents[i]
+                    i += 1
+                    if index[nxt] == -1:
+                        work.append((node, i))
+                        work.append((nxt, 0))
+                        break
+                    elif on_stack[nxt]:
+                        low[node] = min(low[node], index[nxt])
+                else:
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = False
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in self.dependents[node]:
+                            cycles.append([self.nodes[m] for m in sorted(component)])
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+
+        return cycles
+
+    def downstream(self, record) -> list:
+        """
+        Gets every record that depends on the given record, directly or indirectly
+        :param record: record to start from
+        :return: list of records in breadth-first order
+        """
+        return [self.nodes[i] for i in self.__walk(self.__ids[id(record)], self.dependents)]
+
+    def upstream(self, record) -> list:
+        """
+        Gets every record the given record depends on, directly or indirectly
+        :param record: record to start from
+        :return: list of records in breadth-first order
+        """
+        return [self.nodes[i] for i in self.__walk(self.__ids[id(record)], self.precedents)]
+
+    def downstream_of(self, nodes) -> set:
+        """
+        Gets the node ids reachable from any of the given node ids, the given nodes included
+        :param nodes: node ids to start from
+        :return: set of node ids
+        """
+        seen = set(nodes)
+        queue = deque(seen)
+        while queue:
+            for nxt in self.dependents[queue.popleft()]:
+                if nxt not in seen:
+                    seen.add(nxt)
+                    queue.append(nxt)
+        return seen
+
+    @staticmethod
+    def __walk(start: int, edges: list) -> list:
+        seen = {start}
+        queue = deque([start])
+        found = []
+        while queue:
+            for nxt in edges[queue.popleft()]:
+                if nxt not in seen:
+                    seen.add(nxt)
+                    found.append(nxt)
+                    queue.append(nxt)
+        return found
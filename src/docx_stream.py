@@ -0,0 +1,130 @@
+"""
+Streaming writer for .docx files too large to build in memory
+- The document is set up as usual with python-docx (styles, header/footer, opening paragraphs), then saved as a
+  shell.  Every other part of the package is copied from the shell as is.
+- word/document.xml is written incrementally into the zip: the shell's body up to its section properties, then
+  each element as it is added, then the section properties and closing tags.  Only one element is held in
+  memory at a time.
+- The package is written to a temporary file next to the document, which replaces the document only once it is
+  complete: a failed run leaves the previous document (or none) rather than a truncated one
+"""
+import io
+import os
+import re
+import uuid
+import zipfile
+from lxml import etree
+from docx import Document
+
+_DOCUMENT_PART = 'word/document.xml'
+_SECTION_PROPERTIES = b'<w:sectPr'
+_NAMESPACE = re.compile(rb' xmlns:(\w+)="[^"]*"')
+
+
+class StreamingDocxWriter(object):
+    """
+    Appends elements to the body of a document while writing it to a file.  Use as a context manager, the file
+    is written when the context exits without an error.
+    """
+
+    def __init__(self, doc: Document, filename: str):
+        """
+        :param doc: document holding everything that comes before the streamed elements, it is not modified
+        :param filename: name of the .docx file to write
+        """
+        self.filename = filename
+        shell = io.BytesIO()
+        doc.save(shell)
+        self.__shell = zipfile.ZipFile(shell)
+
+        xml = self.__shell.read(_DOCUMENT_PART)
+        split = xml.rfind(_SECTION_PROPERTIES)
+        self.__head, self.__tail = xml[:split], xml[split:]
+        root = self.__head.index(b'<w:document')
+        self.__declared = set(_NAMESPACE.findall(self.__head[root:self.__head.index(b'>', root)]))
+
+        self.__temporary = None
+        self.__zip = None
+        self.__stream = None
+        self.__remaining = []
+
+    def __enter__(self):
+        # Same directory as the document, so that os.replace is a rename
+        folder, name = os.path.split(os.path.abspath(self.filename))
+        self.__temporary = os.path.join(folder, f'.{name}.{uuid.uuid4().hex}.tmp')
+        self.__zip = zipfile.ZipFile(self.__temporary, 'x', zipfile.ZIP_DEFLATED)
+        try:
+            infos = self.__shell.infolist()
+            names = [i.filename for i in infos]
+            position = names.index(_DOCUMENT_PART)
+            for info in infos[:position]:
+                self.__zip.writestr(info, self.__shell.read(info))
+            self.__remaining = infos[position + 1:]
+
+            self.__stream = self.__zip.open(infos[position], 'w', force_zip64=True)
+            self.__stream.write(self.__head)
+        except BaseException:
+            self.__discard()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.__discard()
+            return False
+
+        try:
+            self.__stream.write(self.__tail)
+            self.__stream.close()
+            for info in self.__remaining:
+                self.__zip.writestr(info, self.__shell.read(info))
+            self.__zip.close()
+        except BaseException:
+            self.__discard()
+            raise
+        self.__shell.close()
+        os.replace(self.__temporary, self.filename)
+        return False
+
+    def __discard(self):
+        """
+        Closes the package after an error and deletes the temporary file, the document is left as it was
+        """
+        try:
+            if self.__stream is not None:
+                self.__stream.close()
+            self.__zip.close()
+        except Exception:
+            # The package is being thrown away, the original error is the one to report
+            pass
+        finally:
+            self.__shell.close()
+            if os.path.exists(self.__temporary):
+                os.remove(self.__temporary)
+
+    def add_paragraph(self):
+        """
+        Writes an empty paragraph, same as doc.add_paragraph()
+        :return: n/a
+        """
+        self.__stream.write(b'<w:p/>')
+
+    def add_element(self, element):
+        """
+        Writes a block level element (table, paragraph) to the end of the body
+        :param element: lxml element, detached from any document
+        :return: n/a
+        """
+        self.add_xml(etree.tostring(element))
+
+    def add_xml(self, xml: bytes):
+        """
+        Writes a block level element serialized by etree.tostring, e.g. in another process
+        :param xml: xml of the element
+        :return: n/a
+        """
+        end = xml.index(b'>')
+        # Namespaces already declared on the document element are dropped from the element's own tag
+        start_tag = _NAMESPACE.sub(lambda m: b'' if m.group(1) in self.__declared else m.group(0), xml[:end])
+        self.__stream.write(start_tag)
+        self.__stream.write(xml[end:])
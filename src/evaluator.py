@@ -0,0 +1,835 @@
+"""
+Evaluator for the formulas of a template
+- Recomputes every formula from the values Excel cached for the cells it uses and compares the result with the
+  value Excel cached for the formula itself, filling in Formula.expected and Formula.passed
+- Formulas sharing the same R1C1 form are evaluated together: every reference becomes a NumPy array holding the
+  value of that reference for each formula of the batch, so a column of copied formulas costs one evaluation
+- A batch that runs into an Excel error or mixed value types is evaluated again one formula at a time.  Formulas
+  using a function or construct the evaluator does not know are left unevaluated (expected/passed stay None).
+- A blank cell is NaN in a float array until it is used: 0 in arithmetic, empty text in text operations, equal to
+  both 0 and "" in comparisons.  Arithmetic never produces NaN (overflow is #NUM!), so NaN is always a blank.
+- evaluate_scenarios recomputes formulas for many sets of input values at once, a batch then holds one entry per
+  formula and scenario (see perturbation)
+"""
+import math
+import operator
+import re
+from datetime import date, datetime, time, timedelta
+import numpy as np
+from formula_parser import Binary, Error, Function, Logical, Missing, Name, Number, Reference, Text, Unary
+from workbook_reader import WorkbookReader
+
+# Tolerance used when comparing a recomputed number to Excel's cached value
+REL_TOLERANCE: float = 1e-9
+ABS_TOLERANCE: float = 1e-9
+
+# Excel error values
+ERRORS: tuple = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+
+
+class ExcelError(Exception):
+    """An Excel error value (#DIV/0!, #VALUE!, ...) produced while evaluating"""
+
+    def __init__(self, value: str):
+        super(ExcelError, self).__init__(value)
+        self.value = value
+
+
+class _Unsupported(Exception):
+    """The formula uses something the evaluator cannot compute"""
+
+
+class _Mixed(Exception):
+    """The values of a reference differ in type across the batch, the batch is split up"""
+
+
+class ScenarioValue(object):
+    """
+    Value of a cell or global name in every scenario of evaluate_scenarios, in place of the single cached value
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values: np.ndarray):
+        self.values = values                # one entry per scenario
+
+
+class _ScenarioView(object):
+    """Values of a single scenario, for evaluating one formula of one scenario"""
+
+    def __init__(self, values: dict, scenario: int):
+        self.__values = values
+        self.__scenario = scenario
+
+    def get(self, key, default=None):
+        value = self.__values.get(key, default)
+        return python_value(value.values[self.__scenario]) if isinstance(value, ScenarioValue) else value
+
+
+class _Range(object):
+    """Values of a multi-cell reference, one row per formula of the batch"""
+
+    def __init__(self, values: np.ndarray):
+        self.values = values                # object array, shape (formulas, cells)
+
+
+def evaluate_template(filename: str, template_data: dict) -> int:
+    """
+    Evaluates every formula of a template against the values cached in the file
+    :param filename: name of template file
+    :param template_data: dict containing lists: formulas, constants, names
+    :return: number of formulas evaluated
+    """
+    return evaluate_formulas(template_data, cached_values(filename, template_data))
+
+
+def cached_values(filename: str, template_data: dict) -> dict:
+    """
+    Gets the values Excel cached for the cells of a template, those captured while the template was extracted
+    (process_template_file, process_template_revision, run_pipeline), the file is only read again for
+    template_data that has none
+    :param filename: name of template file
+    :param template_data: dict containing lists: formulas, constants, names, and the dict of values
+    :return: dict of (sheet, row, col) to the cached value, cells without one are left out
+    """
+    values = template_data.get('values')
+    if values is not None:
+        return values
+    with WorkbookReader(filename) as reader:
+        return {(sheet_name, c.row, c.col): c.cached
+                for sheet_name in reader.sheetnames for c in reader.iter_cells(sheet_name) if c.cached is not None}
+
+
+def evaluate_formulas(template_data: dict, values: dict) -> int:
+    """
+    Evaluates the formulas of a template
+    :param template_data: dict containing lists: formulas, constants, names
+    :param values: dict of (sheet, row, col) to the value Excel cached for the cell
+    :return: number of formulas evaluated
+    """
+    names = {}
+    for n in template_data['names']:
+        names.setdefault(n.name, []).append(n)
+
+    batches = {}
+    for f in template_data['formulas']:
+        if f.parsed is not None:
+            batches.setdefault((f.sheet, f.parsed.r1c1), []).append(f)
+
+    evaluated = 0
+    for formulas in batches.values():
+        try:
+            results = _Batch(formulas, values, names).evaluate()
+        except _Unsupported:
+            continue
+        except (ExcelError, _Mixed):
+            results = [_evaluate_single(f, values, names) for f in formulas]
+
+        for f, result in zip(formulas, results):
+            if result is _UNSUPPORTED:
+                continue
+            f.expected = result
+            f.passed = matches(result, values.get((f.sheet, f.row, f.col)))
+            evaluated += 1
+
+    return evaluated
+
+
+def evaluate_scenarios(batches: list, values: dict, names: dict, scenarios: int) -> list:
+    """
+    Evaluates formulas for many scenarios at once
+    :param batches: lists of formulas sharing an R1C1 form and a sheet, every batch may use the results of the
+                    batches before it but not its own
+    :param values: dict of (sheet, row, col) to the value of the cell, a ScenarioValue for the cells that differ
+                   between scenarios; global names may be given a ScenarioValue under (None, name).  The result
+                   of every formula is added as a ScenarioValue.
+    :param names: dict of name to the named ranges of that name
+    :param scenarios: number of scenarios
+    :return: list of tuples (formula, array of its result in every scenario, an Excel error as its text), the array
+             is None for formulas the evaluator does not support
+    """
+    evaluated = []
+    for formulas in batches:
+        try:
+            results = _Batch(formulas, values, names, scenarios).array().reshape(len(formulas), scenarios)
+        except _Unsupported:
+            results = [None] * len(formulas)
+        except (ExcelError, _Mixed):
+            results = [_evaluate_scenarios_single(f, values, names, scenarios) for f in formulas]
+
+        for f, result in zip(formulas, results):
+            if result is not None:
+                values[(f.sheet, f.row, f.col)] = ScenarioValue(result)
+            evaluated.append((f, result))
+    return evaluated
+
+
+def _evaluate_scenarios_single(formula, values: dict, names: dict, scenarios: int):
+    """
+    Evaluates one formula for every scenario, one scenario at a time if some of them run into an Excel error
+    """
+    try:
+        return _Batch([formula], values, names, scenarios).array()
+    except _Unsupported:
+        return None
+    except (ExcelError, _Mixed):
+        pass
+
+    results = [_evaluate_single(formula, _ScenarioView(values, s), names) for s in range(scenarios)]
+    if any(r is _UNSUPPORTED for r in results):
+        return None
+    return _object_array(results)
+
+
+def matches(expected, cached) -> bool:
+    """
+    Compares a recomputed value with the value Excel cached
+    :param expected: recomputed value
+    :param cached: cached value, None when the file holds no cached value
+    :return: True if they agree, None if there is nothing to compare to
+    """
+    if cached is None:
+        return None
+    if isinstance(expected, bool) or isinstance(cached, bool):
+        return expected is cached or (isinstance(expected, bool) and isinstance(cached, bool) and expected == cached)
+    if isinstance(expected, (int, float)) and isinstance(cached, (int, float)):
+        return math.isclose(expected, cached, rel_tol=REL_TOLERANCE, abs_tol=ABS_TOLERANCE)
+    return expected == cached
+
+
+def general_format(value) -> str:
+    """
+    Formats a value the way Excel's General format shows it
+    :param value: number, text, logical or None
+    :return: text
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return f'{value:.15g}'.replace('e+', 'E+').replace('e-', 'E-')
+    return str(value)
+
+
+def python_value(value):
+    """
+    Converts an element of an evaluated array to the plain value a formula result is given as
+    :param value: numpy or python number, logical or text
+    :return: float, bool or the value itself
+    """
+    if isinstance(value, (np.bool_, bool)):
+        return bool(value)
+    if isinstance(value, (np.floating, float, int)):
+        return float(value)
+    return value
+
+
+_UNSUPPORTED = object()
+
+
+def _evaluate_single(formula, values: dict, names: dict):
+    """
+    Evaluates one formula, an Excel error is the result rather than a failure
+    """
+    try:
+        return _Batch([formula], values, names).evaluate()[0]
+    except ExcelError as e:
+        return e.value
+    except (_Unsupported, _Mixed):
+        return _UNSUPPORTED
+
+
+class _Batch(object):
+    """
+    Evaluates the syntax tree shared by a batch of formulas, every value is an array with one entry per formula
+    """
+
+    def __init__(self, formulas: list, values: dict, names: dict, scenarios: int = 1):
+        """
+        :param formulas: formulas sharing the syntax tree
+        :param values: dict of (sheet, row, col) to the value of the cell or a ScenarioValue
+        :param names: dict of name to the named ranges of that name
+        :param scenarios: number of scenarios, the entry of formula i in scenario s is at i * scenarios + s
+        """
+        self.formulas = formulas
+        self.values = values
+        self.names = names
+        self.scenarios = scenarios
+        self.size = len(formulas) * scenarios
+        self.__functions = {
+            'SUM': self.__sum, 'MIN': self.__min, 'MAX': self.__max, 'AVERAGE': self.__average,
+            'COUNT': self.__count, 'PRODUCT': self.__product, 'IF': self.__if, 'IFERROR': self.__iferror,
+            'AND': self.__and, 'OR': self.__or, 'NOT': self.__not, 'ROUND': self.__round,
+            'ROUNDUP': self.__roundup, 'ROUNDDOWN': self.__rounddown, 'INT': self.__int, 'ABS': self.__abs,
+            'SQRT': self.__sqrt, 'EXP': self.__exp, 'LN': self.__ln, 'LOG10': self.__log10, 'MOD': self.__mod,
+            'POWER': self.__power, 'PI': self.__pi, 'TEXT': self.__text, 'CONCATENATE': self.__concatenate,
+            'CONCAT': self.__concatenate, 'LEN': self.__len, 'UPPER': self.__upper, 'LOWER': self.__lower,
+        }
+
+    def evaluate(self) -> list:
+        """
+        :return: list of the results, one per formula, as Python values
+        """
+        return [python_value(v) for v in self.array()]
+
+    def array(self) -> np.ndarray:
+        """
+        :return: array of the results, one per formula and scenario
+        """
+        result = self.eval(self.formulas[0].parsed.ast)
+        if isinstance(result, _Range):
+            raise _Unsupported('Formula returns a range')
+        # A formula returning a blank cell shows 0
+        return _blank_zero(result)
+
+    def eval(self, node):
+        if isinstance(node, Number):
+            return np.full(self.size, float(node.value))
+        elif isinstance(node, Text):
+            return _object_array([node.value] * self.size)
+        elif isinstance(node, Logical):
+            return np.full(self.size, node.value)
+        elif isinstance(node, Error):
+            raise ExcelError(node.value)
+        elif isinstance(node, Reference):
+            return self.__reference(node)
+        elif isinstance(node, Name):
+            return self.__name(node)
+        elif isinstance(node, Unary):
+            return self.__unary(node)
+        elif isinstance(node, Binary):
+            return self.__binary(node)
+        elif isinstance(node, Function):
+            function = self.__functions.get(node.name)
+            if function is None:
+                raise _Unsupported(node.name)
+            return function(node.args)
+        raise _Unsupported(type(node).__name__)
+
+    # References
+
+    def __reference(self, ref: Reference):
+        if ref.book is not None or ref.row1 is None or ref.col1 is None:
+            raise _Unsupported('External or whole row/column reference')
+
+        cells = []
+        for f in self.formulas:
+            row1, col1, row2, col2 = ref.anchor(f.row, f.col)
+            cells.append((ref.sheet or f.sheet, min(row1, row2), min(col1, col2), max(row1, row2), max(col1, col2)))
+
+        if ref.is_cell():
+            return self.__cells([(sheet, row, col) for sheet, row, col, _, _ in cells])
+        return self.__ranges(cells)
+
+    def __cells(self, keys: list) -> np.ndarray:
+        """
+        Values of one cell per formula
+        """
+        if self.scenarios == 1:
+            return _vector([self.values.get(key) for key in keys])
+
+        found = [self.values.get(key) for key in keys]
+        if all(isinstance(v, ScenarioValue) and v.values.dtype == float or
+               v is None or isinstance(v, (int, float)) and not isinstance(v, bool) for v in found):
+            # Numbers only, nothing to check
+            return np.concatenate([v.values if isinstance(v, ScenarioValue) else
+                                   np.full(self.scenarios, np.nan if v is None else float(v)) for v in found])
+
+        raw = []
+        for v in found:
+            raw.extend(v.values.tolist() if isinstance(v, ScenarioValue) else [v] * self.scenarios)
+        return _vector(raw)
+
+    def __ranges(self, areas: list) -> _Range:
+        """
+        Values of one range per formula, areas are tuples (sheet, first row, first col, last row, last col)
+        """
+        if self.scenarios == 1:
+            return _Range(np.array([[self.values.get((sheet, r, c)) for r in range(row1, row2 + 1)
+                                     for c in range(col1, col2 + 1)]
+                                    for sheet, row1, col1, row2, col2 in areas], dtype=object))
+
+        blocks = []
+        for sheet, row1, col1, row2, col2 in areas:
+            block = np.empty((self.scenarios, (row2 - row1 + 1) * (col2 - col1 + 1)), dtype=object)
+            cells = ((r, c) for r in range(row1, row2 + 1) for c in range(col1, col2 + 1))
+            for i, (r, c) in enumerate(cells):
+                v = self.values.get((sheet, r, c))
+                block[:, i] = v.values.tolist() if isinstance(v, ScenarioValue) else v
+            blocks.append(block)
+        return _Range(np.vstack(blocks))
+
+    def __name(self, node: Name):
+        if node.book is not None:
+            raise _Unsupported('External name')
+
+        sheet = self.formulas[0].sheet
+        candidates = self.names.get(node.name, [])
+        # A sheet level name hides the workbook level one on its own sheet
+        found = ([n for n in candidates if n.scope == (node.sheet or sheet)] or
+                 [n for n in candidates if n.scope == 'Workbook'])
+        if not found:
+            raise ExcelError('#NAME?')
+        n = found[0]
+
+        if n.is_global:
+            value = self.values.get((None, n.name))
+            if isinstance(value, ScenarioValue):
+                return np.tile(value.values, len(self.formulas))
+            try:
+                return np.full(self.size, float(n.value.lstrip('=')))
+            except ValueError:
+                raise _Unsupported('Name holding a formula')
+
+        if not n.is_range:
+            return self.__cells([(n.sheet, n.row, n.col)] * len(self.formulas))
+        return self.__ranges([(n.sheet, n.row, n.col, n.last_row, n.last_col)] * len(self.formulas))
+
+    # Operators
+
+    def __unary(self, node: Unary):
+        value = _numbers(self.eval(node.operand))
+        if node.op == '-':
+            return -value
+        elif node.op == '%':
+            return value / 100
+        return value
+
+    def __binary(self, node: Binary):
+        if node.op in (':', ' '):
+            raise _Unsupported('Reference operator')
+
+        left, right = self.eval(node.left), self.eval(node.right)
+        if node.op == '&':
+            return _texts(left) + _texts(right)
+        if node.op in ('=', '<>', '<', '>', '<=', '>='):
+            return _compare(node.op, _single(left), _single(right))
+
+        left, right = _numbers(left), _numbers(right)
+        with np.errstate(all='ignore'):
+            if node.op == '+':
+                return _finite(left + right)
+            elif node.op == '-':
+                return _finite(left - right)
+            elif node.op == '*':
+                return _finite(left * right)
+            elif node.op == '/':
+                if np.any(right == 0):
+                    raise ExcelError('#DIV/0!')
+                return _finite(left / right)
+        if node.op == '^':
+            return _power(left, right)
+        raise _Unsupported(node.op)
+
+    # Functions
+
+    def __aggregate_numbers(self, args) -> np.ndarray:
+        """
+        Collects the numbers of the arguments of an aggregate function, shape (formulas, values).
+        Text, logicals and blanks inside ranges are skipped (NaN), so are blank cells given directly, other values
+        given directly are converted.
+        """
+        columns = []
+        for arg in args:
+            if isinstance(arg, Missing):
+                continue
+            value = self.eval(arg)
+            if isinstance(value, _Range):
+                columns.append(_range_numbers(value))
+            elif value.dtype == float:
+                columns.append(value[:, None])
+            else:
+                columns.append(_numbers(value)[:, None])
+        return np.hstack(columns) if columns else np.full((self.size, 1), np.nan)
+
+    def __sum(self, args):
+        return np.nansum(self.__aggregate_numbers(args), axis=1)
+
+    def __product(self, args):
+        numbers = self.__aggregate_numbers(args)
+        return np.where(np.isnan(numbers).all(axis=1), 0.0, np.nanprod(numbers, axis=1))
+
+    def __min(self, args):
+        return self.__extreme(args, np.nanmin)
+
+    def __max(self, args):
+        return self.__extreme(args, np.nanmax)
+
+    def __extreme(self, args, function):
+        numbers = self.__aggregate_numbers(args)
+        empty = np.isnan(numbers).all(axis=1)
+        numbers = np.where(empty[:, None], 0.0, numbers)
+        return function(numbers, axis=1)
+
+    def __count(self, args):
+        return (~np.isnan(self.__aggregate_numbers(args))).sum(axis=1).astype(float)
+
+    def __average(self, args):
+        numbers = self.__aggregate_numbers(args)
+        count = (~np.isnan(numbers)).sum(axis=1)
+        if np.any(count == 0):
+            raise ExcelError('#DIV/0!')
+        return np.nansum(numbers, axis=1) / count
+
+    def __if(self, args):
+        if not 1 < len(args) <= 3:
+            raise _Unsupported('IF arguments')
+        condition = _logicals(self.eval(args[0]))
+        branches = [args[1], args[2] if len(args) > 2 else Logical(False)]
+
+        if self.size == 1:
+            # Only the branch taken is evaluated, the other one may well be an error
+            return self.__argument(branches[0] if condition[0] else branches[1])
+
+        true, false = (self.__argument(b) for b in branches)
+        true, false = _single(true), _single(false)
+        if true.dtype != false.dtype:
+            if true.dtype == object or false.dtype == object:
+                raise _Mixed('IF branches of different types')
+            true, false = true.astype(float), false.astype(float)
+        return np.where(condition, true, false)
+
+    def __iferror(self, args):
+        if len(args) != 2:
+            raise _Unsupported('IFERROR arguments')
+        if self.size > 1:
+            # Errors of some formulas only, decided one formula at a time
+            return self.__argument(args[0])
+        try:
+            return self.__argument(args[0])
+        except ExcelError:
+            return self.__argument(args[1])
+
+    def __argument(self, arg):
+        """Empty arguments count as 0"""
+        return np.zeros(self.size) if isinstance(arg, Missing) else self.eval(arg)
+
+    def __and(self, args):
+        return self.__logical_function(args, np.all)
+
+    def __or(self, args):
+        return self.__logical_function(args, np.any)
+
+    def __logical_function(self, args, reduce):
+        columns = []
+        for arg in args:
+            value = self.eval(arg)
+            if not isinstance(value, _Range):
+                columns.append(_logicals(value)[:, None])
+                continue
+            # Text and blanks inside a range are ignored, a range holding nothing else is an error
+            numbers = _range_numbers(value, logicals=True)
+            if np.any(np.isnan(numbers).all(axis=1)):
+                raise ExcelError('#VALUE!')
+            ignored = 1.0 if reduce is np.all else 0.0
+            columns.append(np.where(np.isnan(numbers), ignored, numbers) != 0)
+        return reduce(np.hstack(columns), axis=1)
+
+    def __not(self, args):
+        return ~_logicals(self.eval(args[0]))
+
+    def __digits(self, args) -> tuple:
+        if len(args) != 2:
+            raise _Unsupported('Rounding arguments')
+        value = _numbers(self.eval(args[0]))
+        digits = np.trunc(_numbers(self.eval(args[1])))
+        return value, 10.0 ** digits
+
+    def __round(self, args):
+        value, factor = self.__digits(args)
+        # Half away from zero, after removing the binary representation error (2.675 -> 2.68 like Excel)
+        return np.sign(value) * np.floor(np.round(np.abs(value) * factor, 9) + 0.5) / factor
+
+    def __roundup(self, args):
+        value, factor = self.__digits(args)
+        return np.sign(value) * np.ceil(np.round(np.abs(value) * factor, 9)) / factor
+
+    def __rounddown(self, args):
+        value, factor = self.__digits(args)
+        return np.sign(value) * np.floor(np.round(np.abs(value) * factor, 9)) / factor
+
+    def __int(self, args):
+        return np.floor(self.__one_number(args))
+
+    def __abs(self, args):
+        return np.abs(self.__one_number(args))
+
+    def __sqrt(self, args):
+        value = self.__one_number(args)
+        if np.any(value < 0):
+            raise ExcelError('#NUM!')
+        return np.sqrt(value)
+
+    def __exp(self, args):
+        with np.errstate(all='ignore'):
+            return _finite(np.exp(self.__one_number(args)))
+
+    def __ln(self, args):
+        value = self.__one_number(args)
+        if np.any(value <= 0):
+            raise ExcelError('#NUM!')
+        return np.log(value)
+
+    def __log10(self, args):
+        value = self.__one_number(args)
+        if np.any(value <= 0):
+            raise ExcelError('#NUM!')
+        return np.log10(value)
+
+    def __one_number(self, args) -> np.ndarray:
+        if len(args) != 1:
+            raise _Unsupported('Function arguments')
+        return _numbers(self.eval(args[0]))
+
+    def __mod(self, args):
+        if len(args) != 2:
+            raise _Unsupported('MOD arguments')
+        number, divisor = _numbers(self.eval(args[0])), _numbers(self.eval(args[1]))
+        if np.any(divisor == 0):
+            raise ExcelError('#DIV/0!')
+        return number - divisor * np.floor(number / divisor)
+
+    def __power(self, args):
+        if len(args) != 2:
+            raise _Unsupported('POWER arguments')
+        return _power(_numbers(self.eval(args[0])), _numbers(self.eval(args[1])))
+
+    def __pi(self, args):
+        return np.full(self.size, math.pi)
+
+    def __text(self, args):
+        if len(args) != 2:
+            raise _Unsupported('TEXT arguments')
+        value, formats = _blank_zero(_single(self.eval(args[0]))), _texts(self.eval(args[1]))
+        return _object_array([text_format(v, f) for v, f in zip(value, formats)])
+
+    def __concatenate(self, args):
+        result = _object_array([''] * self.size)
+        for arg in args:
+            result = result + _texts(self.eval(arg))
+        return result
+
+    def __len(self, args):
+        return np.array([len(t) for t in _texts(self.eval(args[0]))], dtype=float)
+
+    def __upper(self, args):
+        return _object_array([t.upper() for t in _texts(self.eval(args[0]))])
+
+    def __lower(self, args):
+        return _object_array([t.lower() for t in _texts(self.eval(args[0]))])
+
+
+# Value conversions, every value is a 1-d array: float (numbers, NaN for blanks), bool (logicals) or object (text)
+
+def _object_array(items: list) -> np.ndarray:
+    array = np.empty(len(items), dtype=object)
+    array[:] = items
+    return array
+
+
+def _vector(raw: list) -> np.ndarray:
+    """
+    Types the cached values of a cell reference across the batch
+    """
+    kinds = set()
+    for v in raw:
+        if isinstance(v, str) and v in ERRORS:
+            raise ExcelError(v)
+        if isinstance(v, (datetime, date, time, timedelta)):
+            raise _Unsupported('Dates')
+        kinds.add(type(v) if v is None or isinstance(v, (bool, str)) else float)
+
+    blanks = type(None) in kinds
+    kinds.discard(type(None))
+    if len(kinds) > 1:
+        raise _Mixed('Values of different types')
+    kind = kinds.pop() if kinds else float
+
+    # Only float arrays can hold blanks
+    if blanks and kind is not float:
+        raise _Mixed('Blanks among text or logicals')
+    if kind is str:
+        return _object_array(raw)
+    if kind is bool:
+        return np.array([bool(v) for v in raw])
+    return np.array([np.nan if v is None else float(v) for v in raw])
+
+
+def _single(value) -> np.ndarray:
+    """
+    Turns a one-cell range into a plain value, any bigger range is not supported where a single value is expected
+    """
+    if isinstance(value, _Range):
+        if value.values.shape[1] != 1:
+            raise _Unsupported('Range used as a single value')
+        return _vector(list(value.values[:, 0]))
+    return value
+
+
+def _blank_zero(value) -> np.ndarray:
+    """
+    Turns the blanks of a float array into 0
+    """
+    if isinstance(value, np.ndarray) and value.dtype == float:
+        blank = np.isnan(value)
+        if blank.any():
+            return np.where(blank, 0.0, value)
+    return value
+
+
+def _numbers(value) -> np.ndarray:
+    value = _single(value)
+    if value.dtype == object:
+        try:
+            return np.array([float(v) for v in value])
+        except ValueError:
+            raise ExcelError('#VALUE!')
+    return _blank_zero(value.astype(float))
+
+
+def _logicals(value) -> np.ndarray:
+    value = _single(value)
+    if value.dtype == object:
+        upper = [v.upper() for v in value]
+        if any(v not in ('TRUE', 'FALSE') for v in upper):
+            raise ExcelError('#VALUE!')
+        return np.array([v == 'TRUE' for v in upper])
+    return value.astype(bool) if value.dtype == bool else _numbers(value) != 0
+
+
+def _texts(value) -> np.ndarray:
+    value = _single(value)
+    if value.dtype == object:
+        return value
+    if value.dtype == bool:
+        return _object_array(['TRUE' if v else 'FALSE' for v in value])
+    return _object_array(['' if math.isnan(v) else general_format(float(v)) for v in value])
+
+
+def _range_numbers(value: _Range, logicals: bool = False) -> np.ndarray:
+    """
+    Gets the numbers of a range, every other cell becomes NaN
+    """
+    numbers = np.full(value.values.shape, np.nan)
+    for index, v in np.ndenumerate(value.values):
+        if isinstance(v, str) and v in ERRORS:
+            raise ExcelError(v)
+        if isinstance(v, bool):
+            if logicals:
+                numbers[index] = float(v)
+        elif isinstance(v, (int, float)):
+            numbers[index] = v
+        elif isinstance(v, (datetime, date, time, timedelta)):
+            raise _Unsupported('Dates')
+    return numbers
+
+
+def _compare(op: str, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Compares like Excel: text case-insensitively, numbers < text < logicals when the types differ, a blank is the
+    empty value of the type it is compared to (0, "" or FALSE)
+    """
+    left, right = _blank_as(left, right), _blank_as(right, left)
+    rank = {np.dtype(float): 0, np.dtype(object): 1, np.dtype(bool): 2}
+    left_rank, right_rank = rank.get(left.dtype, 0), rank.get(right.dtype, 0)
+    if left.dtype == object or right.dtype == object:
+        # Element by element, text and blanks turned into "" or FALSE may sit among numbers
+        keys = [_compare_key(v) for v in left], [_compare_key(v) for v in right]
+        return np.array([_COMPARISONS[op](a, b) for a, b in zip(*keys)], dtype=bool)
+    if left_rank != right_rank:
+        left, right = np.full(len(left), float(left_rank)), np.full(len(right), float(right_rank))
+
+    if op == '=':
+        return np.asarray(left == right, dtype=bool)
+    elif op == '<>':
+        return np.asarray(left != right, dtype=bool)
+    elif op == '<':
+        return np.asarray(left < right, dtype=bool)
+    elif op == '>':
+        return np.asarray(left > right, dtype=bool)
+    elif op == '<=':
+        return np.asarray(left <= right, dtype=bool)
+    return np.asarray(left >= right, dtype=bool)
+
+
+def _blank_as(value: np.ndarray, other: np.ndarray) -> np.ndarray:
+    """
+    Replaces the blanks of a float array by the empty value of the type of the array it is compared to
+    """
+    if value.dtype != float or other.dtype == float:
+        return _blank_zero(value)
+    blank = np.isnan(value)
+    if not blank.any():
+        return value
+    empty = '' if other.dtype == object else False
+    return _object_array([empty if b else float(v) for v, b in zip(value, blank)])
+
+
+def _compare_key(value) -> tuple:
+    if isinstance(value, (bool, np.bool_)):
+        return 2, bool(value)
+    if isinstance(value, str):
+        return 1, value.lower()
+    return 0, float(value)
+
+
+_COMPARISONS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '>': operator.gt, '<=': operator.le,
+                '>=': operator.ge}
+
+
+def _finite(value: np.ndarray) -> np.ndarray:
+    if not np.all(np.isfinite(value)):
+        raise ExcelError('#NUM!')
+    return value
+
+
+def _power(base: np.ndarray, exponent: np.ndarray) -> np.ndarray:
+    """
+    base ^ exponent as Excel computes it: 0^0 is #NUM! and 0 to a negative power #DIV/0!, where numpy gives 1 and inf
+    """
+    zero = base == 0
+    if np.any(zero & (exponent == 0)):
+        raise ExcelError('#NUM!')
+    if np.any(zero & (exponent < 0)):
+        raise ExcelError('#DIV/0!')
+    with np.errstate(all='ignore'):
+        return _finite(np.power(base, exponent))
+
+
+# Number formats TEXT understands: optional thousands separator, decimals, percent or exponent
+_FORMAT = re.compile(r'^(#,##)?0(\.0+)?(%|E\+00)?$')
+
+
+def text_format(value, number_format: str) -> str:
+    """
+    Formats a value like Excel's TEXT function for the common number formats
+    :param value: value to format
+    :param number_format: Excel number format such as '0.00', '#,##0' or '0.0%'
+    :return: formatted text
+    """
+    if number_format.lower() == 'general':
+        return general_format(python_value(value))
+    if number_format == '@' or isinstance(value, str):
+        return python_value(value) if isinstance(value, str) else general_format(python_value(value))
+
+    match = _FORMAT.match(number_format)
+    if match is None or isinstance(value, (bool, np.bool_)):
+        raise _Unsupported(f'Number format {number_format}')
+
+    thousands, decimals, suffix = match.groups()
+    places = len(decimals) - 1 if decimals else 0
+    number = float(value)
+
+    if suffix == 'E+00':
+        mantissa, exponent = f'{number:.{places}E}'.split('E')
+        return f'{mantissa}E{int(exponent):+03d}'
+    if suffix == '%':
+        number *= 100
+
+    # Half away from zero like ROUND
+    factor = 10.0 ** places
+    number = math.copysign(math.floor(round(abs(number) * factor, 9) + 0.5) / factor, number)
+    text = f'{number:,.{places}f}' if thousands else f'{number:.{places}f}'
+    return text + ('%' if suffix == '%' else '')
@@ -0,0 +1,280 @@
+"""
+Resolution of references to other workbooks ([Reagents.xlsx]Stock!B2, [1]Stock!B2)
+- Linked workbooks are loaded into a bounded LRU pool shared by every template processed in the process, so a
+  workbook linked from many templates is read once per process (each worker of a batch has its own pool)
+- The pool holds at most max_workbooks workbooks and max_cells cells in total, the least recently used
+  workbooks are evicted past either limit.  A workbook is reloaded if its file changed since it was read.
+- Resolvers fetch the workbooks from the pool on every lookup instead of holding on to them, an evicted workbook
+  is freed as soon as the lookups using it are done
+- A workbook is loaded outside the pool's lock, threads asking for the workbook being loaded wait for that load,
+  the others are not held up
+- Hits, misses, loads, evictions and missing files are counted for reporting
+"""
+import os
+import threading
+import warnings
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import unquote, urlparse
+from xml.etree.ElementTree import ParseError
+from openpyxl.utils.exceptions import InvalidFileException
+from instrumentation import count, stage
+from variable import Variable
+from workbook_reader import WorkbookReader
+
+# Errors of a linked file that is not an xlsx workbook (a legacy .xls, a corrupt or truncated file)
+_UNREADABLE = (OSError, KeyError, ValueError, zipfile.BadZipFile, ParseError, InvalidFileException)
+
+
+class LinkedWorkbook(object):
+    """
+    Values of every populated cell of a linked workbook
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.cells: dict = {}           # (upper case sheet name, row, col) -> CellData
+
+        with WorkbookReader(filename) as reader:
+            for sheet_name in reader.sheetnames:
+                key = sheet_name.upper()
+                for cell in reader.iter_cells(sheet_name):
+                    self.cells[(key, cell.row, cell.col)] = cell
+
+    def __len__(self):
+        return len(self.cells)
+
+    def cell(self, sheet: str, row: int, col: int):
+        """
+        Gets a cell, sheet names are not case sensitive
+        :return: CellData or None if the cell is blank or the sheet does not exist
+        """
+        return self.cells.get((sheet.upper(), row, col))
+
+
+class WorkbookPool(object):
+    """
+    LRU cache of linked workbooks, keyed by their absolute path and the size and modification time of the file.
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_workbooks: int = 16, max_cells: int = 5_000_000):
+        """
+        :param max_workbooks: most workbooks held at once
+        :param max_cells: most cells held at once over all workbooks, the memory limit of the pool.  The workbook
+                          just loaded is always kept, even if it is larger than the limit on its own.
+        """
+        self.max_workbooks = max_workbooks
+        self.max_cells = max_cells
+        self.__workbooks = OrderedDict()    # (path, size, mtime) -> LinkedWorkbook, least recently used first
+        self.__cells = 0
+        self.__loading: dict = {}           # (path, size, mtime) -> Future of the workbook being loaded
+        self.__lock = threading.Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'loads': 0, 'evictions': 0, 'missing': 0}
+
+    def __len__(self):
+        return len(self.__workbooks)
+
+    def get(self, filename: str):
+        """
+        Gets a linked workbook, loading it if it is not in the pool
+        :param filename: path of the workbook
+        :return: LinkedWorkbook or None if the file does not exist or cannot be read
+        """
+        path = os.path.abspath(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.__count('missing')
+            return None
+        key = (path, stat.st_size, stat.st_mtime_ns)
+
+        with self.__lock:
+            workbook = self.__workbooks.get(key)
+            if workbook is not None:
+                self.__workbooks.move_to_end(key)
+                self.__stats['hits'] += 1
+                return workbook
+            self.__stats['misses'] += 1
+
+            loading = self.__loading.get(key)
+            loader = loading is None
+            if loader:
+                loading = self.__loading[key] = Future()
+
+        if not loader:
+            # Another thread is loading the same revision
+            return loading.result()
+
+        workbook = None
+        try:
+            workbook = self.__load(path)
+        finally:
+            with self.__lock:
+                del self.__loading[key]
+                if workbook is not None:
+                    self.__add(key, workbook)
+                else:
+                    self.__stats['missing'] += 1
+            loading.set_result(workbook)
+        return workbook
+
+    @staticmethod
+    def __load(path: str):
+        """
+        Reads a linked workbook, outside the lock
+        :return: LinkedWorkbook or None if it cannot be read
+        """
+        try:
+            with stage('load_linked_workbook'):
+                workbook = LinkedWorkbook(path)
+        except _UNREADABLE as e:
+            # References to it stay unresolved
+            warnings.warn(f'Could not read linked workbook {path}: {e}')
+            return None
+        count('linked_workbooks')
+        return workbook
+
+    def __add(self, key: tuple, workbook: LinkedWorkbook):
+        """
+        Adds a workbook that was just loaded and evicts the least recently used ones past the limits, called with
+        the lock held
+        """
+        path = key[0]
+        # An older revision of the same file is dropped right away
+        for old in [k for k in self.__workbooks if k[0] == path]:
+            self.__cells -= len(self.__workbooks.pop(old))
+
+        self.__workbooks[key] = workbook
+        self.__cells += len(workbook)
+        self.__stats['loads'] += 1
+        while len(self.__workbooks) > 1 and (len(self.__workbooks) > self.max_workbooks
+                                             or self.__cells > self.max_cells):
+            _, evicted = self.__workbooks.popitem(last=False)
+            self.__cells -= len(evicted)
+            self.__stats['evictions'] += 1
+
+    def stats(self) -> dict:
+        """
+        :return: dict of the hit, miss, load, eviction and missing file counts and the workbooks and cells held
+        """
+        with self.__lock:
+            return dict(self.__stats, workbooks=len(self.__workbooks), cells=self.__cells)
+
+    def clear(self):
+        with self.__lock:
+            self.__workbooks.clear()
+            self.__cells = 0
+
+    def __count(self, key: str):
+        with self.__lock:
+            self.__stats[key] += 1
+
+
+_shared_pool = WorkbookPool()
+
+
+def shared_pool() -> WorkbookPool:
+    """
+    :return: the pool used when none is given, shared by every template processed in this process.  Processes do
+             not share it: every worker of a batch (see batch.verify_templates) loads the workbooks it needs into
+             its own pool.
+    """
+    return _shared_pool
+
+
+def file_signatures(paths) -> dict:
+    """
+    Identifies the revision of files without reading them
+    :param paths: paths of the files
+    :return: dict of path to (size, modification time), None for files that are gone
+    """
+    signatures = {}
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            signatures[path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            signatures[path] = None
+    return signatures
+
+
+class ExternalResolver(object):
+    """
+    Resolves the external cell references of the formulas of one template.  Each referenced cell becomes a single
+    Variable, shared by every formula referencing it.
+    """
+
+    def __init__(self, filename: str, links: dict, pool: WorkbookPool = None):
+        """
+        :param filename: name of the template, relative links are relative to its folder
+        :param links: link numbers to linked files, from WorkbookReader.read_external_links
+        :param pool: pool the linked workbooks are loaded into, the shared pool by default
+        """
+        self.folder = os.path.dirname(os.path.abspath(filename))
+        self.links = links
+        self.pool = pool if pool is not None else shared_pool()  # an empty pool is falsy
+        self.files: set = set()         # linked workbooks that were read
+        self.__books: dict = {}         # workbook as written in formulas -> path, None if it cannot be read
+        self.__records: dict = {}
+
+    def cell(self, book: str, sheet: str, row: int, col: int):
+        """
+        Gets the record of a cell of a linked workbook
+        :param book: workbook as written in the formula: link number ('1') or file name ('Reagents.xlsx')
+        :param sheet: sheet of the cell
+        :param row: row of the cell
+        :param col: column of the cell
+        :return: Variable or None if the workbook cannot be found or the cell is blank or only holds text
+        """
+        key = (book, sheet, row, col)
+        if key in self.__records:
+            return self.__records[key]
+
+        # The workbook is taken from the pool for every cell, holding on to it would keep it in memory after the
+        # pool evicted it
+        filename = self.__books[book] if book in self.__books else self.__find(book)
+        workbook = self.pool.get(filename) if filename is not None else None
+        if workbook is not None:
+            self.files.add(workbook.filename)
+            self.__books[book] = filename
+        else:
+            self.__books[book] = None
+
+        record = None
+        cell = workbook.cell(sheet, row, col) if workbook is not None and sheet else None
+        if cell is not None and not (isinstance(cell.value, str) and not cell.value.startswith('=')):
+            label = f'[{os.path.basename(filename)}]{sheet}'
+            record = Variable(sheet=label, row=row, col=col, value=cell.value, output=str(cell.cached))
+            record.name = f'{label}!{record.coordinate}'
+            count('external_references')
+
+        self.__records[key] = record
+        return record
+
+    def signatures(self) -> dict:
+        """
+        Identifies the revision of every linked workbook that was read, see file_signatures
+        """
+        return file_signatures(self.files)
+
+    def __find(self, book: str):
+        """
+        Locates a linked workbook: the path Excel recorded, or failing that a file of the same name next to the
+        template (linked files are usually moved together with the template)
+        """
+        target = self.links.get(book, book)
+        if target.startswith('file:'):
+            target = unquote(urlparse(target).path)
+            # file:///C:/... has a leading slash before the drive letter
+            if len(target) > 2 and target[0] == '/' and target[2] == ':':
+                target = target[1:]
+        target = target.replace('\\', os.sep)
+
+        candidates = [target if os.path.isabs(target) else os.path.join(self.folder, target),
+                      os.path.join(self.folder, os.path.basename(target.replace('/', os.sep)))]
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        return candidates[0]
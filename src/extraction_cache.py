@@ -0,0 +1,204 @@
+"""
+On-disk cache of process_template_file results for incremental re-verification
+- Keyed by the template's path; holds the file hash, a signature per sheet and a content hash per cell
+- An identical file is returned straight from the cache
+- For a new revision, unchanged sheets are reused whole, changed sheets are streamed and only their changed
+  cells get new records.  The changes and every formula downstream of them are reported.
+"""
+import hashlib
+import os
+import pickle
+from dependency_graph import DependencyGraph
+from external_links import ExternalResolver, WorkbookPool, file_signatures
+from name_index import RangeIndex
+from template_file import _build_named_ranges, _create_cell_record, _get_name_destinations, _get_name_targets, \
+    _match_items, _read_tables
+from variable import Formula
+from workbook_reader import WorkbookReader
+
+__CACHE_VERSION = 6
+__CHUNK_SIZE = 1 << 20
+
+
+class TemplateChanges(object):
+    """
+    What changed between the cached revision of a template and the current one
+    """
+
+    def __init__(self):
+        self.cached: bool = False           # True when the whole file was unchanged
+        self.full: bool = False             # True when there was no usable cache and everything was extracted
+        self.reused_sheets: list = []       # sheets whose records were reused without reading them
+        self.added: list = []               # (sheet, coordinate) of cells with new contents
+        self.modified: list = []
+        self.removed: list = []
+        self.names: list = []               # named ranges that were added, removed or now hold other values
+        self.affected: list = []            # formulas that changed or depend on a change, in sheet order
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed or self.names)
+
+    def summary(self) -> str:
+        if self.cached:
+            return 'Template unchanged, loaded from cache'
+        if self.full:
+            return 'No cached revision, template extracted in full'
+        return (f'{len(self.added)} cells added, {len(self.modified)} modified, {len(self.removed)} removed, '
+                f'{len(self.names)} named ranges changed, {len(self.affected)} formulas to re-verify '
+                f'({len(self.reused_sheets)} sheets reused)')
+
+
+def process_template_revision(filename: str, cache_dir: str, pool: WorkbookPool = None) -> tuple:
+    """
+    Processes the template like process_template_file, reusing what it can from the previous run on the same
+    file and updating the cache afterwards
+    :param filename: name of template file
+    :param cache_dir: directory holding the cache files
+    :param pool: pool the linked workbooks are loaded into, see process_template_file
+    :return: tuple of the template data dict and the TemplateChanges
+    """
+    cache_file = os.path.join(cache_dir, hashlib.sha1(os.path.abspath(filename).encode()).hexdigest() + '.pickle')
+    previous = _load(cache_file)
+    file_hash = _file_hash(filename)
+    changes = TemplateChanges()
+
+    # The records hold values of the linked workbooks as well, they must not have changed either
+    if previous is not None and previous['file_hash'] == file_hash and \
+            file_signatures(previous['links']) == previous['links']:
+        changes.cached = True
+        return previous['template_data'], changes
+
+    changes.full = previous is None
+    previous_sheets = previous['sheets'] if previous else {}
+    sheets = {}
+    formula_list = []
+    constants_list = []
+    values = {}
+    changed_records = []
+
+    with WorkbookReader(filename) as reader:
+        destinations = _get_name_destinations(reader)
+        name_cells = {}
+        targets = _get_name_targets(destinations)
+        tables = _read_tables(reader)
+        external = ExternalResolver(filename, reader.read_external_links(), pool)
+
+        for sheet_name in reader.sheetnames:
+            signature = reader.sheet_signature(sheet_name)
+            old = previous_sheets.get(sheet_name)
+            needed = targets.get(sheet_name, [])
+
+            if old is not None and old['signature'] == signature and set(needed) <= set(old['targets']):
+                sheet = old
+                changes.reused_sheets.append(sheet_name)
+            else:
+                sheet = _read_sheet(reader, sheet_name, signature, needed, old, changes, changed_records)
+
+            sheets[sheet_name] = sheet
+            name_cells[sheet_name] = sheet['name_cells']
+            values.update(sheet['values'])
+            for record in sheet['records']:
+                (formula_list if isinstance(record, Formula) else constants_list).append(record)
+
+        for sheet_name, old in previous_sheets.items():
+            if sheet_name not in sheets:
+                changes.removed.extend((sheet_name, r.coordinate) for r in old['records'])
+
+    template_data = {'formulas': formula_list, 'names': _build_named_ranges(destinations, name_cells),
+                     'constants': constants_list, 'tables': tables, 'values': values}
+    _match_items(template_data, external)
+
+    if previous is not None:
+        __find_affected(template_data, previous['template_data']['names'], changed_records, changes)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        pickle.dump({'version': __CACHE_VERSION, 'file_hash': file_hash, 'sheets': sheets,
+                     'links': external.signatures(), 'template_data': template_data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return template_data, changes
+
+
+def _read_sheet(reader: WorkbookReader, sheet_name: str, signature: tuple, needed: list, old, changes,
+                changed_records: list) -> dict:
+    """
+    Streams a sheet, reusing the cached record of every cell whose contents hash the same as before
+    :return: cache entry of the sheet
+    """
+    old_hashes = old['hashes'] if old else {}
+    old_records = {(r.row, r.col): r for r in old['records']} if old else {}
+    hashes = {}
+    records = []
+    name_cells = {}
+    values = {}
+    ranges = RangeIndex()
+    for target in needed:
+        ranges.add(sheet_name, *target, target)
+
+    for cell in reader.iter_cells(sheet_name):
+        key = (cell.row, cell.col)
+        if needed and ranges.covering(sheet_name, cell.row, cell.col):
+            name_cells[key] = cell
+
+        if cell.cached is not None:
+            values[(sheet_name, cell.row, cell.col)] = cell.cached
+
+        digest = hashlib.blake2b(repr((cell.value, cell.cached)).encode(), digest_size=8).digest()
+        hashes[key] = digest
+        if old_hashes.get(key) == digest:
+            if key in old_records:
+                records.append(old_records[key])
+            continue
+
+        record = _create_cell_record(sheet_name, cell)
+        if old is not None:
+            (changes.modified if key in old_hashes else changes.added).append((sheet_name, cell.coordinate))
+        if record is not None:
+            records.append(record)
+            changed_records.append(record)
+
+    for key in old_hashes.keys() - hashes.keys():
+        if key in old_records:
+            changes.removed.append((sheet_name, old_records[key].coordinate))
+
+    return {'signature': signature, 'hashes': hashes, 'records': records, 'targets': needed,
+            'name_cells': name_cells, 'values': values}
+
+
+def __find_affected(template_data: dict, old_names: list, changed_records: list, changes: TemplateChanges):
+    """
+    Collects the changed named ranges and every formula downstream of a changed record or name
+    """
+    def key(n):
+        return (n.name, n.scope, n.sheet, n.row, n.col, n.last_row, n.last_col, n.value, n.output,
+                tuple((c.value, c.cached) for c in n.cells.values() if n.contains(n.sheet, c.row, c.col))
+                if n.is_range else None)
+
+    old_keys = {key(n) for n in old_names}
+    new_keys = {key(n) for n in template_data['names']}
+    changed_names = [n for n in template_data['names'] if key(n) not in old_keys]
+    changes.names = sorted({k[0] for k in old_keys ^ new_keys})
+
+    graph = DependencyGraph(template_data)
+    affected = graph.downstream_of(graph.node(r) for r in changed_records + changed_names)
+    changes.affected = [f for f in template_data['formulas'] if graph.node(f) in affected]
+
+
+def _file_hash(filename: str) -> str:
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(__CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _load(cache_file: str):
+    """
+    Loads a cache file, a missing, unreadable or outdated cache is treated as no cache
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    return cache if cache.get('version') == __CACHE_VERSION else None
@@ -0,0 +1,187 @@
+"""
+Machine readable export of the formula tests, for tools that need the tests rather than the Word document
+- One record per formula: sheet, coordinate, name, formula text, the value Excel cached for it, the evaluator's
+  result (when the formulas were evaluated) and the resolved variables with their values
+- JSON Lines, or Parquet when pyarrow is installed
+- export_template writes the records while the template is being read (see pipeline.run_pipeline), the writers
+  hold at most one row group in memory whatever the number of formulas
+"""
+import json
+import os
+from external_links import WorkbookPool
+from instrumentation import count, stage
+from variable import Formula, cell_variables
+
+FORMATS: tuple = ('jsonl', 'parquet')
+
+# Records per Parquet row group
+ROW_GROUP_SIZE: int = 10000
+
+
+def formula_record(formula: Formula) -> dict:
+    """
+    Gets the exported record of a formula
+    :param formula: Formula, with its variables resolved
+    :return: dict of plain values, variables that could not be resolved are None
+    """
+    return {'sheet': formula.sheet, 'coordinate': formula.coordinate, 'name': formula.name,
+            'formula': formula.value, 'output': formula.output, 'expected': formula.expected,
+            'passed': formula.passed,
+            'variables': [None if v is None or isinstance(v, str) else
+                          {'name': v.name, 'sheet': v.sheet, 'coordinate': v.coordinate, 'value': v.value,
+                           'output': v.output}
+                          for v in cell_variables(formula.variables) or ()]}
+
+
+def open_writer(filename: str, fmt: str = None):
+    """
+    Opens a record writer, use as a context manager
+    :param filename: file to write
+    :param fmt: 'jsonl' or 'parquet', taken from the file extension when None
+    :return: JsonLinesWriter or ParquetWriter
+    """
+    fmt = fmt or os.path.splitext(filename)[1].lstrip('.').lower()
+    check_format(fmt)
+    return JsonLinesWriter(filename) if fmt == 'jsonl' else ParquetWriter(filename)
+
+
+def check_format(fmt: str):
+    """
+    Checks the records can be written in a format, before a template is read for them
+    :param fmt: 'jsonl' or 'parquet'
+    :raises ValueError: if the format is not one of FORMATS
+    :raises ImportError: if the format needs a package that is not installed
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Format must be {' or '.join(FORMATS)}")
+    if fmt == 'parquet':
+        _import_pyarrow()
+
+
+def _import_pyarrow() -> tuple:
+    """
+    :return: the pyarrow and pyarrow.parquet modules
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('Parquet output needs pyarrow: pip install pyarrow') from e
+    return pyarrow, pyarrow.parquet
+
+
+def write_records(template_data: dict, filename: str, fmt: str = None) -> int:
+    """
+    Writes the record of every formula of an extracted template
+    :param template_data: dict containing lists: formulas, constants, names
+    :param filename: file to write
+    :param fmt: 'jsonl' or 'parquet', taken from the file extension when None
+    :return: number of records written
+    """
+    with stage('write_records'), open_writer(filename, fmt) as writer:
+        for f in template_data['formulas']:
+            writer.write(f)
+    return writer.records
+
+
+def export_template(template_filename: str, filename: str, fmt: str = None, workers: int = None,
+                    pool: WorkbookPool = None) -> dict:
+    """
+    Extracts the template and writes the record of every formula as soon as its sheet is matched, in sheet
+    order.  The records have no evaluator results, use write_records after evaluate_template for those.
+    :param template_filename: name of template file
+    :param filename: file to write
+    :param fmt: 'jsonl' or 'parquet', taken from the file extension when None
+    :param workers: number of processes reading worksheets, see process_template_file
+    :param pool: pool the linked workbooks are loaded into, see process_template_file
+    :return: dict of formula list and named ranges list, as process_template_file returns it
+    """
+    from pipeline import run_pipeline
+
+    def write(tests):
+        for f, _ in tests:
+            writer.write(f)
+
+    # Opened first, a format that cannot be written fails before the template is read
+    with stage('export_template'), open_writer(filename, fmt) as writer:
+        return run_pipeline(template_filename, write, workers=workers, pool=pool)
+
+
+class JsonLinesWriter(object):
+    """
+    Writes one JSON object per line.  Values JSON has no type for (dates, times) are written as text.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.records = 0
+        self.__file = open(filename, 'w', encoding='utf-8', newline='\n')
+
+    def write(self, formula: Formula):
+        self.__file.write(json.dumps(formula_record(formula), ensure_ascii=False, default=str))
+        self.__file.write('\n')
+        self.records += 1
+        count('records')
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ParquetWriter(object):
+    """
+    Writes the records as a Parquet file, ROW_GROUP_SIZE records per row group.  Needs pyarrow.
+    expected is written as text since the evaluator may give numbers, text, logicals or dates.
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: file to write
+        :raises ImportError: if pyarrow is not installed
+        """
+        pa, pq = _import_pyarrow()
+
+        self.filename = filename
+        self.records = 0
+        self.__pa = pa
+        variable = pa.struct([('name', pa.string()), ('sheet', pa.string()), ('coordinate', pa.string()),
+                              ('value', pa.string()), ('output', pa.string())])
+        self.__schema = pa.schema([('sheet', pa.string()), ('coordinate', pa.string()), ('name', pa.string()),
+                                   ('formula', pa.string()), ('output', pa.string()), ('expected', pa.string()),
+                                   ('passed', pa.bool_()), ('variables', pa.list_(variable))])
+        self.__writer = pq.ParquetWriter(filename, self.__schema)
+        self.__columns = {name: [] for name in self.__schema.names}
+
+    def write(self, formula: Formula):
+        record = formula_record(formula)
+        if record['expected'] is not None:
+            record['expected'] = str(record['expected'])
+        for name, values in self.__columns.items():
+            values.append(record[name])
+        self.records += 1
+        count('records')
+        if len(self.__columns['sheet']) >= ROW_GROUP_SIZE:
+            self.__flush()
+
+    def close(self):
+        if self.__columns['sheet']:
+            self.__flush()
+        self.__writer.close()
+
+    def __flush(self):
+        self.__writer.write_table(self.__pa.Table.from_pydict(self.__columns, schema=self.__schema))
+        for values in self.__columns.values():
+            values.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,79 @@
+"""
+Groups of copied formulas
+- A formula filled down a column has the same R1C1 form in every row, the rows only differ by the cells they
+  point to.  Such runs are collapsed into one group that gets a single test in the verification document.
+- Grouping is one pass over the formulas with a dict lookup per formula
+"""
+
+
+class FormulaGroup(object):
+    """
+    Formulas in consecutive rows of one column sharing the same R1C1 form, in row order.  The first formula is
+    the representative whose test stands for the whole group.
+    """
+
+    def __init__(self, formula):
+        self.formulas: list = [formula]
+
+    def __len__(self):
+        return len(self.formulas)
+
+    def __iter__(self):
+        return iter(self.formulas)
+
+    @property
+    def representative(self):
+        return self.formulas[0]
+
+    @property
+    def sheet(self) -> str:
+        return self.formulas[0].sheet
+
+    @property
+    def coordinate(self) -> str:
+        """
+        Range covered by the group in A1 format, a single coordinate for a group of one
+        """
+        first, last = self.formulas[0], self.formulas[-1]
+        return first.coordinate if first is last else f'{first.coordinate}:{last.coordinate}'
+
+    def samples(self, count: int) -> list:
+        """
+        Picks members spread evenly over the group, the representative excluded
+        :param count: maximum number of members to pick
+        :return: list of formulas in row order
+        """
+        others = self.formulas[1:]
+        if count >= len(others):
+            return others
+        if count <= 0:
+            return []
+        # Always includes the last member, the others are spaced evenly before it
+        step = len(others) / count
+        return [others[min(len(others) - 1, int((i + 1) * step) - 1)] for i in range(count)]
+
+
+def group_formulas(formulas: list) -> list:
+    """
+    Collapses formulas copied down a column into groups.  Formulas that could not be parsed are never grouped.
+    :param formulas: formulas in extraction order (row by row within each sheet)
+    :return: list of FormulaGroup, ordered by their representative's position in formulas
+    """
+    groups = []
+    open_groups = {}    # (sheet, column, R1C1 form) -> group whose last formula may continue in the next row
+
+    for f in formulas:
+        if f.parsed is None:
+            groups.append(FormulaGroup(f))
+            continue
+
+        key = (f.sheet, f.col, f.parsed.r1c1)
+        group = open_groups.get(key)
+        if group is not None and group.formulas[-1].row == f.row - 1:
+            group.formulas.append(f)
+        else:
+            group = FormulaGroup(f)
+            groups.append(group)
+            open_groups[key] = group
+
+    return groups
@@ -0,0 +1,650 @@
+"""
+Tokenizer and parser for Excel formulas
+- Splits a formula into tokens (numbers, strings, cell references, names, functions, operators, table references)
+- Parses the tokens into an abstract syntax tree following Excel's operator precedence
+- References are stored relative to the formula's cell (R1C1 style), so formulas copied down a column share one
+  parse result.  Tokens are memoized by formula text, parse results by their R1C1-normalized tokens.
+"""
+import re
+from functools import lru_cache
+from typing import NamedTuple, Union
+
+# Token kinds
+NUMBER = 'number'
+STRING = 'string'
+LOGICAL = 'logical'
+ERROR = 'error'
+REFERENCE = 'reference'
+NAME = 'name'
+FUNCTION = 'function'
+TABLE = 'table'
+OPERATOR = 'operator'
+SEPARATOR = 'separator'         # argument (,) or array row (;) separator
+OPEN = 'open'                   # ( or {
+CLOSE = 'close'                 # ) or }
+WHITESPACE = 'whitespace'
+
+MAX_ROW = 1048576
+MAX_COLUMN = 16384
+__CACHE_SIZE = 65536
+
+_NUMBER = re.compile(r'(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+_STRING = re.compile(r'"((?:[^"]|"")*)"')
+_ERROR = re.compile(r'#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A|GETTING_DATA|SPILL!|CALC!)')
+_WHITESPACE = re.compile(r'\s+')
+_OPERATOR = re.compile(r'<>|<=|>=|[-+*/^&=<>%:@]')
+# Sheet prefix: 'Quoted Sheet'!, Sheet1!, Sheet1:Sheet3!, [1]Sheet1!, [Book.xlsx]Sheet1! or [1]! (workbook level name)
+_SHEET = re.compile(r"(?:'((?:[^']|'')+)'|(\[[^\[\]]+\])?([^\s!'\[\](){},;+\-*/^&=<>%\"]*))!")
+_CELL = re.compile(r'(\$?)([A-Za-z]{1,3})(\$?)(\d+)(?![\w.(\[])')
+_COLUMNS = re.compile(r'(\$?)([A-Za-z]{1,3}):(\$?)([A-Za-z]{1,3})(?![\w.(\[])')
+_ROWS = re.compile(r'(\$?)(\d+):(\$?)(\d+)(?![\w.(\[])')
+_IDENTIFIER = re.compile(r'[A-Za-z_\\][\w.\\?]*')
+
+
+class FormulaError(ValueError):
+    """Raised when a formula cannot be tokenized or parsed"""
+
+
+class Token(NamedTuple):
+    kind: str
+    value: object
+
+
+# Syntax tree nodes
+class Number(NamedTuple):
+    value: float
+
+
+class Text(NamedTuple):
+    value: str
+
+
+class Logical(NamedTuple):
+    value: bool
+
+
+class Error(NamedTuple):
+    value: str
+
+
+class Missing(NamedTuple):
+    """Argument left empty, e.g. the second argument of IF(A1,,0)"""
+
+
+class Reference(NamedTuple):
+    """
+    Cell, range, whole-row or whole-column reference.  Relative parts are stored as offsets from the cell
+    holding the formula, absolute ($) parts as the actual row/column.  Whole-column references have no rows,
+    whole-row references have no columns.
+    """
+    sheet: Union[str, None]
+    book: Union[str, None]
+    row1: Union[int, None]
+    col1: Union[int, None]
+    row2: Union[int, None]
+    col2: Union[int, None]
+    row1_abs: bool = False
+    col1_abs: bool = False
+    row2_abs: bool = False
+    col2_abs: bool = False
+
+    def anchor(self, row: int, col: int) -> tuple:
+        """
+        Gets the rows and columns the reference covers when the formula sits in the given cell
+        :param row: row of the formula
+        :param col: column of the formula
+        :return: tuple of (first row, first column, last row, last column)
+        """
+        return (_anchor(self.row1, self.row1_abs, row), _anchor(self.col1, self.col1_abs, col),
+                _anchor(self.row2, self.row2_abs, row), _anchor(self.col2, self.col2_abs, col))
+
+    def is_cell(self) -> bool:
+        start = (self.row1, self.row1_abs, self.col1, self.col1_abs)
+        end = (self.row2, self.row2_abs, self.col2, self.col2_abs)
+        return self.row1 is not None and self.col1 is not None and start == end
+
+    def a1(self, row: int, col: int) -> str:
+        """
+        Formats the reference in A1 style for the formula sitting in the given cell
+        :param row: row of the formula
+        :param col: column of the formula
+        :return: reference text, e.g. 'Sheet2!B3' or 'E1:E5'
+        """
+        r1, c1, r2, c2 = self.anchor(row, col)
+        start = f"{_column_letter(c1) if c1 else ''}{r1 or ''}"
+        end = f"{_column_letter(c2) if c2 else ''}{r2 or ''}"
+        text = start if self.is_cell() else f'{start}:{end}'
+        return f'{_sheet_prefix(self.sheet, self.book)}{text}'
+
+    def r1c1(self) -> str:
+        start = f"{_r1c1_part('R', self.row1, self.row1_abs)}{_r1c1_part('C', self.col1, self.col1_abs)}"
+        end = f"{_r1c1_part('R', self.row2, self.row2_abs)}{_r1c1_part('C', self.col2, self.col2_abs)}"
+        text = start if self.is_cell() else f'{start}:{end}'
+        return f'{_sheet_prefix(self.sheet, self.book)}{text}'
+
+
+class Name(NamedTuple):
+    name: str
+    sheet: Union[str, None] = None
+    book: Union[str, None] = None
+
+
+class TableReference(NamedTuple):
+    """Structured reference such as Table1[@Col] or [Col], the part in brackets is kept as written"""
+    table: Union[str, None]
+    specifier: str
+
+
+class Function(NamedTuple):
+    name: str
+    args: tuple
+
+
+class Unary(NamedTuple):
+    op: str
+    operand: object
+
+
+class Binary(NamedTuple):
+    op: str
+    left: object
+    right: object
+
+
+class Array(NamedTuple):
+    rows: tuple
+
+
+class Union_(NamedTuple):
+    items: tuple
+
+
+class ParsedFormula(object):
+    """
+    Parse result of a formula, independent of the cell the formula is in.  Everything the verification tests
+    need (built-in functions, names, references, formats) is collected from the syntax tree once.
+    """
+
+    def __init__(self, ast, r1c1: str):
+        self.ast = ast
+        self.r1c1: str = r1c1
+        self.built_ins: list = []
+        self.names: list = []
+        self.references: list = []
+        self.tables: list = []
+        self.formats: list = []
+        self.has_digits: bool = False
+
+        self.__collect(ast)
+
+    def __collect(self, node):
+        """
+        Walks the syntax tree collecting the functions, names, references and formats
+        :param node: node to walk
+        :return: n/a
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Function):
+                if node.name not in self.built_ins:
+                    self.built_ins.append(node.name)
+                if node.name == 'TEXT' and len(node.args) > 1 and isinstance(node.args[1], Text):
+                    self.formats.append(node.args[1].value)
+                stack.extend(reversed(node.args))
+            elif isinstance(node, Name):
+                if node.name not in self.names:
+                    self.names.append(node.name)
+            elif isinstance(node, Reference):
+                self.references.append(node)
+            elif isinstance(node, TableReference):
+                self.tables.append(node)
+            elif isinstance(node, Number):
+                self.has_digits = True
+            elif isinstance(node, Unary):
+                stack.append(node.operand)
+            elif isinstance(node, Binary):
+                stack.extend((node.right, node.left))
+            elif isinstance(node, Array):
+                stack.extend(v for row in reversed(node.rows) for v in reversed(row))
+            elif isinstance(node, Union_):
+                stack.extend(reversed(node.items))
+
+
+def parse_formula(formula: str, row: int = 1, col: int = 1) -> ParsedFormula:
+    """
+    Parses a formula sitting in the given cell.  Formulas that are the same once their references are made
+    relative to their cell (copied-down formulas) share the same ParsedFormula.
+    :param formula: formula text, with or without the leading '='
+    :param row: row of the cell holding the formula
+    :param col: column of the cell holding the formula
+    :return: ParsedFormula
+    """
+    if formula.startswith('='):
+        formula = formula[1:]
+    return _parse_tokens(normalize(tokenize(formula), row, col))
+
+
+def to_r1c1(formula: str, row: int = 1, col: int = 1) -> str:
+    """
+    Gets the R1C1 form of a formula, identical for every copy of a filled-down formula
+    :param formula: formula text, with or without the leading '='
+    :param row: row of the cell holding the formula
+    :param col: column of the cell holding the formula
+    :return: normalized formula text
+    """
+    return parse_formula(formula, row, col).r1c1
+
+
+@lru_cache(maxsize=__CACHE_SIZE)
+def tokenize(formula: str) -> tuple:
+    """
+    Splits a formula into tokens.  Cell references keep their absolute positions here, see normalize.
+    :param formula: formula text without the leading '='
+    :return: tuple of Tokens
+    """
+    tokens = []
+    pos = 0
+    length = len(formula)
+
+    while pos < length:
+        char = formula[pos]
+
+        if char.isspace():
+            match = _WHITESPACE.match(formula, pos)
+            tokens.append(Token(WHITESPACE, match.group()))
+            pos = match.end()
+        elif char == '"':
+            match = _STRING.match(formula, pos)
+            if not match:
+                raise FormulaError(f'Unterminated string in {formula}')
+            tokens.append(Token(STRING, match.group(1).replace('""', '"')))
+            pos = match.end()
+        elif char == '#':
+            match = _ERROR.match(formula, pos)
+            if not match:
+                raise FormulaError(f'Unknown error value in {formula}')
+            tokens.append(Token(ERROR, match.group()))
+            pos = match.end()
+        elif char in '(){}':
+            tokens.append(Token(OPEN if char in '({' else CLOSE, char))
+            pos += 1
+        elif char in ',;':
+            tokens.append(Token(SEPARATOR, char))
+            pos += 1
+        else:
+            token, pos = _operand_or_operator(formula, pos)
+            tokens.append(token)
+
+    return tuple(_drop_whitespace(tokens))
+
+
+def normalize(tokens: tuple, row: int, col: int) -> tuple:
+    """
+    Makes the relative parts of every reference relative to the formula's cell
+    :param tokens: tokens from tokenize
+    :param row: row of the cell holding the formula
+    :param col: column of the cell holding the formula
+    :return: tuple of Tokens
+    """
+    normalized = []
+    for token in tokens:
+        if token.kind == REFERENCE:
+            ref = token.value
+            token = Token(REFERENCE, ref._replace(
+                row1=_relative(ref.row1, ref.row1_abs, row), col1=_relative(ref.col1, ref.col1_abs, col),
+                row2=_relative(ref.row2, ref.row2_abs, row), col2=_relative(ref.col2, ref.col2_abs, col)))
+        normalized.append(token)
+    return tuple(normalized)
+
+
+@lru_cache(maxsize=__CACHE_SIZE)
+def _parse_tokens(tokens: tuple) -> ParsedFormula:
+    r1c1 = ''.join(_token_text(t) for t in tokens)
+    parser = _Parser(tokens)
+    return ParsedFormula(parser.parse(), r1c1)
+
+
+def _operand_or_operator(formula: str, pos: int) -> tuple:
+    """
+    Reads the reference, name, function, number or operator starting at pos
+    :param formula: formula text
+    :param pos: position to read from
+    :return: tuple of Token and the position after it
+    """
+    sheet = book = None
+    start = pos
+
+    match = _SHEET.match(formula, pos)
+    if match and (match.group(1) or match.group(2) or match.group(3)):
+        if match.group(1):
+            sheet = match.group(1).replace("''", "'")
+            if sheet.startswith('['):
+                book, sheet = sheet[1:].split(']', 1)
+        else:
+            book = match.group(2)[1:-1] if match.group(2) else None
+            sheet = match.group(3) or None
+        pos = match.end()
+
+    if formula.startswith('#REF!', pos):
+        return Token(ERROR, '#REF!'), pos + 5
+
+    for pattern, kind in ((_CELL, 'cell'), (_COLUMNS, 'columns'), (_ROWS, 'rows')):
+        match = pattern.match(formula, pos)
+        if match:
+            ref = _reference(match, kind, sheet, book)
+            if ref is not None:
+                return _range_end(formula, match.end(), ref)
+
+    if formula[pos:pos + 1] == '[' and sheet is None:
+        return _table_reference(formula, pos, None)
+
+    match = _IDENTIFIER.match(formula, pos)
+    if match:
+        word = match.group()
+        end = match.end()
+        if end < len(formula) and formula[end] == '(' and sheet is None:
+            return Token(FUNCTION, _function_name(word)), end
+        if end < len(formula) and formula[end] == '[' and sheet is None:
+            return _table_reference(formula, end, word)
+        if sheet is None and word.upper() in ('TRUE', 'FALSE'):
+            return Token(LOGICAL, word.upper() == 'TRUE'), end
+        return Token(NAME, Name(word, sheet, book)), end
+
+    if pos > start:
+        raise FormulaError(f'Expected a reference after {formula[start:pos]} in {formula}')
+
+    match = _NUMBER.match(formula, pos)
+    if match:
+        return Token(NUMBER, float(match.group())), match.end()
+
+    match = _OPERATOR.match(formula, pos)
+    if match:
+        return Token(OPERATOR, match.group()), match.end()
+
+    raise FormulaError(f'Unexpected character {formula[pos]!r} in {formula}')
+
+
+def _reference(match, kind: str, sheet, book) -> Union[Reference, None]:
+    """
+    Builds a Reference from a cell/column/row match, None if the match is out of the sheet's bounds
+    (e.g. 'ABCD1' or 'LOG10000000' are names, not cells)
+    """
+    a1_abs, a1, b1_abs, b1 = match.groups()
+    if kind == 'cell':
+        col, row = _column_index(a1), int(b1)
+        if col > MAX_COLUMN or not 0 < row <= MAX_ROW:
+            return None
+        return Reference(sheet, book, row, col, row, col, bool(b1_abs), bool(a1_abs), bool(b1_abs), bool(a1_abs))
+    elif kind == 'columns':
+        col1, col2 = _column_index(a1), _column_index(b1)
+        if max(col1, col2) > MAX_COLUMN:
+            return None
+        return Reference(sheet, book, None, col1, None, col2, False, bool(a1_abs), False, bool(b1_abs))
+    row1, row2 = int(a1), int(b1)
+    if not 0 < min(row1, row2) <= max(row1, row2) <= MAX_ROW:
+        return None
+    return Reference(sheet, book, row1, None, row2, None, bool(a1_abs), False, bool(b1_abs), False)
+
+
+def _range_end(formula: str, pos: int, ref: Reference) -> tuple:
+    """
+    Extends a single cell reference to a range when it is followed by ':' and another cell (A1:B2)
+    """
+    if ref.is_cell() and formula[pos:pos + 1] == ':':
+        match = _CELL.match(formula, pos + 1)
+        if match:
+            end = _reference(match, 'cell', ref.sheet, ref.book)
+            if end is not None:
+                ref = ref._replace(row2=end.row1, col2=end.col1, row2_abs=end.row1_abs, col2_abs=end.col1_abs)
+                return Token(REFERENCE, ref), match.end()
+    return Token(REFERENCE, ref), pos
+
+
+def _table_reference(formula: str, pos: int, table) -> tuple:
+    """
+    Reads a structured reference's bracketed part, brackets may be nested: Table1[[#This Row],[Col]]
+    """
+    depth = 0
+    escaped = False
+    for i in range(pos, len(formula)):
+        char = formula[i]
+        if escaped:
+            escaped = False
+        elif char == "'":
+            escaped = True
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+            if depth == 0:
+                return Token(TABLE, TableReference(table, formula[pos:i + 1])), i + 1
+    raise FormulaError(f'Unterminated table reference in {formula}')
+
+
+def _drop_whitespace(tokens: list) -> list:
+    """
+    Whitespace between two operands is Excel's intersection operator, anywhere else it is ignored
+    """
+    result = []
+    for i, token in enumerate(tokens):
+        if token.kind != WHITESPACE:
+            result.append(token)
+            continue
+        prev = result[-1] if result else None
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        if prev and following and _ends_operand(prev) and _starts_operand(following):
+            result.append(Token(OPERATOR, ' '))
+    return result
+
+
+def _ends_operand(token: Token) -> bool:
+    return token.kind in (REFERENCE, NAME, TABLE) or (token.kind == CLOSE and token.value == ')')
+
+
+def _starts_operand(token: Token) -> bool:
+    return token.kind in (REFERENCE, NAME, TABLE, FUNCTION) or (token.kind == OPEN and token.value == '(')
+
+
+class _Parser(object):
+    """
+    Recursive descent parser, lowest to highest precedence:
+    comparison, &, + -, * /, ^, unary + -, %, reference operators (: space ,)
+    """
+
+    def __init__(self, tokens: tuple):
+        self.tokens = tokens
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise FormulaError('Empty formula')
+        node = self.comparison()
+        if self.pos != len(self.tokens):
+            raise FormulaError(f'Unexpected token {self.tokens[self.pos].value!r}')
+        return node
+
+    def peek(self) -> Union[Token, None]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def accept(self, kind: str, *values) -> Union[Token, None]:
+        token = self.peek()
+        if token is not None and token.kind == kind and (not values or token.value in values):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, kind: str, value: str) -> Token:
+        token = self.accept(kind, value)
+        if token is None:
+            raise FormulaError(f'Expected {value!r}')
+        return token
+
+    def binary(self, operand, *ops):
+        node = operand()
+        while True:
+            token = self.accept(OPERATOR, *ops)
+            if token is None:
+                return node
+            node = Binary(token.value, node, operand())
+
+    def comparison(self):
+        return self.binary(self.concatenation, '=', '<>', '<', '>', '<=', '>=')
+
+    def concatenation(self):
+        return self.binary(self.additive, '&')
+
+    def additive(self):
+        return self.binary(self.multiplicative, '+', '-')
+
+    def multiplicative(self):
+        return self.binary(self.power, '*', '/')
+
+    def power(self):
+        return self.binary(self.unary, '^')
+
+    def unary(self):
+        token = self.accept(OPERATOR, '-', '+', '@')
+        if token is not None:
+            operand = self.unary()
+            return operand if token.value == '@' else Unary(token.value, operand)
+        return self.percent()
+
+    def percent(self):
+        node = self.reference()
+        while self.accept(OPERATOR, '%'):
+            node = Unary('%', node)
+        return node
+
+    def reference(self):
+        return self.binary(self.primary, ':', ' ')
+
+    def primary(self):
+        token = self.peek()
+        if token is None:
+            raise FormulaError('Unexpected end of formula')
+        self.pos += 1
+
+        if token.kind == NUMBER:
+            return Number(token.value)
+        elif token.kind == STRING:
+            return Text(token.value)
+        elif token.kind == LOGICAL:
+            return Logical(token.value)
+        elif token.kind == ERROR:
+            return Error(token.value)
+        elif token.kind in (REFERENCE, NAME, TABLE):
+            return token.value
+        elif token.kind == FUNCTION:
+            self.expect(OPEN, '(')
+            return Function(token.value, self.arguments())
+        elif token.kind == OPEN and token.value == '(':
+            items = [self.comparison()]
+            while self.accept(SEPARATOR, ','):
+                items.append(self.comparison())
+            self.expect(CLOSE, ')')
+            return items[0] if len(items) == 1 else Union_(tuple(items))
+        elif token.kind == OPEN and token.value == '{':
+            return self.array()
+        raise FormulaError(f'Unexpected token {token.value!r}')
+
+    def arguments(self) -> tuple:
+        args = []
+        if self.accept(CLOSE, ')'):
+            return ()
+        while True:
+            token = self.peek()
+            if token is not None and (token.kind == SEPARATOR and token.value == ',' or
+                                      token.kind == CLOSE and token.value == ')'):
+                args.append(Missing())
+            else:
+                args.append(self.comparison())
+            if self.accept(CLOSE, ')'):
+                return tuple(args)
+            self.expect(SEPARATOR, ',')
+
+    def array(self) -> Array:
+        rows = [[]]
+        while True:
+            rows[-1].append(self.unary())
+            if self.accept(CLOSE, '}'):
+                return Array(tuple(tuple(r) for r in rows))
+            token = self.accept(SEPARATOR, ',', ';')
+            if token is None:
+                raise FormulaError("Expected ',' ';' or '}' in array")
+            if token.value == ';':
+                rows.append([])
+
+
+def _token_text(token: Token) -> str:
+    """
+    Writes a normalized token back out as formula text, references in R1C1 form
+    """
+    kind, value = token.kind, token.value
+    if kind == REFERENCE:
+        return value.r1c1()
+    elif kind == NAME:
+        return f'{_sheet_prefix(value.sheet, value.book)}{value.name}'
+    elif kind == TABLE:
+        return f'{value.table or ""}{value.specifier}'
+    elif kind == STRING:
+        return '"' + value.replace('"', '""') + '"'
+    elif kind == NUMBER:
+        return repr(value)
+    elif kind == LOGICAL:
+        return 'TRUE' if value else 'FALSE'
+    elif kind == FUNCTION:
+        return value
+    return value
+
+
+def _function_name(word: str) -> str:
+    """
+    Upper-cases a function name and drops the prefix Excel stores newer functions with (_xlfn.STDEV.S)
+    """
+    word = word.upper()
+    for prefix in ('_XLFN.', '_XLWS.'):
+        if word.startswith(prefix):
+            word = word[len(prefix):]
+    return word
+
+
+def _sheet_prefix(sheet, book) -> str:
+    if sheet is None and book is None:
+        return ''
+    book = f'[{book}]' if book else ''
+    sheet = sheet or ''
+    if re.fullmatch(r'[A-Za-z_][\w.]*', sheet) or not sheet:
+        return f'{book}{sheet}!'
+    return "'" + f'{book}{sheet}'.replace("'", "''") + "'!"
+
+
+def _relative(value, is_abs: bool, origin: int):
+    return value if value is None or is_abs else value - origin
+
+
+def _anchor(value, is_abs: bool, origin: int):
+    return value if value is None or is_abs else value + origin
+
+
+def _r1c1_part(prefix: str, value, is_abs: bool) -> str:
+    if value is None:
+        return ''
+    return f'{prefix}{value}' if is_abs else f'{prefix}[{value}]'
+
+
+@lru_cache(maxsize=None)
+def _column_index(letters: str) -> int:
+    index = 0
+    for char in letters.upper():
+        index = index * 26 + ord(char) - 64
+    return index
+
+
+@lru_cache(maxsize=None)
+def _column_letter(index: int) -> str:
+    letters = ''
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
@@ -0,0 +1,246 @@
+"""
+Stage timers, counters and peak memory sampling for the verification pipeline
+- The pipeline marks its stages with stage('name') and counts things with count('name'), observers registered
+  with add_observer (or the recording() context manager) are told when stages start and end
+- Stages nest, every stage is identified by its path (process_template_file;read_sheets)
+- Recorder collects the stages of a run and dumps them as JSON or as collapsed stacks for flame graph tools
+- With no observer registered stage() returns a shared do-nothing context manager and count() returns at once,
+  so the hooks cost one function call each
+"""
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_observers: list = []
+_memory: int = 0                # number of registered observers that want peak memory
+_tracing: bool = False          # tracemalloc was started here and is stopped with the last memory observer
+_local = threading.local()      # stack of the running stages of each thread
+
+
+class Observer(object):
+    """
+    Base class of the objects notified of the pipeline stages, override the methods of interest
+    """
+    # Peak memory of every stage is sampled with tracemalloc while an observer with memory set is registered
+    memory: bool = False
+
+    def stage_started(self, path: tuple):
+        """
+        :param path: names of the running stages, outermost first, the last one just started
+        """
+        pass
+
+    def stage_ended(self, path: tuple, seconds: float, peak_bytes):
+        """
+        :param path: names of the running stages, outermost first, the last one just ended
+        :param seconds: wall time of the stage
+        :param peak_bytes: highest memory allocated during the stage above what was allocated when it started,
+                           None when memory is not sampled
+        """
+        pass
+
+    def counted(self, path: tuple, name: str, n: int):
+        """
+        :param path: names of the running stages when the count was made
+        :param name: counter
+        :param n: amount added to the counter
+        """
+        pass
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    __slots__ = ('name', 'path', 'start', 'base', 'peak')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        self.path = (stack[-1].path if stack else ()) + (self.name,)
+        self.base = self.peak = None
+        if _memory and tracemalloc.is_tracing():
+            # The running stage keeps the peak reached so far, the peak is then reset for this stage
+            current, peak = tracemalloc.get_traced_memory()
+            if stack and stack[-1].peak is not None:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak = current
+        stack.append(self)
+
+        for o in _observers:
+            o.stage_started(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack = _stack()
+        stack.pop()
+
+        peak_bytes = None
+        if self.base is not None and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            peak_bytes = self.peak - self.base
+            if stack and stack[-1].peak is not None:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+
+        for o in _observers:
+            o.stage_ended(self.path, seconds, peak_bytes)
+        return False
+
+
+def _stack() -> list:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def stage(name: str):
+    """
+    Marks a stage of the pipeline, use as a context manager: with stage('create_document'): ...
+    :param name: name of the stage, nested stages are recorded under the running one
+    :return: context manager
+    """
+    if not _observers:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(name: str, n: int = 1):
+    """
+    Adds to a counter of the running stage
+    :param name: counter
+    :param n: amount to add
+    :return: n/a
+    """
+    if not _observers:
+        return
+    stack = _stack()
+    path = stack[-1].path if stack else ()
+    for o in _observers:
+        o.counted(path, name, n)
+
+
+def enabled() -> bool:
+    """
+    :return: True when an observer is registered, for callers that want to skip work only done for the counters
+    """
+    return bool(_observers)
+
+
+def add_observer(observer: Observer):
+    """
+    Registers an observer, tracemalloc is started if the observer samples memory and it is not running yet
+    :param observer: observer to notify
+    :return: n/a
+    """
+    global _memory, _tracing
+    _observers.append(observer)
+    if observer.memory:
+        _memory += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing = True
+
+
+def remove_observer(observer: Observer):
+    """
+    Unregisters an observer, stops tracemalloc once no observer samples memory if it was started by add_observer
+    :param observer: observer to remove
+    :return: n/a
+    """
+    global _memory, _tracing
+    _observers.remove(observer)
+    if observer.memory:
+        _memory -= 1
+        if not _memory and _tracing:
+            tracemalloc.stop()
+            _tracing = False
+
+
+@contextmanager
+def recording(memory: bool = False):
+    """
+    Records the stages run inside the with block
+        with recording() as recorder:
+            process_template_file(filename)
+        print(recorder.to_json())
+    :param memory: also sample the peak memory of every stage (slows the pipeline down noticeably)
+    :return: context manager giving the Recorder
+    """
+    recorder = Recorder(memory)
+    add_observer(recorder)
+    try:
+        yield recorder
+    finally:
+        remove_observer(recorder)
+
+
+class Recorder(Observer):
+    """
+    Observer aggregating the stages by path: number of calls, total and longest wall time, highest peak
+    memory and the counters, in the order the stages were first seen
+    """
+
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.stages: dict = {}      # path -> {'calls', 'seconds', 'max_seconds', 'peak_bytes', 'counters'}
+
+    def __entry(self, path: tuple) -> dict:
+        entry = self.stages.get(path)
+        if entry is None:
+            entry = self.stages[path] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_bytes': None,
+                                         'counters': {}}
+        return entry
+
+    def stage_started(self, path: tuple):
+        self.__entry(path)
+
+    def stage_ended(self, path: tuple, seconds: float, peak_bytes):
+        entry = self.__entry(path)
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['max_seconds'] = max(entry['max_seconds'], seconds)
+        if peak_bytes is not None:
+            entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak_bytes)
+
+    def counted(self, path: tuple, name: str, n: int):
+        counters = self.__entry(path)['counters']
+        counters[name] = counters.get(name, 0) + n
+
+    def to_dict(self) -> dict:
+        """
+        :return: dict of stage path (names joined with ';') to its totals
+        """
+        return {';'.join(path) or '<root>': dict(entry) for path, entry in self.stages.items()}
+
+    def to_json(self, indent: int = 2) -> str:
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def collapsed(self) -> str:
+        """
+        Collapsed stack lines ('outer;inner microseconds') as read by flamegraph.pl, speedscope and similar
+        tools.  The time of a stage excludes its nested stages, so every microsecond is counted once.
+        :return: one line per stage
+        """
+        self_time = {path: entry['seconds'] for path, entry in self.stages.items() if path}
+        for path, entry in self.stages.items():
+            if len(path) > 1 and path[:-1] in self_time:
+                self_time[path[:-1]] -= entry['seconds']
+        return '\n'.join(f"{';'.join(path)} {max(0, round(seconds * 1e6))}" for path, seconds in self_time.items())
@@ -7,9 +7,11 @@ Module for creating Excel formula verification tests
 """
 # TODO: Create UI for this
 from docx import Document
+from evaluator import evaluate_template
+from instrumentation import stage
 from template_file import process_template_file
 from verification_document import create_document
-from utils import create_filename, output_formulas_to_excel
+from output_files import create_filename, output_formulas_to_excel
 
 
 def main():
@@ -25,11 +27,10 @@ def main():
 
     ########
     outfile: str = create_filename(out_dir, 'formulas and names', extension='xlsx')
-    template_data: dict = process_template_file(template_fname, outfile)
-
-    for name, items in template_data:
-        output_formulas_to_excel(outfile, name, items)
+    template_data: dict = process_template_file(template_fname)
+    evaluate_template(template_fname, template_data)
 
+    output_formulas_to_excel(outfile, template_data)
 
     filename: str = create_filename(out_dir, template_desc)
     # NOTE: Before the document is created, will need to update the formulas with:
@@ -40,7 +41,8 @@ def main():
     #   - Dealing with Table formulas
     document: Document = create_document(template_data, template_name, template_desc)
 
-    document.save(filename)
+    with stage('Document.save'):
+        document.save(filename)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,294 @@
+"""
+Lookup tables used to match constants, formulas and named ranges together
+- Built once per workbook so every match is a hash lookup instead of a scan over all names
+- Named ranges are rectangles, looked up by the cell or range they cover through a bucketed interval index
+- Structured references (Table1[@Col], [Col]) are resolved to cell ranges through the tables' names and columns
+"""
+import re
+from functools import lru_cache
+
+# Special items of a structured reference, [@Col] is short for [[#This Row],[Col]]
+_THIS_ROW = '#THIS ROW'
+_ESCAPED = re.compile(r"'(.)")
+
+
+class RangeIndex(object):
+    """
+    Interval index of rectangular ranges on the sheets of a workbook.  Each sheet's rows are split in buckets,
+    a range is listed in every bucket its rows overlap, so finding the ranges covering a cell only checks the
+    ranges of one bucket.  Results keep the order the ranges were added in.
+    """
+    BUCKET_ROWS: int = 64
+
+    def __init__(self):
+        self.__buckets: dict = {}       # sheet -> bucket -> entries (row1, col1, row2, col2, order, item)
+        self.__entries: dict = {}       # sheet -> every entry on the sheet
+
+    def __len__(self):
+        return sum(len(e) for e in self.__entries.values())
+
+    def add(self, sheet: str, row1: int, col1: int, row2: int, col2: int, item):
+        """
+        Adds a range, row1/col1 is the top left cell and row2/col2 the bottom right one
+        :return: n/a
+        """
+        entries = self.__entries.setdefault(sheet, [])
+        entry = (row1, col1, row2, col2, len(entries), item)
+        entries.append(entry)
+
+        buckets = self.__buckets.setdefault(sheet, {})
+        for b in range(row1 // self.BUCKET_ROWS, row2 // self.BUCKET_ROWS + 1):
+            buckets.setdefault(b, []).append(entry)
+
+    def covering(self, sheet: str, row: int, col: int) -> list:
+        """
+        Gets the ranges that contain a cell
+        :return: list of the items of the ranges, in the order they were added
+        """
+        entries = self.__buckets.get(sheet, {}).get(row // self.BUCKET_ROWS, ())
+        return [e[5] for e in entries if e[0] <= row <= e[2] and e[1] <= col <= e[3]]
+
+    def overlapping(self, sheet: str, row1, col1, row2, col2) -> list:
+        """
+        Gets the ranges that share at least one cell with the given range.  row1/row2 are None for whole
+        column ranges (A:A), col1/col2 are None for whole row ranges (1:1).
+        :return: list of the items of the ranges, in the order they were added
+        """
+        row1, row2 = (0, float('inf')) if row1 is None else (min(row1, row2), max(row1, row2))
+        col1, col2 = (0, float('inf')) if col1 is None else (min(col1, col2), max(col1, col2))
+
+        entries = self.__entries.get(sheet, [])
+        if row2 - row1 + 1 < len(entries) * self.BUCKET_ROWS:
+            buckets = self.__buckets[sheet]
+            found = {e[4]: e for b in range(row1 // self.BUCKET_ROWS, row2 // self.BUCKET_ROWS + 1)
+                     for e in buckets.get(b, ())}
+            entries = [found[i] for i in sorted(found)]
+
+        return [e[5] for e in entries if e[0] <= row2 and row1 <= e[2] and e[1] <= col2 and col1 <= e[3]]
+
+
+class TableIndex(object):
+    """
+    Indexes the tables of a workbook by name (case insensitive, like Excel), by column name and by the cells they
+    cover, so a structured reference is resolved with a few dict lookups whatever the number of tables
+    """
+
+    def __init__(self, tables: list = ()):
+        self.by_name: dict = {}         # upper case table name -> table
+        self.columns: dict = {}         # (upper case table name, upper case column name) -> column index
+        self.ranges = RangeIndex()      # tables by the cells they cover
+
+        for t in tables:
+            key = t.name.upper()
+            self.by_name[key] = t
+            for i, column in enumerate(t.columns):
+                self.columns[(key, column.upper())] = t.col + i
+            self.ranges.add(t.sheet, t.row, t.col, t.last_row, t.last_col, t)
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def table_at(self, sheet: str, row: int, col: int):
+        """
+        Gets the table containing a cell, the table unqualified references ([@Col]) in that cell refer to
+        :return: table or None
+        """
+        tables = self.ranges.covering(sheet, row, col)
+        return tables[0] if tables else None
+
+    def resolve(self, ref, sheet: str, row: int, col: int):
+        """
+        Gets the cells a structured reference points to
+        :param ref: TableReference from the formula parser
+        :param sheet: sheet of the formula's cell
+        :param row: row of the formula's cell, [#This Row] refers to it
+        :param col: column of the formula's cell
+        :return: tuple (sheet, first row, first column, last row, last column) or None if the reference does not
+                 match a table, a column or (for [#This Row]) a data row of the table
+        """
+        table = self.by_name.get(ref.table.upper()) if ref.table else self.table_at(sheet, row, col)
+        if table is None:
+            return None
+
+        specials, first, last = _parse_specifier(ref.specifier)
+        data = (table.row + table.header_rows, table.last_row - table.totals_rows)
+        rows = []
+        for special in specials or ('#DATA',):
+            if special == '#ALL':
+                rows.append((table.row, table.last_row))
+            elif special == '#DATA':
+                rows.append(data)
+            elif special == '#HEADERS' and table.header_rows:
+                rows.append((table.row, table.row))
+            elif special == '#TOTALS' and table.totals_rows:
+                rows.append((table.last_row, table.last_row))
+            elif special == _THIS_ROW and table.sheet == sheet and data[0] <= row <= data[1]:
+                rows.append((row, row))
+            else:
+                return None
+
+        col1, col2 = table.col, table.last_col
+        if first is not None:
+            key = table.name.upper()
+            col1, col2 = self.columns.get((key, first.upper())), self.columns.get((key, last.upper()))
+            if col1 is None or col2 is None:
+                return None
+
+        return (table.sheet, min(r[0] for r in rows), min(col1, col2), max(r[1] for r in rows), max(col1, col2))
+
+
+@lru_cache(maxsize=4096)
+def _parse_specifier(specifier: str) -> tuple:
+    """
+    Splits the bracketed part of a structured reference: [@Col], [Col], [#All], [[#Headers],[Col1]:[Col2]], ...
+    :param specifier: text in brackets as the formula parser keeps it
+    :return: tuple of the special items (upper case), first and last column names (None for every column)
+    """
+    inner = specifier[1:-1].strip()
+    specials = []
+    if inner.startswith('@'):
+        specials.append(_THIS_ROW)
+        inner = inner[1:].strip()
+
+    items = []
+    if inner.startswith('['):
+        depth = 0
+        escaped = False
+        start = 0
+        for i, char in enumerate(inner):
+            if escaped:
+                escaped = False
+            elif char == "'":
+                escaped = True
+            elif char == '[':
+                depth += 1
+                if depth == 1:
+                    start = i + 1
+            elif char == ']':
+                depth -= 1
+                if depth == 0:
+                    items.append(inner[start:i])
+    elif inner:
+        items.append(inner)
+
+    columns = []
+    for item in items:
+        if item.strip().startswith('#'):
+            specials.append(' '.join(item.upper().split()))
+        else:
+            # A ' escapes the next character of a column name ([Total '# Sold])
+            columns.append(_ESCAPED.sub(r'\1', item))
+
+    return tuple(specials), (columns[0] if columns else None), (columns[-1] if columns else None)
+
+
+class NameIndex(object):
+    """
+    Indexes the named ranges of a workbook by the cells they cover and by their name, and the constants and
+    formulas by their cell.  Once the formula variables are resolved, the formulas using each name are recorded
+    as well (reverse "used-by" index).  The tables of the workbook resolve the formulas' structured references,
+    the external resolver (see external_links) their references to other workbooks.
+    """
+
+    def __init__(self, named_ranges: list, records: list = (), tables: list = (), external=None):
+        self.named_ranges = named_ranges
+        self.ranges = RangeIndex()      # named ranges by the cells they cover
+        self.by_name: dict = {}         # name -> positions in named_ranges of every range with that name
+        self.cells: dict = {}           # (sheet, row, col) -> constant or formula in that cell
+        self.used_by: dict = {}         # name -> formulas using the name
+        self.tables = TableIndex(tables)
+        self.external = external        # ExternalResolver or None to leave external references unresolved
+
+        self.add_records(records)
+
+        for i, n in enumerate(named_ranges):
+            if n.row is not None:
+                self.ranges.add(n.sheet, n.row, n.col, n.last_row, n.last_col, n)
+            self.by_name.setdefault(n.name, []).append(i)
+
+    def add_records(self, records: list):
+        """
+        Indexes constants and formulas by their cell, records can be added as their sheets are read
+        :param records: constants and formulas
+        :return: n/a
+        """
+        for r in records:
+            self.cells[(r.sheet, r.row, r.col)] = r
+
+    def name_at(self, sheet: str, row: int, col: int):
+        """
+        Gets the named range covering a cell
+        :param sheet: sheet the cell is on
+        :param row: row of the cell
+        :param col: column of the cell
+        :return: the first named range defined over the cell or None
+        """
+        names = self.ranges.covering(sheet, row, col)
+        return names[0] if names else None
+
+    def resolve(self, names, cells=(), external=()) -> list:
+        """
+        Gets the variables of a formula: the named ranges matching the given names, in the order the named
+        ranges were defined, followed by the records of the referenced cells, then the cells of other workbooks.
+        Ranges stay a single variable, they are only expanded to one variable per cell where a test table shows
+        them (see table.table_variables).  A referenced cell that is part of a named range resolves to the named
+        range's cell, or to nothing when the range is a variable already.  Cells that are blank or only hold text
+        are skipped.
+        :param names: names to look up
+        :param cells: (sheet, row, col) of the cells referenced directly
+        :param external: (workbook, sheet, row, col) of the cells of other workbooks referenced
+        :return: list of variables
+        """
+        positions = sorted(i for name in set(names) for i in self.by_name.get(name, ()))
+        variables = [self.named_ranges[i] for i in positions]
+
+        seen = set(map(id, variables))
+        for key in cells:
+            n = self.name_at(*key)
+            if n is not None and id(n) in seen:
+                # The cell is shown with the rest of the range
+                continue
+            v = n.cell_at(key[1], key[2]) if n is not None else self.cells.get(key)
+            if v is not None and id(v) not in seen:
+                seen.add(id(v))
+                variables.append(v)
+
+        for key in (external if self.external is not None else ()):
+            v = self.external.cell(*key)
+            if v is not None and id(v) not in seen:
+                seen.add(id(v))
+                variables.append(v)
+        return variables
+
+    def add_usages(self, formulas: list):
+        """
+        Records which formulas use each name, formula variables must already be resolved.  A formula also
+        uses the named ranges overlapping a range it references (SUM(A1:A10) uses a name over A5:A20).
+        :param formulas: formulas to record
+        :return: n/a
+        """
+        for f in formulas:
+            for v in f.variables:
+                self.__add_user(v.name, f)
+
+            areas = []
+            for ref in (f.parsed.references if f.parsed else ()):
+                if not ref.is_cell() and ref.book is None:
+                    areas.append((ref.sheet or f.sheet,) + ref.anchor(f.row, f.col))
+            for ref in (f.parsed.tables if f.parsed else ()):
+                area = self.tables.resolve(ref, f.sheet, f.row, f.col)
+                if area is not None and area[1:3] != area[3:5]:
+                    areas.append(area)
+
+            for area in areas:
+                for n in self.ranges.overlapping(*area):
+                    self.__add_user(n.name, f)
+
+    def __add_user(self, name: str, formula):
+        # The formulas are recorded one at a time, a formula using a name twice is already the last user
+        users = self.used_by.setdefault(name, [])
+        if not users or users[-1] is not formula:
+            users.append(formula)
+
+    def is_used(self, name: str) -> bool:
+        return name in self.used_by
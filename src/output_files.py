@@ -0,0 +1,59 @@
+"""
+Output file names and the formulas workbook
+- Kept apart from the python-docx helpers of utils so writing the workbook does not import python-docx
+"""
+from datetime import datetime
+import openpyxl
+
+# Record lists of the template data written to the workbook, one sheet each in this order
+__SHEETS = ('formulas', 'names', 'constants')
+
+
+def create_filename(directory: str, description: str, initials: str = 'ELS', extension: str = 'docx') -> str:
+    """
+    Sets the name of the file based on the current timestamp and directory
+    :param directory: Directory where document will be stored
+    :param description: Description of the document
+    :param initials: Initials of user
+    :param extension: File type extension (should be docx, xlsx, jsonl or parquet)
+    :return: name of the document as string
+    """
+    if extension not in ['docx', 'xlsx', 'jsonl', 'parquet']:
+        raise ValueError("Extension must be docx, xlsx, jsonl or parquet")
+    now = datetime.now().strftime
+    return f"{directory}{now('%Y%m%d')}_{initials}_{description}_{now('%H%M%S')}.{extension}"
+
+
+def output_formulas_to_excel(filename: str, template_data: dict):
+    """
+    Writes out the formulas, names and constants of a template to one sheet each in a new excel file, an
+    existing file is replaced (the names create_filename gives are new every time).
+    The workbook is created once in write-only mode and saved once.  Each sheet has an index column followed by
+    one column per record field, holding plain values only: lists are written as comma separated text (variables
+    by name).
+    :param filename: Excel file to write items to
+    :param template_data: dict of the formulas, names and constants lists, as process_template_file returns it
+    :return: n/a
+    """
+    book = openpyxl.Workbook(write_only=True)
+
+    for sheet_name in __SHEETS:
+        items = template_data[sheet_name]
+        sheet = book.create_sheet(sheet_name)
+        columns = list(items[0].fields) if items else []
+        sheet.append([None] + columns)
+        for i, item in enumerate(items):
+            sheet.append([i] + [__flat_value(getattr(item, c)) for c in columns])
+
+    book.save(filename)
+
+
+def __flat_value(value):
+    """
+    Converts a record field to a value a cell can hold
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, list):
+        return ', '.join(str(getattr(v, 'name', v)) for v in value)
+    return str(value)
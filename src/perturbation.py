@@ -0,0 +1,320 @@
+"""
+What-if testing of the formulas of a template
+- The inputs are the numeric constants of the template and its numeric global named constants.  Every scenario
+  gives them other values: random (within a relative spread around the cached value), boundary (zero, the
+  negated value and the edges of the spread) or values given by the user
+- Every formula downstream of an input is recomputed for all the scenarios at once (see evaluate_scenarios): the
+  formulas of one dependency level sharing an R1C1 form are a single batch with one entry per formula and scenario
+- A formula is reported when it differs from what was declared for it, an Excel expression or a Python reference
+  implementation, in any scenario, or when it turns into an Excel error in scenarios where it did not before
+"""
+import re
+import time
+from types import SimpleNamespace
+import numpy as np
+from dependency_graph import DependencyGraph
+from evaluator import (ABS_TOLERANCE, ERRORS, REL_TOLERANCE, ScenarioValue, cached_values, evaluate_scenarios,
+                       matches, python_value)
+from formula_parser import FormulaError, parse_formula
+from instrumentation import count, stage
+from variable import Formula
+
+MODES: tuple = ('random', 'boundary', 'given')
+
+# Relative change of the inputs in random and boundary scenarios
+SPREAD: float = 0.5
+
+# Scenarios kept with every finding, as examples
+EXAMPLES: int = 5
+
+_LABEL = re.compile(r"^(?:'((?:[^']|'')+)'|([^!]+))!\$?([A-Z]{1,3})\$?(\d+)$")
+
+
+class Finding(object):
+    """
+    A formula that gave unexpected results in some scenarios
+    """
+    __slots__ = ('formula', 'kind', 'scenarios', 'results', 'expected')
+
+    fields: tuple = ('label', 'kind', 'scenarios', 'results', 'expected')
+
+    def __init__(self, formula: Formula, kind: str, scenarios: list, results: list, expected: list = None):
+        """
+        :param formula: the formula
+        :param kind: 'mismatch' when it differs from its declared expectation, 'error' when it gives an Excel error
+        :param scenarios: numbers of the scenarios in which it did
+        :param results: its results in the first EXAMPLES of those scenarios
+        :param expected: the expected results in the same scenarios, for mismatches
+        """
+        self.formula = formula
+        self.kind = kind
+        self.scenarios = scenarios
+        self.results = results
+        self.expected = expected
+
+    @property
+    def label(self) -> str:
+        return f'{self.formula.sheet}!{self.formula.coordinate}'
+
+    def to_dict(self) -> dict:
+        return {f: getattr(self, f) for f in self.fields}
+
+    def __repr__(self):
+        return f'Finding({self.label}, {self.kind}, {len(self.scenarios)} scenarios)'
+
+
+class PerturbationReport(object):
+    """
+    Outcome of a what-if run
+    """
+
+    def __init__(self, scenarios: int, inputs: dict):
+        self.scenarios = scenarios
+        self.inputs = inputs                # label -> array of the input in every scenario
+        self.evaluated: int = 0             # formulas recomputed
+        self.unsupported: list = []         # formulas downstream of an input the evaluator cannot compute
+        self.findings: list = []
+        self.seconds: float = 0.0
+
+    def summary(self) -> str:
+        return (f'{len(self.inputs)} inputs, {self.scenarios} scenarios, {self.evaluated} formulas recomputed, '
+                f'{len(self.unsupported)} unsupported, {len(self.findings)} findings in {self.seconds:.2f}s')
+
+    def to_dict(self) -> dict:
+        return {'scenarios': self.scenarios, 'inputs': sorted(self.inputs), 'evaluated': self.evaluated,
+                'unsupported': [f'{f.sheet}!{f.coordinate}' for f in self.unsupported],
+                'findings': [f.to_dict() for f in self.findings], 'seconds': round(self.seconds, 3)}
+
+
+def perturb_template(filename: str, template_data: dict, scenarios: int = 1000, mode: str = 'random',
+                     spread: float = SPREAD, given: dict = None, expectations: dict = None,
+                     seed: int = None) -> PerturbationReport:
+    """
+    Runs the what-if scenarios of a template against the values cached in the file
+    :param filename: name of template file
+    :param template_data: dict containing lists: formulas, constants, names
+    :param scenarios: number of scenarios, the length of the given values in 'given' mode
+    :param mode: 'random', 'boundary' or 'given' (only the inputs in given vary)
+    :param spread: relative change of the inputs in random and boundary scenarios
+    :param given: dict of input label ('Sheet!B2' or a global name) to its value in every scenario, replacing the
+                  generated values of that input
+    :param expectations: dict of formula label ('Sheet!C5') to what the formula should give: an Excel expression
+                         ('Volume*Conc/1000', written as if it were in the formula's cell) or a Python function,
+                         called with a function returning the value of a label in every scenario
+    :param seed: seed of the random values
+    :return: PerturbationReport
+    """
+    return perturb_formulas(template_data, cached_values(filename, template_data), scenarios, mode, spread, given,
+                            expectations, seed)
+
+
+def perturb_formulas(template_data: dict, values: dict, scenarios: int = 1000, mode: str = 'random',
+                     spread: float = SPREAD, given: dict = None, expectations: dict = None,
+                     seed: int = None) -> PerturbationReport:
+    """
+    Runs the what-if scenarios of a template, see perturb_template
+    :param values: dict of (sheet, row, col) to the value Excel cached for the cell
+    :return: PerturbationReport
+    """
+    if mode not in MODES:
+        raise ValueError(f"Mode must be {', '.join(MODES)}")
+    given = {k: np.asarray(v, dtype=float) for k, v in (given or {}).items()}
+    if mode == 'given':
+        if not given:
+            raise ValueError("The given mode needs the values of the inputs")
+        scenarios = len(next(iter(given.values())))
+    if any(len(v) != scenarios for v in given.values()):
+        raise ValueError(f'Every given input needs {scenarios} values')
+
+    start = time.perf_counter()
+    with stage('perturb_formulas'):
+        graph = DependencyGraph(template_data)
+        inputs = find_inputs(template_data, values)
+        unknown = set(given) - set(inputs)
+        if unknown:
+            raise ValueError(f"Not numeric constants of the template: {', '.join(sorted(unknown))}")
+        if mode == 'given':
+            inputs = {label: inputs[label] for label in given}
+
+        rng = np.random.default_rng(seed)
+        report = PerturbationReport(scenarios, {})
+        scenario_values = dict(values)
+        for label, (record, base) in inputs.items():
+            varied = given.get(label)
+            if varied is None:
+                varied = generate_values(base, scenarios, mode, spread, rng)
+            report.inputs[label] = varied
+            key = (None, record.name) if record.row is None else (record.sheet, record.row, record.col)
+            scenario_values[key] = ScenarioValue(varied)
+
+        names = {}
+        for n in template_data['names']:
+            names.setdefault(n.name, []).append(n)
+
+        batches, report.unsupported = _batches(graph, [record for record, _ in inputs.values()])
+        with stage('evaluate_scenarios'):
+            results = evaluate_scenarios(batches, scenario_values, names, scenarios)
+        count('scenario_formulas', len(results))
+
+        # Formulas using an unsupported one were computed from its cached value, they are not reliable either
+        unreliable = graph.downstream_of(graph.node(f) for f, result in results if result is None)
+        for f, result in results:
+            if graph.node(f) in unreliable:
+                report.unsupported.append(f)
+                continue
+            report.evaluated += 1
+            finding = _errors(f, result, values.get((f.sheet, f.row, f.col)))
+            if finding is not None:
+                report.findings.append(finding)
+
+        with stage('expectations'):
+            labels = {f'{f.sheet}!{f.coordinate}': f for f in template_data['formulas']}
+            for label, expectation in (expectations or {}).items():
+                if label not in labels:
+                    raise ValueError(f'No formula at {label}')
+                finding = _check(labels[label], expectation, scenario_values, names, scenarios)
+                if finding is not None:
+                    report.findings.append(finding)
+
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def find_inputs(template_data: dict, values: dict) -> dict:
+    """
+    Finds the inputs that can be perturbed: constants holding a number and global names defined as a number
+    :param template_data: dict containing lists: formulas, constants, names
+    :param values: dict of (sheet, row, col) to the value Excel cached for the cell
+    :return: dict of label ('Sheet!B2' or the global name) to tuples (record, value)
+    """
+    inputs = {}
+    for c in template_data['constants']:
+        value = values.get((c.sheet, c.row, c.col))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            inputs[f'{c.sheet}!{c.coordinate}'] = (c, float(value))
+    for n in template_data['names']:
+        if n.is_global:
+            try:
+                inputs[n.name] = (n, float(n.value.lstrip('=')))
+            except (ValueError, AttributeError):
+                pass
+    return inputs
+
+
+def generate_values(base: float, scenarios: int, mode: str, spread: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Generates the values of one input in every scenario
+    :param base: cached value of the input
+    :param scenarios: number of scenarios
+    :param mode: 'random' or 'boundary'
+    :param spread: relative change of the input, an input of 0 varies by spread itself
+    :param rng: random generator
+    :return: array of one value per scenario
+    """
+    low, high = (base * (1 - spread), base * (1 + spread)) if base else (-spread, spread)
+    if mode == 'random':
+        return rng.uniform(min(low, high), max(low, high), scenarios)
+    return rng.choice(np.array([0.0, base, -base, low, high]), scenarios)
+
+
+def _batches(graph: DependencyGraph, inputs: list) -> tuple:
+    """
+    Groups the formulas downstream of the inputs into evaluator batches, in dependency order
+    :return: tuple of the list of batches and the list of formulas that cannot be ordered (circular references)
+    """
+    affected = graph.downstream_of(graph.node(r) for r in inputs)
+    level = {}
+    batches = {}
+    circular = []
+    for node in graph.topological_order():
+        record = graph.nodes[node]
+        precedents = graph.precedents[node]
+        if any(p not in level for p in precedents):
+            # Part of a circular reference or downstream of one
+            if node in affected and isinstance(record, Formula):
+                circular.append(record)
+            continue
+        level[node] = max((level[p] for p in precedents), default=-1) + 1
+        if node in affected and isinstance(record, Formula) and record.parsed is not None:
+            batches.setdefault((level[node], record.sheet, record.parsed.r1c1), []).append(record)
+
+    ordered = sorted(batches.items(), key=lambda item: item[0][0])
+    return [formulas for _, formulas in ordered], circular
+
+
+def _errors(formula: Formula, result: np.ndarray, cached) -> Finding:
+    """
+    Reports a formula giving Excel errors in some scenarios, unless Excel gave the error as well
+    """
+    if result.dtype != object or (isinstance(cached, str) and cached in ERRORS):
+        return None
+    failed = [s for s, v in enumerate(result) if isinstance(v, str) and v in ERRORS]
+    if not failed:
+        return None
+    return Finding(formula, 'error', failed, [result[s] for s in failed[:EXAMPLES]])
+
+
+def _check(formula: Formula, expectation, values: dict, names: dict, scenarios: int) -> Finding:
+    """
+    Compares a formula with its declared expectation in every scenario
+    """
+    result = values.get((formula.sheet, formula.row, formula.col))
+    if not isinstance(result, ScenarioValue):
+        # Not downstream of any input, or not supported: the result is the same in every scenario
+        result = np.full(scenarios, result, dtype=object)
+    else:
+        result = result.values
+
+    if callable(expectation):
+        expected = np.asarray(expectation(lambda label: _lookup(label, values, names, scenarios)))
+        if expected.shape != (scenarios,):
+            expected = np.broadcast_to(expected, (scenarios,))
+    else:
+        try:
+            parsed = parse_formula(expectation.lstrip('='), formula.row, formula.col)
+        except FormulaError as e:
+            raise ValueError(f'Expectation of {formula.sheet}!{formula.coordinate}: {e}')
+        # The expression is evaluated as if it were in the formula's cell, the formula's result is put back after
+        key = (formula.sheet, formula.row, formula.col)
+        own = values.get(key)
+        expression = SimpleNamespace(sheet=formula.sheet, row=formula.row, col=formula.col, parsed=parsed)
+        _, expected = evaluate_scenarios([[expression]], values, names, scenarios)[0]
+        values[key] = own
+        if expected is None:
+            raise ValueError(f'Expectation of {formula.sheet}!{formula.coordinate} cannot be evaluated')
+
+    if result.dtype == float and expected.dtype == float:
+        failed = np.flatnonzero(~np.isclose(result, expected, rtol=REL_TOLERANCE, atol=ABS_TOLERANCE))
+    else:
+        failed = [s for s in range(scenarios)
+                  if not matches(python_value(expected[s]), python_value(result[s]))]
+    if len(failed) == 0:
+        return None
+    failed = [int(s) for s in failed]
+    return Finding(formula, 'mismatch', failed, [python_value(result[s]) for s in failed[:EXAMPLES]],
+                   [python_value(expected[s]) for s in failed[:EXAMPLES]])
+
+
+def _lookup(label: str, values: dict, names: dict, scenarios: int) -> np.ndarray:
+    """
+    Value of a cell ('Sheet!B2') or global name in every scenario, for reference implementations
+    """
+    match = _LABEL.match(label)
+    if match:
+        quoted, plain, letters, row = match.groups()
+        col = 0
+        for letter in letters:
+            col = col * 26 + ord(letter) - 64
+        key = ((quoted or '').replace("''", "'") or plain, int(row), col)
+    else:
+        key = (None, label)
+
+    value = values.get(key)
+    if isinstance(value, ScenarioValue):
+        return value.values
+    if key[0] is None:
+        found = [n for n in names.get(label, ()) if n.is_global]
+        if not found:
+            raise KeyError(label)
+        value = float(found[0].value.lstrip('='))
+    return np.full(scenarios, value, dtype=float if isinstance(value, (int, float)) else object)
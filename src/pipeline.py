@@ -0,0 +1,242 @@
+"""
+Pipelined extraction and document rendering
+- A producer thread streams the worksheets of the template and hands each finished sheet over through a bounded
+  queue, the tables of a sheet are rendered while the following sheets are still being read
+- A sheet is rendered once every sheet its formulas refer to (directly, through a named range or a table) has been
+  read, sheets are always rendered in workbook order so the document is the same on every run
+- Large templates are read by a pool of worker processes, at most queue_size sheets ahead of the renderer
+- run_pipeline hands the tests to any writer, pipeline_document renders them into the verification document
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from external_links import ExternalResolver, WorkbookPool
+from instrumentation import count, stage
+from name_index import NameIndex
+from template_file import (PARALLEL_MIN_BYTES, _build_named_ranges, _count_records, _get_name_destinations,
+                           _get_name_targets, _read_sheet_in_worker, _read_sheet_records, _read_tables)
+from variable import Formula, parse_value
+from workbook_reader import WorkbookReader
+
+# Sheets read ahead of the renderer
+QUEUE_SIZE: int = 4
+
+_DONE = object()
+
+
+def pipeline_document(template_filename: str, filename: str, template_name: str, template_description: str,
+                      margins: tuple = (0.5, 0.5, 0.5, 0.5),
+                      tab_stops: tuple = (4.0, 7.5),
+                      group: bool = False,
+                      samples: int = 0,
+                      workers: int = None,
+                      queue_size: int = QUEUE_SIZE,
+                      pool: WorkbookPool = None) -> dict:
+    """
+    Extracts the template and writes its verification test document at the same time.  The document is the
+    one stream_document writes after process_template_file, in sheet order.  Dependency order needs every
+    formula before the first table and is not available here, neither are the evaluator's results (run
+    evaluate_template and stream_document for those).
+    :param template_filename: name of template file
+    :param filename: name of the .docx file to write
+    :param template_name: Name of the excel template
+    :param template_description: Description of the excel template
+    :param margins: Document margins
+    :param tab_stops: Header/footer tab stops
+    :param group: one test per group of copied formulas, see create_document
+    :param samples: additional tests per group, see create_document
+    :param workers: number of processes reading worksheets, see process_template_file
+    :param queue_size: number of sheets that may be read ahead of the renderer
+    :param pool: pool the linked workbooks are loaded into, see process_template_file
+    :return: dict of formula list and named ranges list, as process_template_file returns it
+    """
+    from verification_document import stream_tests
+
+    def write(tests):
+        stream_tests(tests, filename, template_name, template_description, margins, tab_stops)
+
+    with stage('pipeline_document'):
+        return run_pipeline(template_filename, write, group, samples, workers, queue_size, pool)
+
+
+def run_pipeline(template_filename: str, write, group: bool = False, samples: int = 0, workers: int = None,
+                 queue_size: int = QUEUE_SIZE, pool: WorkbookPool = None) -> dict:
+    """
+    Extracts the template and hands its tests to write as each sheet is matched
+    :param template_filename: name of template file
+    :param write: called once with the iterator of tests, tuples (formula, text shown as its location or None),
+                  it must consume the iterator
+    :param group: one test per group of copied formulas, see create_document
+    :param samples: additional tests per group, see create_document
+    :param workers: number of processes reading worksheets, see process_template_file
+    :param queue_size: number of sheets that may be read ahead of write
+    :param pool: pool the linked workbooks are loaded into, see process_template_file
+    :return: dict of formula list and named ranges list, as process_template_file returns it
+    """
+    try:
+        reader = WorkbookReader(template_filename)
+    except PermissionError as e:
+        print(e)
+        exit(1)
+
+    with reader:
+        destinations = _get_name_destinations(reader)
+        targets = _get_name_targets(destinations)
+        sheet_names = reader.sheetnames
+
+        # Named ranges are known from the workbook part, their cells are filled in as their sheets are read
+        name_cells = {s: {} for s in sheet_names}
+        named_ranges = _build_named_ranges(destinations, name_cells)
+        tables = _read_tables(reader)
+        external = ExternalResolver(template_filename, reader.read_external_links(), pool)
+        index = NameIndex(named_ranges, tables=tables, external=external)
+
+        template_data = {'formulas': [], 'names': named_ranges, 'constants': [], 'tables': tables, 'values': {}}
+        sheets = queue.Queue(maxsize=max(1, queue_size))
+        stop = threading.Event()
+        producer = threading.Thread(target=_produce, daemon=True,
+                                    args=(reader, template_filename, sheet_names, targets, sheets, stop,
+                                          workers or os.cpu_count() or 1, max(1, queue_size)))
+        producer.start()
+        try:
+            write(_consume(sheets, sheet_names, named_ranges, name_cells, index, template_data, group, samples))
+        finally:
+            stop.set()
+            producer.join()
+
+        _count_records(template_data['formulas'], named_ranges, template_data['constants'])
+        index.add_usages(template_data['formulas'])
+        for n in named_ranges:
+            n.set_is_used(index)
+
+    return template_data
+
+
+def _produce(reader: WorkbookReader, filename: str, sheet_names: list, targets: dict, sheets: queue.Queue,
+             stop: threading.Event, workers: int, ahead: int):
+    """
+    Producer thread, puts (sheet, records, name cells, cached values) on the queue in sheet order, then _DONE, or the exception
+    that stopped it
+    """
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                sheets.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        size = sum(reader.sheet_size(s) for s in sheet_names)
+        if workers > 1 and len(sheet_names) > 1 and size >= PARALLEL_MIN_BYTES:
+            # Up to ahead sheets are being read or waiting in the pool at any time
+            with ProcessPoolExecutor(max_workers=min(workers, len(sheet_names))) as pool:
+                futures = []
+                for i, s in enumerate(sheet_names):
+                    futures.append(pool.submit(_read_sheet_in_worker, filename, s, targets.get(s, [])))
+                    if len(futures) > ahead:
+                        if not put((sheet_names[i - ahead],) + futures.pop(0).result()):
+                            return
+                for s, future in zip(sheet_names[len(sheet_names) - len(futures):], futures):
+                    if not put((s,) + future.result()):
+                        return
+        else:
+            for s in sheet_names:
+                with stage('read_sheet'):
+                    item = (s,) + _read_sheet_records(reader, s, targets.get(s, []))
+                if not put(item):
+                    return
+        put(_DONE)
+    except BaseException as e:
+        put(e)
+
+
+def _consume(sheets: queue.Queue, sheet_names: list, named_ranges: list, name_cells: dict, index: NameIndex,
+             template_data: dict, group: bool, samples: int):
+    """
+    Takes the sheets off the queue, matches them and yields their tests once every sheet they depend on is read
+    :return: iterator of tuples (formula, text shown as its location or None)
+    """
+    read = set()
+    waiting = []        # sheets read but not rendered yet, in sheet order: (sheet, formulas, sheets needed)
+
+    while True:
+        with stage('wait_for_sheet'):
+            item = sheets.get()
+        if item is _DONE:
+            break
+        if isinstance(item, BaseException):
+            raise item
+
+        sheet_name, records, cells, values = item
+        template_data['values'].update(values)
+        read.add(sheet_name)
+        formulas = [r for r in records if isinstance(r, Formula)]
+        constants = [r for r in records if not isinstance(r, Formula)]
+
+        with stage('match_sheet'):
+            _add_name_cells(named_ranges, sheet_name, name_cells, cells)
+            index.add_records(records)
+            for r in records:
+                r.set_name(index)
+        template_data['formulas'].extend(formulas)
+        template_data['constants'].extend(constants)
+        count('sheets')
+
+        needed = set()
+        for f in formulas:
+            needed |= _sheets_used(f, index, named_ranges)
+        waiting.append((sheet_name, formulas, needed & set(sheet_names)))
+
+        # Sheets are rendered in order, a sheet waiting for a later sheet holds back the ones after it
+        while waiting and waiting[0][2] <= read:
+            _, formulas, _ = waiting.pop(0)
+            yield from _sheet_tests(formulas, index, group, samples)
+
+    for _, formulas, _ in waiting:
+        yield from _sheet_tests(formulas, index, group, samples)
+
+
+def _sheet_tests(formulas: list, index: NameIndex, group: bool, samples: int) -> list:
+    with stage('match_sheet'):
+        for f in formulas:
+            f.update_variables(index)
+    if not group:
+        tests = [(f, None) for f in formulas]
+    else:
+        # Imported here, the records can be exported without python-docx (see formula_export)
+        from verification_document import list_tests
+        tests = list_tests({'formulas': formulas}, 'sheet', group, samples)
+    count('tables', len(tests))
+    return tests
+
+
+def _sheets_used(formula: Formula, index: NameIndex, named_ranges: list) -> set:
+    """
+    Sheets holding the cells a formula's variables are resolved from
+    """
+    if formula.parsed is None:
+        return set()
+
+    used = {ref.sheet or formula.sheet for ref in formula.parsed.references if ref.is_cell() and ref.book is None}
+    for ref in formula.parsed.tables:
+        area = index.tables.resolve(ref, formula.sheet, formula.row, formula.col)
+        if area is not None:
+            used.add(area[0])
+    for name in formula.parsed.names:
+        used.update(named_ranges[i].sheet for i in index.by_name.get(name, ()) if named_ranges[i].sheet)
+    return used
+
+
+def _add_name_cells(named_ranges: list, sheet_name: str, name_cells: dict, cells: dict):
+    """
+    Fills in the contents of the named range cells of a sheet that was just read
+    """
+    name_cells[sheet_name].update(cells)
+    for n in named_ranges:
+        if n.sheet == sheet_name and not n.is_range:
+            cell = cells.get((n.row, n.col))
+            value, cached = (cell.value, cell.cached) if cell else (None, None)
+            n.value, n.output = parse_value(str(value)), str(cached)
@@ -0,0 +1,364 @@
+"""
+Long running verification service
+- Serves verification requests over HTTP on localhost, or over a Unix socket, so the heavy libraries are imported
+  once and the caches stay warm between requests: the styled blank document, the revision cache of every template
+  (see extraction_cache) and the pool of linked workbooks
+- A request names a template, the service writes its verification document and/or its formulas workbook and
+  answers with the files written, the changes since the template was last verified and the time taken
+- Requests are handled one at a time, they share the revision cache and the pool of linked workbooks
+- Only local clients are served: requests must carry a localhost Host header and a JSON content type, which
+  browsers do not send cross-site without asking, and every output is written under the output root
+
+Usage:
+    python src/service.py serve --cache-dir ~/.verification_cache --output-root ~/verification
+    python src/service.py submit Template.xlsx --out-dir results/
+
+    POST /verify  {"template": "...", "out_dir": "...", "outputs": ["docx", "xlsx"], ...}
+    GET  /status
+    POST /shutdown
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+HOST: str = '127.0.0.1'
+PORT: int = 8765
+
+# Longest request body accepted, requests only hold file names and options
+_MAX_BODY: int = 1 << 20
+# Host headers of requests sent to this machine, a web page's requests name its own site
+_LOCAL_HOSTS: tuple = ('localhost', '127.0.0.1', '[::1]')
+# Options of a verify request, see VerificationService.verify
+_OPTIONS: tuple = ('out_dir', 'outputs', 'name', 'description', 'order', 'group', 'samples', 'evaluate')
+
+
+class VerificationService(object):
+    """
+    The state kept warm between requests
+    """
+
+    def __init__(self, cache_dir: str, output_root: str = None):
+        """
+        :param cache_dir: directory of the template revision cache, see process_template_revision
+        :param output_root: directory the outputs must be written under, the current directory by default
+        """
+        # The whole pipeline is imported up front, not by the first request
+        from evaluator import evaluate_template
+        from extraction_cache import process_template_revision
+        from external_links import WorkbookPool
+        from output_files import create_filename, output_formulas_to_excel
+        from verification_document import create_document, stream_document
+
+        self.cache_dir = cache_dir
+        self.output_root = os.path.realpath(output_root or os.getcwd())
+        self.pool = WorkbookPool()
+        self.started = time.time()
+        self.requests = 0
+        self.failures = 0
+        self.__lock = threading.Lock()
+        self.__counts_lock = threading.Lock()    # the counts are updated by every handler thread
+        self.__evaluate = evaluate_template
+        self.__process = process_template_revision
+        self.__create_filename = create_filename
+        self.__to_excel = output_formulas_to_excel
+        self.__stream = stream_document
+
+        # Builds the styled blank document once, every document after the first starts from a copy of it
+        create_document({'formulas': [], 'names': [], 'constants': []}, '', '')
+
+    def verify(self, template: str, out_dir: str = None, outputs: tuple = ('docx', 'xlsx'),
+               name: str = None, description: str = 'Formula verification', order: str = 'sheet',
+               group: bool = False, samples: int = 0, evaluate: bool = True) -> dict:
+        """
+        Verifies a template
+        :param template: name of template file
+        :param out_dir: directory for the outputs, the folder of the template by default, must be under the
+                        output root
+        :param outputs: 'docx' for the verification document, 'xlsx' for the formulas, names and constants
+        :param name: name of the template in the document header and the output file names, its file name by
+                     default, must not contain a directory
+        :param description: description of the template in the document header
+        :param order: 'sheet' or 'dependency', see create_document
+        :param group: one test per group of copied formulas, see create_document
+        :param samples: additional tests per group, see create_document
+        :param evaluate: evaluate the formulas against the values cached in the template
+        :return: dict of the files written, the number of formulas, names and constants, the changes since the
+                 last request for the template and the seconds taken
+        """
+        if not os.path.isfile(template):
+            raise FileNotFoundError(f'No such template: {template}')
+        unknown = set(outputs) - {'docx', 'xlsx'}
+        if unknown:
+            raise ValueError(f"Outputs must be docx or xlsx, not {', '.join(sorted(unknown))}")
+
+        template = os.path.abspath(template)
+        out_dir = os.path.join(os.path.abspath(out_dir or os.path.dirname(template)), '')
+        if os.path.commonpath([self.output_root, os.path.realpath(out_dir)]) != self.output_root:
+            raise PermissionError(f'Outputs must be written under {self.output_root}, not {out_dir}')
+        if name is not None and (os.path.basename(name) != name or name in ('.', '..')):
+            # The name is part of the output file names, a path would write them outside out_dir
+            raise PermissionError(f'The name must not contain a directory: {name}')
+        name = name or os.path.splitext(os.path.basename(template))[0]
+        os.makedirs(out_dir, exist_ok=True)
+
+        with self.__lock:
+            start = time.perf_counter()
+            template_data, changes = self.__process(template, self.cache_dir, self.pool)
+            if evaluate:
+                self.__evaluate(template, template_data)
+
+            files = {}
+            if 'docx' in outputs:
+                files['docx'] = self.__stream(template_data, self.__create_filename(out_dir, name), name,
+                                              description, order=order, group=group, samples=samples)
+            if 'xlsx' in outputs:
+                files['xlsx'] = self.__create_filename(out_dir, f'{name} formulas and names', extension='xlsx')
+                self.__to_excel(files['xlsx'], template_data)
+
+            return {'template': template, 'files': files, 'formulas': len(template_data['formulas']),
+                    'names': len(template_data['names']), 'constants': len(template_data['constants']),
+                    'changes': changes.summary(), 'seconds': round(time.perf_counter() - start, 4)}
+
+    def add_request(self, failed: bool = False):
+        """
+        Counts a request, or a failed one
+        """
+        with self.__counts_lock:
+            if failed:
+                self.failures += 1
+            else:
+                self.requests += 1
+
+    def status(self) -> dict:
+        with self.__counts_lock:
+            requests, failures = self.requests, self.failures
+        return {'uptime': round(time.time() - self.started, 1), 'requests': requests,
+                'failures': failures, 'cache_dir': self.cache_dir, 'output_root': self.output_root,
+                'linked_workbooks': self.pool.stats()}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP, the service is the service attribute of the server
+    """
+
+    def do_GET(self):
+        if not self.__local():
+            return
+        if self.path == '/status':
+            self.__reply(200, self.server.service.status())
+        else:
+            self.__reply(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if not self.__local():
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self.__reply(415, {'error': 'Content-Type must be application/json'})
+            return
+        if self.path == '/shutdown':
+            self.__reply(200, {'stopping': True})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if self.path != '/verify':
+            self.__reply(404, {'error': f'Unknown path {self.path}'})
+            return
+
+        service = self.server.service
+        service.add_request()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > _MAX_BODY:
+                raise ValueError('Request too large')
+            request = json.loads(self.rfile.read(length) or b'{}')
+            template = request.pop('template')
+            unknown = set(request) - set(_OPTIONS)
+            if unknown:
+                raise ValueError(f"unknown options {', '.join(sorted(unknown))}")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            service.add_request(failed=True)
+            self.__reply(400, {'error': f'Bad request: {e}'})
+            return
+
+        try:
+            self.__reply(200, service.verify(template, **request))
+        except PermissionError as e:
+            service.add_request(failed=True)
+            self.__reply(403, {'error': str(e)})
+        except (Exception, SystemExit) as e:
+            # The pipeline reports unreadable files with exit(1), the service keeps running
+            service.add_request(failed=True)
+            self.__reply(500, {'error': f'{type(e).__name__}: {e}'})
+
+    def __local(self) -> bool:
+        """
+        Checks the request was meant for this machine and not sent by a web page, answers 403 when it was not
+        """
+        origin = self.headers.get('Origin')
+        if _host_name(self.headers.get('Host', '')) in _LOCAL_HOSTS and \
+                (origin is None or _host_name(urlsplit(origin).netloc) in _LOCAL_HOSTS):
+            return True
+        self.__reply(403, {'error': 'Only local requests are served'})
+        return False
+
+    def __reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def _host_name(host: str) -> str:
+    """
+    Gets the host name of a Host header or URL location, without the port
+    """
+    host = host.lower()
+    return host[:host.find(']') + 1] if host.startswith('[') else host.split(':')[0]
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        # Other users of the machine must not be able to submit requests
+        os.chmod(self.server_address, 0o600)
+
+
+def serve(cache_dir: str, host: str = HOST, port: int = PORT, unix_socket: str = None, quiet: bool = False,
+          output_root: str = None):
+    """
+    Runs the service until it is shut down (POST /shutdown or Ctrl+C)
+    :param cache_dir: directory of the template revision cache
+    :param host: address to listen on, localhost by default
+    :param port: port to listen on
+    :param unix_socket: path of a Unix socket to listen on instead of host and port
+    :param quiet: do not log every request
+    :param output_root: directory the outputs must be written under, the current directory by default
+    :return: n/a
+    """
+    service = VerificationService(cache_dir, output_root)
+    if unix_socket:
+        server = _UnixHTTPServer(unix_socket, _Handler)
+        where = unix_socket
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+        where = f'http://{host}:{server.server_address[1]}'
+    server.service = service
+    server.quiet = quiet
+
+    print(f'Verification service listening on {where}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+def submit(template: str, host: str = HOST, port: int = PORT, unix_socket: str = None, timeout: float = 900.0,
+           **options) -> dict:
+    """
+    Asks a running service to verify a template
+    :param template: name of template file, relative names are resolved here and not in the service
+    :param host: address of the service
+    :param port: port of the service
+    :param unix_socket: path of the Unix socket of the service, instead of host and port
+    :param timeout: seconds to wait for the answer
+    :param options: out_dir, outputs, name, description, order, group, samples, evaluate, see
+                    VerificationService.verify
+    :return: the answer of the service
+    """
+    if options.get('out_dir'):
+        options['out_dir'] = os.path.abspath(options['out_dir'])
+    return _request('POST', '/verify', dict(options, template=os.path.abspath(template)),
+                    host, port, unix_socket, timeout)
+
+
+def _request(method: str, path: str, body, host: str, port: int, unix_socket: str, timeout: float) -> dict:
+    if unix_socket:
+        connection = _UnixHTTPConnection(unix_socket, timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        answer = json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise RuntimeError(answer.get('error', f'HTTP {response.status}'))
+    return answer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Excel formula verification service')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--socket', help='Unix socket to use instead of host and port')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='run the service')
+    serve_parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.verification_cache'))
+    serve_parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    serve_parser.add_argument('--output-root', help='directory the outputs must be written under, the current '
+                                                    'directory by default')
+
+    submit_parser = commands.add_parser('submit', help='verify a template with a running service')
+    submit_parser.add_argument('template')
+    submit_parser.add_argument('--out-dir')
+    submit_parser.add_argument('--outputs', nargs='+', default=['docx', 'xlsx'], choices=['docx', 'xlsx'])
+    submit_parser.add_argument('--name')
+    submit_parser.add_argument('--description', default='Formula verification')
+    submit_parser.add_argument('--order', default='sheet', choices=['sheet', 'dependency'])
+    submit_parser.add_argument('--group', action='store_true')
+    submit_parser.add_argument('--samples', type=int, default=0)
+
+    commands.add_parser('status', help='show the state of a running service')
+    commands.add_parser('shutdown', help='stop a running service')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.cache_dir, args.host, args.port, args.socket, args.quiet, args.output_root)
+    elif args.command == 'submit':
+        print(json.dumps(submit(args.template, args.host, args.port, args.socket, out_dir=args.out_dir,
+                                outputs=args.outputs, name=args.name, description=args.description,
+                                order=args.order, group=args.group, samples=args.samples), indent=2))
+    else:
+        method, path = ('GET', '/status') if args.command == 'status' else ('POST', '/shutdown')
+        print(json.dumps(_request(method, path, None, args.host, args.port, args.socket, 60.0), indent=2))
@@ -1,11 +1,15 @@
+from copy import copy, deepcopy
+from types import SimpleNamespace
 from docx import Document
 from docx.shared import Inches, RGBColor
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
 from docx.enum.table import WD_CELL_VERTICAL_ALIGNMENT
 from docx.table import Table
+from evaluator import general_format
+from instrumentation import stage
 from utils import add_field, shade_cell
-from variable import Formula
+from variable import Formula, cell_variables
 
 __MINIMUM_ROWS = 7
 __NUM_COLUMNS = 7
@@ -15,6 +19,8 @@ __ROW_HEIGHT = 0.1
 __FILL_COLOR = 'd0cece'
 __CELL_MARGINS = {'top': "50", 'bottom': "10", 'start': "50", 'end': "50"}
 __AUTONUM = r'AUTONUM \s :'  # Document field code
+__RESULT_SLOTS = ('expected', 'output', 'passed')   # Manual, Excel and Pass cells of the last row
+__PASS_TEXT = {True: 'Yes', False: 'No', None: ''}
 
 # TODO: Keep with next, and non-breaking across rows
 
@@ -28,8 +34,19 @@ def add_table(doc: Document, formula: Formula):
     :param formula: Formula to base the document on
     :return: n/a
     """
-    doc.add_paragraph()
+    with stage('add_table'):
+        doc.add_paragraph()
+        _build_table(doc, formula)
 
+
+def _build_table(doc: Document, formula: Formula) -> Table:
+    """
+    Adds the table of a formula to the end of the document, cell by cell
+    :param doc: Document where table will be added
+    :param formula: Formula to base the table on
+    :return: the new table
+    """
+    formula = _with_cells(formula)
     total_rows: int = __MINIMUM_ROWS + len(formula.variables)
     table: Table = doc.add_table(total_rows, __NUM_COLUMNS)
     table.style = __TABLE_STYLE
@@ -40,6 +57,137 @@ def add_table(doc: Document, formula: Formula):
     __create_manual_formula_row(table, formula)
     __create_excel_formula_row(table, formula)
     __create_variable_rows(table, formula, total_rows)
+    return table
+
+
+class TableRenderer(object):
+    """
+    Renders formula tables by cloning a prototype instead of building every table cell by cell.
+    One prototype is built per number of variable rows (with add_table's own code, using placeholder text),
+    each table is a deep copy of it with the placeholder runs filled in.  Runs are filled with the same
+    python-docx text setter add_table uses, so the xml is identical to add_table's.
+    """
+
+    def __init__(self, doc: Document, prototypes: dict = None):
+        """
+        :param doc: Document the tables are for
+        :param prototypes: prototypes to use and add to, may be shared by renderers of documents with the same
+                           styles, each renderer builds its own when None
+        """
+        self.doc = doc
+        # (variable row count, evaluated) -> (table element, [(run index, slot)])
+        self.__prototypes: dict = {} if prototypes is None else prototypes
+
+    def add_table(self, formula: Formula, coordinate: str = None):
+        """
+        Adds the table for a formula to the end of the document, same result as add_table(doc, formula)
+        :param formula: Formula to base the table on
+        :param coordinate: text shown as the location of the formula, defaults to its coordinate
+        :return: n/a
+        """
+        with stage('add_table'):
+            self.doc.add_paragraph()
+            self.doc.element.body._insert_tbl(self.render(formula, coordinate))
+
+    def render(self, formula: Formula, coordinate: str = None):
+        """
+        Creates the table element for a formula without adding it to the document
+        :param formula: Formula to base the table on
+        :param coordinate: text shown as the location of the formula, defaults to its coordinate
+        :return: CT_Tbl element
+        """
+        formula = _with_cells(formula)
+        if any(v is None for v in formula.variables):
+            table = _build_table(self.doc, formula)
+            if coordinate is not None:
+                cell = table.cell(len(table.rows) - 1, 2)
+                cell.text = coordinate
+                cell.paragraphs[0].style = 'Cell Text'
+            table._tbl.getparent().remove(table._tbl)
+            return table._tbl
+
+        tbl, slots = self.__prototype(len(formula.variables), formula.expected is not None)
+        tbl = deepcopy(tbl)
+        runs = list(tbl.iter(qn('w:r')))
+        for i, slot in slots:
+            runs[i].text = coordinate if slot == 'coordinate' and coordinate is not None else _slot_text(formula, slot)
+        return tbl
+
+    def __prototype(self, num_variables: int, evaluated: bool) -> tuple:
+        """
+        Builds (once) the prototype table for formulas with the given number of variables, with or without the
+        evaluator's results
+        """
+        key = (num_variables, evaluated)
+        if key in self.__prototypes:
+            return self.__prototypes[key]
+
+        placeholders = SimpleNamespace(
+            sheet='{sheet}', value='{value}', coordinate='{coordinate}', name='{name}',
+            variables=[SimpleNamespace(coordinate=f'{{var{i}.coordinate}}', name=f'{{var{i}.name}}',
+                                       output=f'{{var{i}.output}}') for i in range(num_variables)],
+            expected='{expected}' if evaluated else None, output='{output}', passed='{passed}')
+
+        tbl = _build_table(self.doc, placeholders)._tbl
+        tbl.getparent().remove(tbl)
+
+        texts = {_slot_text(placeholders, slot): slot for slot in _slots(num_variables, evaluated)}
+        slots = [(i, texts[r.text]) for i, r in enumerate(tbl.iter(qn('w:r'))) if r.text in texts]
+
+        self.__prototypes[key] = (tbl, slots)
+        return tbl, slots
+
+
+def _with_cells(formula):
+    """
+    Gets the formula with its named ranges expanded to one variable row per cell, a copy when it uses any
+    """
+    variables = cell_variables(formula.variables)
+    if variables is formula.variables:
+        return formula
+    formula = copy(formula)
+    formula.variables = variables
+    return formula
+
+
+def _slots(num_variables: int, evaluated: bool) -> list:
+    slots = ['sheet', 'formula', 'coordinate', 'name']
+    for i in range(num_variables):
+        slots.extend([('coordinate', i), ('name', i), ('output', i)])
+    if evaluated:
+        slots.extend(__RESULT_SLOTS)
+    return slots
+
+
+def _slot_text(formula, slot) -> str:
+    """
+    Gets the text add_table writes for one of the formula dependent runs of a table
+    :param formula: Formula the table is for
+    :param slot: which run
+    :return: text of the run
+    """
+    if slot == 'sheet':
+        return f"Sheet: {formula.sheet}"
+    elif slot == 'formula':
+        return f'\n={formula.value}'
+    elif slot == 'coordinate':
+        return formula.coordinate
+    elif slot == 'name':
+        return formula.name
+    elif slot == 'expected':
+        return general_format(formula.expected)
+    elif slot == 'output':
+        return formula.output or ''
+    elif slot == 'passed':
+        return __PASS_TEXT.get(formula.passed, formula.passed)
+
+    field, i = slot
+    var = formula.variables[i]
+    if field == 'coordinate':
+        return var.coordinate or 'N/A'
+    elif field == 'name':
+        return var.name
+    return var.output or ''
 
 
 def __set_column_widths(table: Table):
@@ -226,6 +374,13 @@ def __create_variable_rows(table: Table, formula: Formula, total_rows: int):
     cell.text = formula.name
     cell.paragraphs[0].style = 'Cell Text'
 
+    # Results of the evaluator under Manual/Excel/Pass
+    if formula.expected is not None:
+        for i, slot in enumerate(__RESULT_SLOTS, start=4):
+            cell = table.cell(total_rows - 1, i)
+            cell.text = _slot_text(formula, slot)
+            cell.paragraphs[0].style = 'Cell Text Center'
+
     # TODO: Make separate function for this?
     # Sub header rows
     headers = ['Manual', 'Excel', 'Pass']
@@ -1,64 +1,269 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import openpyxl
 from openpyxl import Workbook, utils
-from variable import Formula, Name, Variable
+from openpyxl.utils.cell import range_boundaries
+from openpyxl.workbook.defined_name import DefinedName
+from external_links import ExternalResolver, WorkbookPool
+from instrumentation import count, stage
+from name_index import NameIndex, RangeIndex
+from variable import ExcelTable, Formula, Name, Variable
+from workbook_reader import MAX_SHEET_CELLS, CellData, WorkbookReader
 
+# Size of a worksheet, whole row/column ranges end here
+_MAX_ROW: int = 1048576
+_MAX_COL: int = 16384
 
-def process_template_file(filename: str) -> dict:
+# Below this much worksheet xml, starting worker processes costs more than reading the sheets in this process
+PARALLEL_MIN_BYTES: int = 4 * 1024 * 1024
+
+
+def process_template_file(filename: str, single_pass: bool = True, workers: int = None,
+                          pool: WorkbookPool = None) -> dict:
     """
     Processes the Excel file aggregating all formulas, named ranges, constants
     matching them together, storing the list of formulas and list of names in a dict
     :param filename: name of template file
+    :param single_pass: read formulas and cached values in one streaming pass, False loads the workbook twice
+                        with openpyxl (slower, kept to cross-check the streaming reader)
+    :param workers: number of processes reading worksheets in parallel (single pass only), defaults to the
+                    number of CPU cores.  Small templates are always read in this process.
+    :param pool: pool the workbooks linked from formulas are loaded into, defaults to the pool shared by every
+                 template processed in this process
+    :return: dict of formula list, named ranges list, constants list and tables list
+    """
+    with stage('process_template_file'):
+        if single_pass:
+            return _read_template_file(filename, workers or os.cpu_count() or 1, pool)
+
+        try:
+            with stage('load_workbook'):
+                wb: Workbook = openpyxl.load_workbook(filename)
+        except PermissionError as e:
+            print(e)
+            exit(1)
+
+        with stage('read_records'):
+            named_ranges: list = _get_named_ranges(wb)
+            formulas, constants = _get_formulas_and_constants(wb)
+        _count_records(formulas, named_ranges, constants)
+
+        variables = {'formulas': formulas, 'names': named_ranges, 'constants': constants, 'tables': _get_tables(wb)}
+
+        _match_output_data(filename, variables, pool)
+
+        wb.close()
+
+        return variables
+
+
+def _read_template_file(filename: str, workers: int = 1, pool: WorkbookPool = None) -> dict:
+    """
+    Single pass version of process_template_file.  Every worksheet is streamed once, the formula and
+    the cached value of each cell are read together so no data_only workbook is needed.
+    With more than one worker the sheets are handed to a process pool, each worker reads its sheet and sends
+    back plain records, which are merged in sheet order and matched here.
+    :param filename: name of template file
+    :param workers: number of processes reading worksheets
+    :param pool: pool the linked workbooks are loaded into
     :return: dict of formula list and named ranges list
     """
     try:
-        wb: Workbook = openpyxl.load_workbook(filename)
+        reader = WorkbookReader(filename)
     except PermissionError as e:
         print(e)
         exit(1)
 
-    named_ranges: list = _get_named_ranges(wb)
-    formulas, constants = _get_formulas_and_constants(wb)
+    with reader:
+        destinations: list = _get_name_destinations(reader)
+
+        # Ranges the names point to, the contents of their cells are picked up while the sheets are streamed
+        targets = _get_name_targets(destinations)
+        tables = _read_tables(reader)
+        external = ExternalResolver(filename, reader.read_external_links(), pool)
+
+        sheet_names = reader.sheetnames
+        size = sum(reader.sheet_size(s) for s in sheet_names)
 
-    variables = {'formulas': formulas, 'names': named_ranges, 'constants': constants}
+        count('sheets', len(sheet_names))
+        count('sheet_bytes', size)
 
-    _match_output_data(filename, variables)
+        with stage('read_sheets'):
+            if workers > 1 and len(sheet_names) > 1 and size >= PARALLEL_MIN_BYTES:
+                count('workers', min(workers, len(sheet_names)))
+                with ProcessPoolExecutor(max_workers=min(workers, len(sheet_names))) as executor:
+                    results = list(executor.map(_read_sheet_in_worker, repeat(filename), sheet_names,
+                                                [targets.get(s, []) for s in sheet_names]))
+            else:
+                results = [_read_sheet_records(reader, s, targets.get(s, [])) for s in sheet_names]
 
-    wb.close()
+    formula_list = []
+    constants_list = []
+    name_cells = {}
+    values = {}
+
+    for sheet_name, (records, cells, sheet_values) in zip(sheet_names, results):
+        for record in records:
+            (formula_list if isinstance(record, Formula) else constants_list).append(record)
+        name_cells[sheet_name] = cells
+        values.update(sheet_values)
+
+    variables = {'formulas': formula_list, 'names': _build_named_ranges(destinations, name_cells),
+                 'constants': constants_list, 'tables': tables, 'values': values}
+    _count_records(formula_list, variables['names'], constants_list)
+
+    _match_items(variables, external)
 
     return variables
 
 
-def _match_output_data(filename, items):
+def _count_records(formulas: list, named_ranges: list, constants: list):
+    count('formulas', len(formulas))
+    count('names', len(named_ranges))
+    count('constants', len(constants))
+
+
+def _read_sheet_records(reader: WorkbookReader, sheet_name: str, targets: list) -> tuple:
+    """
+    Streams one worksheet into records
+    :param reader: reader of the template
+    :param sheet_name: sheet to read
+    :param targets: (row1, col1, row2, col2) of the ranges named ranges point to
+    :return: tuple of the list of records (formulas and constants in sheet order),
+             dict of (row, col) to the CellData of every populated cell inside a target range and
+             dict of (sheet, row, col) to the value Excel cached for every cell that has one (see evaluator)
+    """
+    records = []
+    name_cells = {}
+    values = {}
+    ranges = RangeIndex()
+    for target in targets:
+        ranges.add(sheet_name, *target, target)
+
+    for cell in reader.iter_cells(sheet_name):
+        if targets and ranges.covering(sheet_name, cell.row, cell.col):
+            name_cells[(cell.row, cell.col)] = cell
+
+        if cell.cached is not None:
+            values[(sheet_name, cell.row, cell.col)] = cell.cached
+
+        record = _create_cell_record(sheet_name, cell)
+        if record is not None:
+            records.append(record)
+
+    return records, name_cells, values
+
+
+def _read_sheet_in_worker(filename: str, sheet_name: str, targets: list) -> tuple:
+    """
+    Process pool entry point, opens its own reader so nothing but plain records crosses the process boundary
+    """
+    with WorkbookReader(filename) as reader:
+        return _read_sheet_records(reader, sheet_name, targets)
+
+
+def _build_named_ranges(destinations: list, name_cells: dict) -> list:
+    """
+    Creates the named range records from the name destinations and the contents of the cells they point to
+    :param destinations: destinations from _get_name_destinations
+    :param name_cells: dict of sheet to the dict of (row, col) to the CellData of the populated cells of its
+                       named ranges
+    :return: list of named ranges
+    """
+    named_ranges = []
+    for name, scope, sheet_name, row, col, last_row, last_col, text in destinations:
+        if sheet_name is None:
+            # Global Constants
+            named_ranges.append(Name(name=name, scope=scope, value=text, is_global=True))
+            continue
+
+        cells = name_cells.get(sheet_name, {})
+        if (row, col) != (last_row, last_col):
+            # The cells are only turned into records if the range is expanded
+            named_ranges.append(Name(sheet=sheet_name, name=name, scope=scope, row=row, col=col, last_row=last_row,
+                                     last_col=last_col, value=text, cells=cells))
+            continue
+
+        cell = cells.get((row, col))
+        value, cached = (cell.value, cell.cached) if cell else (None, None)
+        named_ranges.append(
+            Name(sheet=sheet_name, name=name, scope=scope, row=row, col=col, value=str(value), output=str(cached)))
+
+    return named_ranges
+
+
+def _get_name_targets(destinations: list) -> dict:
+    """
+    Collects the ranges the names point to by sheet
+    :param destinations: destinations from _get_name_destinations
+    :return: dict of sheet to the list of (row1, col1, row2, col2) of its named ranges
+    """
+    targets = {}
+    for _, _, sheet_name, row, col, last_row, last_col, _ in destinations:
+        if sheet_name is not None:
+            targets.setdefault(sheet_name, []).append((row, col, last_row, last_col))
+    return targets
+
+
+def _match_output_data(filename, items, pool: WorkbookPool = None):
     """
     Matches the items to the the data values in the Excel file
     :param filename: filename to open as data_only
     :param items: items to match
+    :param pool: pool the linked workbooks are loaded into
     :return: n/a
     """
-    try:
-        wb_data: Workbook = openpyxl.load_workbook(filename, data_only=True)
-    except PermissionError as e:
-        print(e)
-        exit(1)
+    with stage('match_output_data'):
+        try:
+            with stage('load_data_workbook'):
+                wb_data: Workbook = openpyxl.load_workbook(filename, data_only=True)
+        except PermissionError as e:
+            print(e)
+            exit(1)
 
+        with stage('set_output'):
+            for key in ('constants', 'formulas', 'names'):
+                for i in items[key]:
+                    i.set_output(wb_data)
+
+        wb_data.close()
+
+        with WorkbookReader(filename) as reader:
+            external = ExternalResolver(filename, reader.read_external_links(), pool)
+        _match_items(items, external)
+
+
+def _match_items(items, external: ExternalResolver = None):
+    """
+    Names the constants and formulas after the named ranges they sit in, resolves the
+    variables of every formula (structured references through the tables) and flags the named ranges that are
+    used by a formula
+    :param items: items to match
+    :param external: resolver of the references to other workbooks, they are left unresolved when None
+    :return: n/a
+    """
     constants = items['constants']
     formulas = items['formulas']
     named_ranges = items['names']
 
-    for c in constants:
-        c.set_name(named_ranges)
-        c.set_output(wb_data)
+    with stage('match_items'):
+        with stage('index'):
+            index = NameIndex(named_ranges, constants + formulas, items.get('tables', ()), external)
 
-    for f in formulas:
-        f.set_name(named_ranges)
-        f.set_output(wb_data)
-        f.update_variables(named_ranges)
+        with stage('resolve_variables'):
+            for c in constants:
+                c.set_name(index)
 
-    for n in named_ranges:
-        n.set_is_used(formulas)
-        n.set_output(wb_data)
+            for f in formulas:
+                f.set_name(index)
+                f.update_variables(index)
 
-    wb_data.close()
+        with stage('usages'):
+            index.add_usages(formulas)
+
+            for n in named_ranges:
+                n.set_is_used(index)
 
 
 def _get_named_ranges(wb) -> list:
@@ -84,11 +289,14 @@ def _get_named_ranges(wb) -> list:
                 named_range_list.append(
                     Name(sheet=sheet_name, name=name, scope=scope, cell=ws[rng]))
                 break
-            # If the named range contains multiple cells
+            # If the named range contains multiple cells, the cached values are added by set_output
             else:
-                for c in ws[rng]:
-                    named_range_list.append(
-                        Name(sheet=sheet_name, name=name, scope=scope, cell=c[0]))
+                min_col, min_row, max_col, max_row = range_boundaries(rng.replace('$', ''))
+                cells = {(c.row, c.column): CellData(c.row, c.column, c.value, None)
+                         for row in ws[rng] for c in row if c.value is not None}
+                named_range_list.append(
+                    Name(sheet=sheet_name, name=name, scope=scope, row=min_row, col=min_col, last_row=max_row,
+                         last_col=max_col, value=rng, cells=cells))
                 break
         else:
             # Global Constants
@@ -98,6 +306,84 @@ def _get_named_ranges(wb) -> list:
     return named_range_list
 
 
+def _get_tables(wb) -> list:
+    """
+    Aggregates the tables of every worksheet into a list
+    :return: list of ExcelTable, in sheet order
+    """
+    return [ExcelTable(name=t.displayName or t.name, sheet=ws.title, ref=t.ref, header_rows=t.headerRowCount,
+                       totals_rows=t.totalsRowCount or 0, columns=[c.name for c in t.tableColumns])
+            for ws in wb.worksheets for t in ws.tables.values()]
+
+
+def _read_tables(reader: WorkbookReader) -> list:
+    """
+    Streaming version of _get_tables
+    :return: list of ExcelTable, in sheet order
+    """
+    return [ExcelTable(name=t.name, sheet=t.sheet, ref=t.ref, header_rows=t.header_rows, totals_rows=t.totals_rows,
+                       columns=t.columns) for t in reader.read_tables()]
+
+
+def _get_name_destinations(reader: WorkbookReader) -> list:
+    """
+    Lists the ranges every defined name points to without loading the workbook
+    :param reader: streaming reader of the template
+    :return: list of tuples (name, scope, sheet, first row, first column, last row, last column, value), the
+             value is the range for names pointing to cells and the constant for global names
+    """
+    destinations = []
+
+    for dn in reader.defined_names:
+        scope = reader.sheetnames[dn.local_sheet_id] if dn.local_sheet_id is not None else 'Workbook'
+        defined_name = DefinedName(name=dn.name, localSheetId=dn.local_sheet_id, attr_text=dn.attr_text)
+
+        for sheet_name, rng in defined_name.destinations:
+            min_col, min_row, max_col, max_row = range_boundaries(rng.replace('$', ''))
+            # Whole row/column names (A:A, 1:1) span the sheet
+            destinations.append((dn.name, scope, sheet_name, min_row or 1, min_col or 1,
+                                 max_row or _MAX_ROW, max_col or _MAX_COL, rng))
+            break
+        else:
+            # Global Constants
+            destinations.append((dn.name, scope, None, None, None, None, None, dn.attr_text))
+
+    return destinations
+
+
+def _create_record(sheet_name: str, value, **kwargs):
+    """
+    Creates the record for a single cell value
+    Skip the cell if:
+    - It's blank
+    - It's a string and doesn't start with "=" (indicates just text)
+    :param sheet_name: sheet the cell is on
+    :param value: cell value as openpyxl reports it
+    :param kwargs: location information passed on to the record
+    :return: Formula, Variable (constant) or None
+    """
+    if value is None or (isinstance(value, str) and not value.startswith('=')):
+        return None
+
+    # FIXME: remove the '=' thing?
+    # Note: Should I perform the check here? or change the variable class
+    #   - so that all formulas/variables/names? are the same object
+    #   - with different flag types?
+    if isinstance(value, str):
+        return Formula(sheet=sheet_name, value=value[1:], **kwargs)
+    return Variable(sheet=sheet_name, value=value, **kwargs)
+
+
+def _create_cell_record(sheet_name: str, cell: CellData):
+    """
+    Creates the record for a cell streamed by the WorkbookReader, output comes from the cached value
+    :param sheet_name: sheet the cell is on
+    :param cell: streamed cell
+    :return: Formula, Variable (constant) or None
+    """
+    return _create_record(sheet_name, cell.value, row=cell.row, col=cell.col, output=str(cell.cached))
+
+
 def _get_formulas_and_constants(wb) -> tuple:
     """
     Aggregates all formulas and constants in the workbook in a list.
@@ -110,31 +396,31 @@ def _get_formulas_and_constants(wb) -> tuple:
     constants_list = []
 
     for sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-        last_cell = utils.get_column_letter(ws.max_column) + str(ws.max_row)
-        working_range = ws['A1':last_cell]
-
-        for row in working_range:
-            for cell in row:
-                # Skip the formula if:
-                # - It's blank
-                # - It's a string and doesn't start with "=" (indicates just text)
-                if cell.value is None or (isinstance(cell.value, str) and not cell.value.startswith('=')):
-                    continue
-
-                # FIXME: remove the '=' thing?
-                # Note: If i don't check, then I won't know if Variable or Formula
-                # Note: Should I perform the check here? or change the variable class
-                #   - so that all formulas/variables/names? are the same object
-                #   - with different flag types?
-                if isinstance(cell.value, str) and cell.value.startswith('='):
-                    value = cell.value[1:]
-                    formula_list.append(Formula(sheet=sheet_name, cell=cell, value=value))
-                else:
-                    value = cell.value
-                    constants_list.append(Variable(sheet=sheet_name, cell=cell, value=value))
+        for cell in _iter_populated_cells(wb[sheet_name]):
+            record = _create_record(sheet_name, cell.value, cell=cell)
+            if isinstance(record, Formula):
+                formula_list.append(record)
+            elif record is not None:
+                constants_list.append(record)
 
     return formula_list, constants_list
 
 
+def _iter_populated_cells(ws):
+    """
+    Iterates the cells of the worksheet that hold a value in row-major order.  The A1:max_row/max_column
+    rectangle is never built, a single stray format at XFD1048576 would make openpyxl create millions of empty
+    cells for it.  openpyxl keeps the cells it read in a sparse dict keyed by (row, column), only those are visited.
+    :param ws: worksheet to iterate
+    :return: iterator of openpyxl cells
+    """
+    populated = 0
+    for key in sorted(ws._cells):
+        cell = ws._cells[key]
+        if cell.value is None:
+            continue
 
+        populated += 1
+        if populated > MAX_SHEET_CELLS:
+            raise ValueError(f"Sheet {ws.title} has more than {MAX_SHEET_CELLS} populated cells")
+        yield cell
@@ -1,13 +1,12 @@
 from __init__ import add_method
-from datetime import datetime
 from docx.oxml import parse_xml, OxmlElement
 from docx.oxml.ns import nsdecls, qn
 from docx.styles.style import _ParagraphStyle as ParagraphStyle
 from docx.table import _Cell as Cell
 from docx.text.run import Run
 from docx.text.paragraph import Paragraph
-import openpyxl
-import pandas as pd
+# Kept here for the callers that import them from utils, see output_files
+from output_files import create_filename, output_formulas_to_excel  # noqa: F401
 
 
 @add_method(ParagraphStyle)
@@ -89,42 +88,3 @@ def shade_cell(self: Cell, color: str):
     """
     cell_color = parse_xml(f'<w:shd {nsdecls("w")} w:fill="{color}" />')
     self._tc.get_or_add_tcPr().append(cell_color)
-
-
-def create_filename(directory: str, description: str, initials: str = 'ELS', extension: str = 'docx') -> str:
-    """
-    Sets the name of the file based on the current timestamp and directory
-    :param directory: Directory where document will be stored
-    :param description: Description of the document
-    :param initials: Initials of user
-    :param extension: File type extension (should be docx or xlsx)
-    :return: name of the document as string
-    """
-    if extension not in ['docx', 'xlsx']:
-        raise ValueError("Extension must be docx or xlsx")
-    now = datetime.now().strftime
-    return f"{directory}{now('%Y%m%d')}_{initials}_{description}_{now('%H%M%S')}.{extension}"
-
-
-def output_formulas_to_excel(filename, sheet_name, items):
-    """
-    Writes out all items to a sheet in the given excel file
-    :param filename: Excel file to write items to
-    :param sheet_name: name of sheet
-    :param items: list of items to write to the sheet
-    :return: n/a
-    """
-    try:
-        book = openpyxl.load_workbook(filename)
-    except FileNotFoundError:
-        book = openpyxl.Workbook()
-        sheet = book.get_sheet_by_name('Sheet')
-        book.remove_sheet(sheet)
-
-    writer = pd.ExcelWriter(filename, engine='openpyxl')
-    writer.book = book
-
-    df = pd.DataFrame([i.__dict__ for i in items])
-    df.to_excel(writer, sheet_name=sheet_name)
-    writer.save()
-
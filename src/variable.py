@@ -1,7 +1,10 @@
-from dataclasses import dataclass
+from reprlib import recursive_repr
+from sys import intern
 from openpyxl.cell import Cell
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string, get_column_letter, range_boundaries
 from typing import Union
-import re
+from formula_parser import FormulaError, ParsedFormula, parse_formula
+from name_index import NameIndex
 
 
 def parse_value(value: str) -> str:
@@ -11,34 +14,55 @@ def parse_value(value: str) -> str:
         return value
 
 
-# TODO: change these to classes instead of data classes?
-@dataclass
 class Variable(object):
-    name: str = None                    # Defined name or coordinate
-    sheet: str = None                   # Sheet record is located on
-    cell: Union[Cell, None] = None      # Cell record is in, or str for global items
-    coordinate: str = None              # Cell coordinate in A1 format
-    row: int = None                     # Row value as an integer
-    col: int = None                     # Column value as integer
-    value: str = None                   # Formula value of the cell/name
-    output: Union[str, None] = None     # Evaluated value of the cell/name
-
-    def __post_init__(self):
-        if isinstance(self.cell, Cell):
-            self.__get_location_information()
-
-        if self.value:
-            self.value = parse_value(str(self.value))
-        else:
-            self.value = parse_value(str(self.cell.value))
+    """
+    Record of a single cell or name.  Records keep only the location and values of the cell, not the openpyxl
+    cell itself, so the workbook can be closed and freed once the records are extracted and the records are cheap
+    to pickle between processes.  Sheet names and defined names are interned, every record of a sheet shares
+    the same string.
+    """
+    __slots__ = ('name', 'sheet', 'row', 'col', 'value', 'output')
+
+    # Fields in the order they are shown and exported, see to_dict
+    fields: tuple = ('name', 'sheet', 'coordinate', 'row', 'col', 'value', 'output')
+
+    def __init__(self, name: str = None, sheet: str = None, cell: Union[Cell, None] = None, coordinate: str = None,
+                 row: int = None, col: int = None, value=None, output: Union[str, None] = None):
+        """
+        :param name: Defined name or coordinate
+        :param sheet: Sheet record is located on
+        :param cell: openpyxl cell the record is read from, only used to fill in the location and value
+        :param coordinate: Cell coordinate in A1 format, only needed when row and col are not given
+        :param row: Row value as an integer
+        :param col: Column value as integer
+        :param value: Formula value of the cell/name
+        :param output: Evaluated value of the cell/name
+        """
+        if isinstance(cell, Cell):
+            row, col = cell.row, cell.column
+            if value is None:
+                value = cell.value
+        elif row is None and coordinate is not None:
+            column_letter, row = coordinate_from_string(coordinate)
+            col = column_index_from_string(column_letter)
+
+        self.name = intern(name) if isinstance(name, str) else name
+        self.sheet = intern(sheet) if isinstance(sheet, str) else sheet
+        self.row = row
+        self.col = col
+        self.value = parse_value(str(value))
+        self.output = output
 
-    def __get_location_information(self):
-        self.coordinate = self.cell.coordinate
-        self.row = self.cell.row
-        self.col = self.cell.column
+    @property
+    def coordinate(self) -> Union[str, None]:
+        """
+        Cell coordinate in A1 format, None for global items
+        """
+        return f'{get_column_letter(self.col)}{self.row}' if self.row is not None else None
 
-    def set_name(self, named_ranges):
-        self.name = next((n.name for n in named_ranges if n == self), self.coordinate)
+    def set_name(self, index: NameIndex):
+        name = index.name_at(self.sheet, self.row, self.col)
+        self.name = name.name if name else intern(self.coordinate)
 
     def set_output(self, wb):
         if self.row:
@@ -46,72 +70,229 @@ class Variable(object):
         else:
             self.output = None
 
+    def to_dict(self) -> dict:
+        """
+        Gets the fields of the record
+        :return: dict of field name -> value, in the order of fields
+        """
+        return {f: getattr(self, f) for f in self.fields}
+
+    def __key(self) -> tuple:
+        # Global items have no cell, they are told apart by name
+        return (self.sheet, self.row, self.col) if self.row is not None else (None, self.name)
+
     def __eq__(self, other):
         """
         Variables are equivalent if they both occupy the same cell in the sheet
         :param other: comparison variable
         :return: True if equivalent
         """
-        if self.cell and other.cell:
-            return self.cell == other.cell
-        return self.name == other.name
+        if not isinstance(other, Variable):
+            return NotImplemented
+        return self.__key() == other.__key()
+
+    def __hash__(self):
+        return hash(self.__key())
+
+    @recursive_repr()
+    def __repr__(self):
+        fields = ', '.join(f'{f}={v!r}' for f, v in self.to_dict().items())
+        return f'{type(self).__name__}({fields})'
 
 
-@dataclass
 class Name(Variable):
-    scope: str = None
-    is_global: bool = False
-    is_used: bool = None
+    """
+    Named range.  A name over several cells is a single record spanning row/col to last_row/last_col, it is
+    expanded to one record per cell only when its individual values are needed (see expand).
+    """
+    __slots__ = ('scope', 'is_global', 'is_used', 'last_row', 'last_col', 'cells', '__expanded')
+
+    fields: tuple = Variable.fields + ('scope', 'is_global', 'is_used', 'last_row', 'last_col')
+
+    def __init__(self, *args, scope: str = None, is_global: bool = False, is_used: bool = None,
+                 last_row: int = None, last_col: int = None, cells: dict = None, **kwargs):
+        """
+        :param scope: sheet the name is defined for or 'Workbook'
+        :param is_global: True for names holding a constant instead of pointing to cells
+        :param is_used: True if a formula uses the name
+        :param last_row: last row of the range, defaults to row
+        :param last_col: last column of the range, defaults to col
+        :param cells: contents of the populated cells of the range, (row, col) -> object with the value and
+                      cached value of the cell (CellData), may hold other cells of the sheet as well
+        """
+        super(Name, self).__init__(*args, **kwargs)
+        self.scope = scope
+        self.is_global = is_global
+        self.is_used = is_used
+        self.last_row = self.row if last_row is None else last_row
+        self.last_col = self.col if last_col is None else last_col
+        self.cells = cells
+        self.__expanded = None
+
+    @property
+    def is_range(self) -> bool:
+        return self.row is not None and (self.last_row, self.last_col) != (self.row, self.col)
+
+    @property
+    def coordinate(self) -> Union[str, None]:
+        if self.is_range:
+            return f'{get_column_letter(self.col)}{self.row}:{get_column_letter(self.last_col)}{self.last_row}'
+        return super(Name, self).coordinate
+
+    def contains(self, sheet: str, row: int, col: int) -> bool:
+        return (sheet == self.sheet and self.row is not None and self.row <= row <= self.last_row
+                and self.col <= col <= self.last_col)
+
+    def expand(self) -> list:
+        """
+        Gets one named range record per cell of the range, row by row
+        :return: list of single cell named ranges, [self] for a single cell
+        """
+        if not self.is_range:
+            return [self]
+        return [self.cell_at(row, col) for row in range(self.row, self.last_row + 1)
+                for col in range(self.col, self.last_col + 1)]
+
+    def cell_at(self, row: int, col: int):
+        """
+        Gets the single cell named range of a cell of the range.  Created on first use and kept, only the cells
+        asked for are ever created.
+        :param row: row of the cell
+        :param col: column of the cell
+        :return: Name
+        """
+        if not self.is_range:
+            return self
+
+        if self.__expanded is None:
+            self.__expanded = {}
+        record = self.__expanded.get((row, col))
+        if record is None:
+            cell = (self.cells or {}).get((row, col))
+            value, cached = (cell.value, cell.cached) if cell is not None else (None, None)
+            record = self.__expanded[(row, col)] = Name(name=self.name, sheet=self.sheet, row=row, col=col,
+                                                        value=value, output=str(cached), scope=self.scope,
+                                                        is_used=self.is_used)
+        return record
+
+    def set_output(self, wb):
+        if not self.is_range:
+            super(Name, self).set_output(wb)
+            return
 
-    def __post_init__(self):
-        super(Name, self).__post_init__()
+        # Ranges keep the cached values with the contents of their cells
+        ws = wb[self.sheet]
+        for (row, col), cell in list(self.cells.items()):
+            if self.row <= row <= self.last_row and self.col <= col <= self.last_col:
+                self.cells[(row, col)] = cell._replace(cached=ws.cell(row=row, column=col).value)
+        self.__expanded = None
 
-    def set_is_used(self, items):
-        self.is_used = self.name in [v.name for i in items for v in i.variables]
+    def set_is_used(self, index: NameIndex):
+        self.is_used = index.is_used(self.name)
+        for n in (self.__expanded or {}).values():
+            n.is_used = self.is_used
 
 
-@dataclass
 class Formula(Variable):
-    built_ins: list = None
-    formats: list = None
-    has_digits: bool = None
-    in_table: bool = None
-    variables: list = None
+    __slots__ = ('built_ins', 'formats', 'has_digits', 'in_table', 'variables', 'parsed', 'expected', 'passed')
+
+    fields: tuple = Variable.fields + ('built_ins', 'formats', 'has_digits', 'in_table', 'variables', 'expected',
+                                       'passed')
 
-    def __post_init__(self):
+    def __init__(self, *args, **kwargs):
+        super(Formula, self).__init__(*args, **kwargs)
+        self.built_ins: list = None
+        self.formats: list = None
+        self.has_digits: bool = None
+        self.in_table: bool = None
+        self.variables: list = None
+        self.parsed: Union[ParsedFormula, None] = None
+        self.expected = None                # Value recomputed by the evaluator
+        self.passed: bool = None            # True if the recomputed value matches Excel's cached value
         self.__parse_function()
-        super(Formula, self).__post_init__()
 
     def __parse_function(self):
-        self.in_table = True if '[' in self.value else False
-
-        formula_parts = re.split(r'[=*/\-+(),"\s]', self.value)
-
-        # Built in Excel formulas are always in caps
-        self.built_ins = [b for b in formula_parts if b.isupper()]
-
-        for part in formula_parts:
-            if part.isupper() or part in ['', ' ', '&', "'"]:
-                continue
-            elif not self.has_digits and part.isdigit():
-                self.has_digits = True
-            # TODO: If ever have a table formula with TEXT, will need to update this
-            elif '#' in part and 'TEXT' in self.value:
-                if not self.formats:
-                    self.formats = [part]
-                else:
-                    self.formats.append(part)
-            else:
-                # Remaining parts should all be names
-                # (next((n for n in named_ranges if n['name'] == part), None))
-                if not self.variables:
-                    self.variables = [part]
+        try:
+            self.parsed = parse_formula(self.value, self.row or 1, self.col or 1)
+        except FormulaError:
+            # Unreadable formula, it still gets a test but without any variables
+            self.in_table = '[' in self.value
+            self.built_ins = []
+            self.variables = []
+            return
+
+        self.built_ins = list(self.parsed.built_ins)
+        self.formats = list(self.parsed.formats) or None
+        self.has_digits = self.parsed.has_digits
+        self.in_table = bool(self.parsed.tables)
+
+        # Names first, then the cells referenced directly (Sheet2!B3, A1)
+        self.variables = self.parsed.names + [r.a1(self.row, self.col) for r in self.parsed.references]
+
+    def update_variables(self, index: NameIndex):
+        names = self.parsed.names if self.parsed else []
+        cells = []
+        external = []
+        for ref in (self.parsed.references if self.parsed else []):
+            if ref.is_cell():
+                row, col, _, _ = ref.anchor(self.row, self.col)
+                if ref.book is None:
+                    cells.append((ref.sheet or self.sheet, row, col))
                 else:
-                    self.variables.append(part)
+                    external.append((ref.book, ref.sheet, row, col))
 
-    def update_variables(self, vars):
-        self.variables = [v for v in vars if v.name in self.variables]
+        # Structured references to a single cell ([@Col]) are variables like A1 references, ranges are not
+        for ref in (self.parsed.tables if self.parsed else []):
+            area = index.tables.resolve(ref, self.sheet, self.row, self.col)
+            if area is not None and area[1:3] == area[3:5]:
+                cells.append(area[:3])
+
+        self.variables = index.resolve(names, cells, external)
+
+
+class ExcelTable(object):
+    """
+    Definition of an Excel table (ListObject): the range it covers, its header/totals rows and its column names
+    """
+    __slots__ = ('name', 'sheet', 'row', 'col', 'last_row', 'last_col', 'header_rows', 'totals_rows', 'columns')
+
+    fields: tuple = ('name', 'sheet', 'coordinate', 'header_rows', 'totals_rows', 'columns')
+
+    def __init__(self, name: str, sheet: str, ref: str, header_rows: int = 1, totals_rows: int = 0,
+                 columns: list = ()):
+        """
+        :param name: display name of the table
+        :param sheet: sheet the table is on
+        :param ref: range of the table in A1 format, header and totals rows included
+        :param header_rows: 1 if the table has a header row
+        :param totals_rows: 1 if the table has a totals row
+        :param columns: column names, left to right
+        """
+        self.name = intern(name)
+        self.sheet = intern(sheet)
+        self.col, self.row, self.last_col, self.last_row = range_boundaries(ref.replace('$', ''))
+        self.header_rows = header_rows
+        self.totals_rows = totals_rows
+        self.columns = list(columns)
+
+    @property
+    def coordinate(self) -> str:
+        return f'{get_column_letter(self.col)}{self.row}:{get_column_letter(self.last_col)}{self.last_row}'
+
+    def to_dict(self) -> dict:
+        return {f: getattr(self, f) for f in self.fields}
+
+    def __repr__(self):
+        fields = ', '.join(f'{f}={v!r}' for f, v in self.to_dict().items())
+        return f'{type(self).__name__}({fields})'
 
-    def __eq__(self, other):
-        return super(Formula, self).__eq__(other)
 
+def cell_variables(variables: list) -> list:
+    """
+    Gets the variables a test shows, named ranges of several cells are expanded to one variable per cell
+    :param variables: variables of a formula, see Formula.update_variables
+    :return: list of variables, None for those that could not be resolved
+    """
+    if not any(isinstance(v, Name) and v.is_range for v in variables or ()):
+        return variables
+    return [c for v in variables for c in (v.expand() if isinstance(v, Name) else [v])]
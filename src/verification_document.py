@@ -1,25 +1,48 @@
 """
 
 """
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from types import SimpleNamespace
 import docx
 from docx import Document
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT, WD_TAB_ALIGNMENT
 from docx.enum.style import WD_STYLE_TYPE
-from table import add_table
+from lxml import etree
+from dependency_graph import DependencyGraph
+from docx_stream import StreamingDocxWriter
+from formula_groups import group_formulas
+from instrumentation import count, stage
+from table import TableRenderer
 from utils import add_field, add_outline_level, add_bottom_border
+from variable import cell_variables
 
 # Document Field Codes
 __PAGE: str = r'PAGE \* Arabic \* MERGEFORMAT'
 __NUMPAGES: str = r'NUMPAGES \* Arabic \* MERGEFORMAT'
 
+# Tables rendered by a worker process per task, a chunk never spans two sheets
+RENDER_CHUNK: int = 500
+# Below this many tables, starting worker processes costs more than rendering the tables in this process
+PARALLEL_MIN_TABLES: int = 2000
 
-doc = docx.Document()
+# Saved blank documents with the styles already set up, by tab stops.  Loading one is cheaper than creating the
+# styles again for every document a process creates.
+__STYLED_DOCUMENTS: dict = {}
+# Table prototypes by tab stops and margins, see TableRenderer.  The column widths of a new table depend on the
+# page margins, a prototype is only reused by documents with the same ones.
+__PROTOTYPES: dict = {}
 
 
 def create_document(template_data: dict, template_name: str, template_description: str,
                     margins: tuple = (0.5, 0.5, 0.5, 0.5),
-                    tab_stops: tuple = (4.0, 7.5)) -> Document:
+                    tab_stops: tuple = (4.0, 7.5),
+                    order: str = 'sheet',
+                    group: bool = False,
+                    samples: int = 0) -> Document:
     """
     Main function to set up the verification test document
     :param template_data: dict containing lists: formulas, constants, names
@@ -27,27 +50,229 @@ def create_document(template_data: dict, template_name: str, template_descriptio
     :param template_description: Description of the excel template
     :param margins: Document margins
     :param tab_stops: Header/footer tab stops
+    :param order: 'sheet' emits the tests in sheet scan order, 'dependency' emits them so every formula is
+                  tested after the formulas it uses
+    :param group: formulas copied down a column get a single test for the whole range instead of one each
+    :param samples: with group, number of additional members of each group that get their own test
     :return: Verification test document
     """
+    with stage('create_document'):
+        with stage('list_tests'):
+            tests = list_tests(template_data, order, group, samples)
+        count('tables', len(tests))
+        with stage('shell'):
+            doc = __create_shell(template_name, template_description, margins, tab_stops)
 
-    __create_styles(tab_stops)
-    __document_setup(template_name, template_description, margins)
+        # TODO: move this to another function
+        renderer = TableRenderer(doc, __PROTOTYPES.setdefault((tuple(tab_stops), tuple(margins)), {}))
+        for f, coordinate in tests:
+            renderer.add_table(f, coordinate)
+
+        # TODO: Process the constants and names if necessary
+
+        return doc
+
+
+def stream_document(template_data: dict, filename: str, template_name: str, template_description: str,
+                    margins: tuple = (0.5, 0.5, 0.5, 0.5),
+                    tab_stops: tuple = (4.0, 7.5),
+                    order: str = 'sheet',
+                    group: bool = False,
+                    samples: int = 0,
+                    workers: int = 1) -> str:
+    """
+    Writes the verification test document straight to a file, one table at a time, instead of building the
+    whole document in memory.  Produces the same document as create_document(...).save(filename), memory use
+    does not grow with the number of formulas.
+    With more than one worker the tables are rendered by worker processes, a chunk of up to RENDER_CHUNK tests
+    of one sheet each, and written to the file in test order as the chunks come back.  The document is the same
+    whatever the number of workers: the tables are numbered by AUTONUM fields and listed by the TOC field when
+    Word updates them, not when they are rendered.
+    :param template_data: dict containing lists: formulas, constants, names
+    :param filename: name of the .docx file to write
+    :param template_name: Name of the excel template
+    :param template_description: Description of the excel template
+    :param margins: Document margins
+    :param tab_stops: Header/footer tab stops
+    :param order: 'sheet' or 'dependency', see create_document
+    :param group: one test per group of copied formulas, see create_document
+    :param samples: additional tests per group, see create_document
+    :param workers: number of processes rendering the tables, None for one per CPU core.  Documents of fewer
+                    than PARALLEL_MIN_TABLES tests are always rendered in this process.
+    :return: filename
+    """
+    with stage('stream_document'):
+        with stage('list_tests'):
+            tests = list_tests(template_data, order, group, samples)
+        count('tables', len(tests))
+
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(tests) >= PARALLEL_MIN_TABLES:
+            return __render_in_workers(tests, filename, template_name, template_description, margins, tab_stops,
+                                       workers)
+        return stream_tests(tests, filename, template_name, template_description, margins, tab_stops)
+
+
+def stream_tests(tests, filename: str, template_name: str, template_description: str,
+                 margins: tuple = (0.5, 0.5, 0.5, 0.5),
+                 tab_stops: tuple = (4.0, 7.5)) -> str:
+    """
+    Writes a verification test document from tests that may still be being produced, each table is written as
+    soon as its test is taken from tests
+    :param tests: iterable of tuples (formula, text shown as its location or None), see list_tests
+    :param filename: name of the .docx file to write
+    :param template_name: Name of the excel template
+    :param template_description: Description of the excel template
+    :param margins: Document margins
+    :param tab_stops: Header/footer tab stops
+    :return: filename
+    """
+    with stage('shell'):
+        doc = __create_shell(template_name, template_description, margins, tab_stops)
+
+    renderer = TableRenderer(doc, __PROTOTYPES.setdefault((tuple(tab_stops), tuple(margins)), {}))
+    with StreamingDocxWriter(doc, filename) as writer:
+        for f, coordinate in tests:
+            with stage('add_table'):
+                writer.add_paragraph()
+                writer.add_element(renderer.render(f, coordinate))
+
+    return filename
+
+
+def __render_in_workers(tests: list, filename: str, template_name: str, template_description: str,
+                        margins: tuple, tab_stops: tuple, workers: int) -> str:
+    """
+    Writes the verification test document with the tables rendered by worker processes, see stream_document
+    """
+    with stage('shell'):
+        doc = __create_shell(template_name, template_description, margins, tab_stops)
+
+    chunks = __chunks(tests)
+    count('workers', min(workers, len(chunks)))
+    with stage('render_in_workers'), StreamingDocxWriter(doc, filename) as writer, \
+            ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        for tables in executor.map(_render_chunk, chunks, repeat(tuple(tab_stops)), repeat(tuple(margins))):
+            for xml in tables:
+                writer.add_paragraph()
+                writer.add_xml(xml)
+
+    return filename
+
+
+def __chunks(tests: list) -> list:
+    """
+    Splits the tests into the tasks of the worker processes, only what the tables show is sent to the workers
+    :param tests: list of tuples (formula, text shown as its location or None), see list_tests
+    :return: list of lists of tuples (table data, text shown as its location or None)
+    """
+    chunks = []
+    sheet = None
+    for f, coordinate in tests:
+        if f.sheet != sheet or len(chunks[-1]) >= RENDER_CHUNK:
+            chunks.append([])
+            sheet = f.sheet
+        chunks[-1].append((__table_data(f), coordinate))
+    return chunks
+
+
+def __table_data(formula) -> SimpleNamespace:
+    """
+    Copies the attributes of a formula a table shows, the formula itself holds its parsed form and the named
+    ranges it uses with all their cells
+    """
+    variables = [None if v is None else SimpleNamespace(coordinate=v.coordinate, name=v.name, output=v.output)
+                 for v in cell_variables(formula.variables)]
+    return SimpleNamespace(sheet=formula.sheet, value=formula.value, coordinate=formula.coordinate,
+                           name=formula.name, variables=variables, expected=formula.expected,
+                           output=formula.output, passed=formula.passed)
+
+
+def _render_chunk(tests: list, tab_stops: tuple, margins: tuple) -> list:
+    """
+    Renders the tables of a chunk of tests inside a worker process
+    :param tests: list of tuples (table data, text shown as its location or None), see __chunks
+    :param tab_stops: Header/footer tab stops, the tables are rendered for the styles of the document
+    :param margins: Document margins, the column widths of the tables depend on them
+    :return: list of the serialized table elements, see StreamingDocxWriter.add_xml
+    """
+    doc = __styled_document(tab_stops)
+    __set_margins(doc, margins)
+    renderer = TableRenderer(doc, __PROTOTYPES.setdefault((tuple(tab_stops), tuple(margins)), {}))
+    return [etree.tostring(renderer.render(f, coordinate)) for f, coordinate in tests]
+
+
+def __create_shell(template_name: str, template_description: str, margins: tuple, tab_stops: tuple) -> Document:
+    """
+    Creates a document with the styles, header, footer and table of contents, everything but the tests
+    :param template_name: Name of the excel template
+    :param template_description: Description of the excel template
+    :param margins: Document margins
+    :param tab_stops: Header/footer tab stops
+    :return: new document
+    """
+    doc = __styled_document(tab_stops)
+    __document_setup(doc, template_name, template_description, margins)
 
     # TODO: move this to another function
     p = doc.add_paragraph('Table of Contents')
     p.add_bottom_border()
     doc.add_paragraph().add_run().add_field(r'TOC \o "1-3" \h \z \u')
+    return doc
 
-    # TODO: move this to another function
-    for f in template_data['formulas']:
-        add_table(doc, f)
-
-    # TODO: Process the constants and names if necessary
 
+def __styled_document(tab_stops: tuple) -> Document:
+    """
+    Creates a blank document with the styles set up
+    :param tab_stops: Header/footer tab stops
+    :return: new document
+    """
+    styled = __STYLED_DOCUMENTS.get(tuple(tab_stops))
+    if styled is not None:
+        return docx.Document(io.BytesIO(styled))
+
+    doc = docx.Document()
+    __create_styles(doc, tab_stops)
+    saved = io.BytesIO()
+    doc.save(saved)
+    __STYLED_DOCUMENTS[tuple(tab_stops)] = saved.getvalue()
     return doc
 
 
-def __create_styles(tab_stops: tuple):
+def list_tests(template_data: dict, order: str, group: bool, samples: int) -> list:
+    """
+    Lists the formulas that get a test, in the order the tests are emitted
+    :param template_data: dict containing lists: formulas, constants, names
+    :param order: 'sheet' or 'dependency'
+    :param group: one test per group of copied formulas
+    :param samples: additional tests per group
+    :return: list of tuples (formula, text shown as its location or None for its coordinate)
+    """
+    if order not in ['sheet', 'dependency']:
+        raise ValueError("Order must be sheet or dependency")
+
+    formulas = template_data['formulas']
+    if order == 'dependency':
+        formulas = DependencyGraph(template_data).ordered(formulas)
+
+    if not group:
+        return [(f, None) for f in formulas]
+
+    # Groups follow the position of their representative in the chosen order
+    position = {id(f): i for i, f in enumerate(formulas)}
+    groups = sorted(group_formulas(template_data['formulas']), key=lambda g: position[id(g.representative)])
+
+    tests = []
+    for g in groups:
+        if len(g) == 1:
+            tests.append((g.representative, None))
+            continue
+        tests.append((g.representative, f'{g.coordinate} ({len(g)} rows)'))
+        tests.extend((f, None) for f in g.samples(samples))
+    return tests
+
+
+def __create_styles(doc: Document, tab_stops: tuple):
     """
     Sets up all the styles for the document
     Cell Text: For plain text within cells
@@ -64,7 +289,9 @@ def __create_styles(tab_stops: tuple):
     Cell Header Right/Center: Both are for header cells with different alignments
     - Based on Header Text
     - Alignment Center or Right
-    :return: Updated document
+    :param doc: Document to add the styles to
+    :param tab_stops: Header/footer tab stops
+    :return: n/a
     """
 
     # TODO: Refactor this part into enum? separate module?
@@ -109,18 +336,15 @@ def __create_styles(tab_stops: tuple):
     style.add_outline_level(1)
 
 
-def __document_setup(template_name: str, template_desc: str, margins: tuple):
+def __document_setup(doc: Document, template_name: str, template_desc: str, margins: tuple):
     """
     Sets up the initial format of the overall document
+    :param doc: Document to set up
     :param template_name: Name of template document is based on
     :param template_desc: Description of template
     :param margins: margins for the document
     """
-    # Margins
-    doc.sections[0].left_margin = Inches(margins[0])
-    doc.sections[0].right_margin = Inches(margins[1])
-    doc.sections[0].top_margin = Inches(margins[2])
-    doc.sections[0].bottom_margin = Inches(margins[3])
+    __set_margins(doc, margins)
 
     # Headers
     doc.sections[0].header_distance = Inches(0.25)
@@ -138,5 +362,13 @@ def __document_setup(template_name: str, template_desc: str, margins: tuple):
     footer_p.style = doc.styles['Header Footer Custom']
 
 
-
-
+def __set_margins(doc: Document, margins: tuple):
+    """
+    Sets the page margins of the document
+    :param doc: Document to set up
+    :param margins: left, right, top and bottom margins in inches
+    """
+    doc.sections[0].left_margin = Inches(margins[0])
+    doc.sections[0].right_margin = Inches(margins[1])
+    doc.sections[0].top_margin = Inches(margins[2])
+    doc.sections[0].bottom_margin = Inches(margins[3])
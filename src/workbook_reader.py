@@ -0,0 +1,385 @@
+"""
+Streaming reader for Excel (xlsx) templates
+- Reads each worksheet's xml exactly once, straight out of the zip archive
+- Yields the formula text (<f>) and the cached value (<v>) of every populated cell in the same pass
+- Cell values are typed the same way openpyxl types them so the records built from either reader match
+"""
+import posixpath
+import zipfile
+from typing import Iterator, NamedTuple
+from xml.etree.ElementTree import iterparse
+from openpyxl.formula.translate import Translator
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+
+__SHEET_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+__RELATIONSHIPS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+__PACKAGE_RELS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+_CELL = f'{{{__SHEET_MAIN}}}c'
+_SHEET_DATA = f'{{{__SHEET_MAIN}}}sheetData'
+_ROW = f'{{{__SHEET_MAIN}}}row'
+_FORMULA = f'{{{__SHEET_MAIN}}}f'
+_VALUE = f'{{{__SHEET_MAIN}}}v'
+_INLINE_STRING = f'{{{__SHEET_MAIN}}}is'
+_TEXT = f'{{{__SHEET_MAIN}}}t'
+_RICH_RUN = f'{{{__SHEET_MAIN}}}r'
+_SHARED_STRING = f'{{{__SHEET_MAIN}}}si'
+_SHEET = f'{{{__SHEET_MAIN}}}sheet'
+_DEFINED_NAME = f'{{{__SHEET_MAIN}}}definedName'
+_WORKBOOK_PR = f'{{{__SHEET_MAIN}}}workbookPr'
+_NUM_FMT = f'{{{__SHEET_MAIN}}}numFmt'
+_CELL_XFS = f'{{{__SHEET_MAIN}}}cellXfs'
+_XF = f'{{{__SHEET_MAIN}}}xf'
+_EXTERNAL_REFERENCE = f'{{{__SHEET_MAIN}}}externalReference'
+_TABLE = f'{{{__SHEET_MAIN}}}table'
+_TABLE_COLUMN = f'{{{__SHEET_MAIN}}}tableColumn'
+_REL_ID = f'{{{__RELATIONSHIPS}}}id'
+_TABLE_REL_TYPE = f'{__RELATIONSHIPS}/table'
+_RELATIONSHIP = f'{{{__PACKAGE_RELS}}}Relationship'
+
+# Hard limit on the populated cells read from one sheet.  Past this the sheet is padded out or corrupt rather
+# than a real template, stop instead of grinding through it.
+MAX_SHEET_CELLS: int = 2_000_000
+
+
+class CellData(NamedTuple):
+    row: int            # Row value as an integer
+    col: int            # Column value as an integer
+    value: object       # Value as openpyxl reports it: '=...' for formulas, typed value otherwise
+    cached: object      # Value Excel last calculated for the cell (what data_only=True reports)
+
+    @property
+    def coordinate(self) -> str:
+        return f'{get_column_letter(self.col)}{self.row}'
+
+
+class DefinedNameData(NamedTuple):
+    name: str
+    local_sheet_id: int         # Index of the sheet the name is scoped to, None for workbook scope
+    attr_text: str              # Destination(s) or constant value of the name
+
+
+class TableData(NamedTuple):
+    name: str                   # Display name, the name formulas use (Table1[Col])
+    sheet: str                  # Sheet the table is on
+    ref: str                    # Range of the table in A1 format, header and totals rows included
+    header_rows: int            # 1 if the table has a header row, 0 if not
+    totals_rows: int            # 1 if the table has a totals row, 0 if not
+    columns: tuple              # Column names, left to right
+
+
+class WorkbookReader(object):
+    """
+    Reads an xlsx file without building an openpyxl Workbook.  Only the workbook part, the shared strings and the
+    styles are held in memory, worksheets are streamed cell by cell.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.archive = zipfile.ZipFile(filename)
+        self.sheetnames: list = []
+        self.defined_names: list = []
+        self.epoch = CALENDAR_WINDOWS_1900
+
+        self.__sheet_paths: dict = {}
+        self.__external_paths: list = []
+        self.__read_workbook()
+        self.shared_strings: list = self.__read_shared_strings()
+        self.date_styles: set = self.__read_date_styles()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.archive.close()
+
+    def sheet_size(self, sheet_name: str) -> int:
+        """
+        Gets the uncompressed size of a worksheet's xml
+        :param sheet_name: name of the sheet
+        :return: size in bytes
+        """
+        return self.archive.getinfo(self.__sheet_paths[sheet_name]).file_size
+
+    def sheet_signature(self, sheet_name: str) -> tuple:
+        """
+        Identifies the contents of a worksheet without reading it: the zip CRC and size of the sheet's xml and
+        of the parts its values depend on (shared strings and styles)
+        :param sheet_name: name of the sheet
+        :return: tuple that only changes when the sheet's cells may have changed
+        """
+        signature = []
+        for part in (self.__sheet_paths[sheet_name], 'xl/sharedStrings.xml', 'xl/styles.xml'):
+            try:
+                info = self.archive.getinfo(part)
+                signature.append((part, info.CRC, info.file_size))
+            except KeyError:
+                signature.append((part, None, None))
+        return tuple(signature)
+
+    def read_tables(self) -> list:
+        """
+        Reads the definitions of the tables (ListObjects) of every worksheet
+        :return: list of TableData, in sheet order
+        """
+        tables = []
+        for sheet_name in self.sheetnames:
+            for part in self.__read_relationships(self.__sheet_paths[sheet_name], _TABLE_REL_TYPE).values():
+                columns = []
+                table = None
+                for _, element in iterparse(self.archive.open(part)):
+                    if element.tag == _TABLE_COLUMN:
+                        columns.append(element.get('name'))
+                    elif element.tag == _TABLE:
+                        table = element
+                tables.append(TableData(name=table.get('displayName') or table.get('name'), sheet=sheet_name,
+                                        ref=table.get('ref'), header_rows=int(table.get('headerRowCount', 1)),
+                                        totals_rows=int(table.get('totalsRowCount', 0)), columns=tuple(columns)))
+        return tables
+
+    def read_external_links(self) -> dict:
+        """
+        Reads the workbooks the template links to.  Formulas refer to them by number: [1]Sheet1!A1 is a cell of
+        the first linked workbook.
+        :return: dict of link number (as written in formulas, '1') to the linked file as recorded by Excel,
+                 relative to the template or absolute (file:///...)
+        """
+        links = {}
+        for i, part in enumerate(self.__external_paths, 1):
+            targets = list(self.__read_relationships(part).values()) if part else []
+            if targets:
+                links[str(i)] = targets[0]
+        return links
+
+    def __read_workbook(self):
+        """
+        Reads the sheet names (in workbook order), their part names and the defined names
+        :return: n/a
+        """
+        rels = self.__read_relationships('xl/workbook.xml')
+
+        for _, element in iterparse(self.archive.open('xl/workbook.xml')):
+            if element.tag == _SHEET:
+                self.sheetnames.append(element.get('name'))
+                self.__sheet_paths[element.get('name')] = rels[element.get(_REL_ID)]
+            elif element.tag == _DEFINED_NAME:
+                local_sheet_id = element.get('localSheetId')
+                self.defined_names.append(DefinedNameData(
+                    name=element.get('name'),
+                    local_sheet_id=int(local_sheet_id) if local_sheet_id is not None else None,
+                    attr_text=element.text or ''))
+            elif element.tag == _WORKBOOK_PR and element.get('date1904') in ('1', 'true'):
+                self.epoch = CALENDAR_MAC_1904
+            elif element.tag == _EXTERNAL_REFERENCE:
+                self.__external_paths.append(rels.get(element.get(_REL_ID)))
+
+    def __read_relationships(self, part: str, rel_type: str = None) -> dict:
+        """
+        Maps the relationship ids of a part to the full part names they target, external targets are kept as written
+        :param part: name of the part whose relationships are read
+        :param rel_type: only keep the relationships of this type, all of them when None
+        :return: dict of relationship id to part name
+        """
+        folder, name = posixpath.split(part)
+        rels_part = posixpath.join(folder, '_rels', f'{name}.rels')
+        if rels_part not in self.archive.namelist():
+            return {}
+
+        rels = {}
+        for _, element in iterparse(self.archive.open(rels_part)):
+            if element.tag == _RELATIONSHIP and rel_type in (None, element.get('Type')):
+                target = element.get('Target')
+                if element.get('TargetMode') == 'External':
+                    rels[element.get('Id')] = target
+                    continue
+                if target.startswith('/'):
+                    target = target[1:]
+                else:
+                    target = posixpath.normpath(posixpath.join(folder, target))
+                rels[element.get('Id')] = target
+        return rels
+
+    def __read_shared_strings(self) -> list:
+        """
+        Reads the shared string table, rich text runs are joined into plain text
+        :return: list of strings
+        """
+        if 'xl/sharedStrings.xml' not in self.archive.namelist():
+            return []
+
+        strings = []
+        for _, element in iterparse(self.archive.open('xl/sharedStrings.xml')):
+            if element.tag == _SHARED_STRING:
+                strings.append(_inline_text(element))
+                element.clear()
+        return strings
+
+    def __read_date_styles(self) -> set:
+        """
+        Finds the cell style indices whose number format is a date, openpyxl converts those values to datetimes
+        :return: set of style indices
+        """
+        if 'xl/styles.xml' not in self.archive.namelist():
+            return set()
+
+        custom_formats = {}
+        style_formats = []
+        in_cell_xfs = False
+        for event, element in iterparse(self.archive.open('xl/styles.xml'), events=('start', 'end')):
+            if element.tag == _CELL_XFS:
+                in_cell_xfs = event == 'start'
+            elif event == 'end' and element.tag == _NUM_FMT:
+                custom_formats[int(element.get('numFmtId'))] = element.get('formatCode')
+            elif event == 'end' and element.tag == _XF and in_cell_xfs:
+                style_formats.append(int(element.get('numFmtId', 0)))
+
+        date_styles = set()
+        for i, fmt_id in enumerate(style_formats):
+            fmt = custom_formats.get(fmt_id, BUILTIN_FORMATS.get(fmt_id))
+            if fmt is not None and is_date_format(fmt):
+                date_styles.add(i)
+        return date_styles
+
+    def iter_cells(self, sheet_name: str) -> Iterator[CellData]:
+        """
+        Streams the populated cells of a worksheet in row-major order.  Cells that only carry formatting are
+        skipped, shared formulas are expanded to the formula each cell would have on its own.  The recorded
+        <dimension> of the sheet is never used, so an inflated used range costs nothing.
+        :param sheet_name: name of the sheet to read
+        :return: iterator of CellData
+        """
+        shared_formulas = {}
+        count = 0
+        row_idx = 0
+        col_idx = 0
+        sheet_data = None
+
+        for event, element in iterparse(self.archive.open(self.__sheet_paths[sheet_name]), events=('start', 'end')):
+            if event == 'start':
+                if element.tag == _ROW:
+                    row_idx = int(element.get('r', row_idx + 1))
+                    col_idx = 0
+                elif element.tag == _SHEET_DATA:
+                    sheet_data = element
+                continue
+
+            # Finished rows are dropped so memory stays flat however long the sheet is
+            if element.tag == _ROW:
+                sheet_data.clear()
+                continue
+            elif element.tag != _CELL:
+                continue
+
+            coordinate = element.get('r')
+            if coordinate:
+                row_idx, col_idx = _split_coordinate(coordinate)
+            else:
+                col_idx += 1
+
+            cell = self.__parse_cell(element, row_idx, col_idx, shared_formulas)
+            if cell is not None:
+                count += 1
+                if count > MAX_SHEET_CELLS:
+                    raise ValueError(f"Sheet {sheet_name} has more than {MAX_SHEET_CELLS} populated cells")
+                yield cell
+
+    def __parse_cell(self, element, row: int, col: int, shared_formulas: dict):
+        """
+        Types the value of a single <c> element
+        :param element: cell element
+        :param row: row of the cell
+        :param col: column of the cell
+        :param shared_formulas: master formulas of the sheet keyed by shared index
+        :return: CellData or None if the cell is blank
+        """
+        data_type = element.get('t', 'n')
+        formula = element.find(_FORMULA)
+        value_element = element.find(_VALUE)
+        value = value_element.text if value_element is not None else None
+
+        if value is not None:
+            if data_type == 'n':
+                value = _cast_number(value)
+                if int(element.get('s', 0)) in self.date_styles:
+                    value = from_excel(value, self.epoch)
+            elif data_type == 's':
+                value = self.shared_strings[int(value)]
+            elif data_type == 'b':
+                value = bool(int(value))
+        elif data_type == 'inlineStr':
+            inline = element.find(_INLINE_STRING)
+            if inline is not None:
+                value = _inline_text(inline)
+
+        cached = value
+        if formula is not None:
+            value = _formula_text(formula, row, col, shared_formulas)
+
+        if value is None and cached is None:
+            return None
+        return CellData(row=row, col=col, value=value, cached=cached)
+
+
+def _formula_text(formula, row: int, col: int, shared_formulas: dict) -> str:
+    """
+    Gets the formula of a cell in openpyxl form ('=' prefixed), translating dependents of shared formulas
+    :param formula: <f> element of the cell
+    :param row: row of the cell
+    :param col: column of the cell
+    :param shared_formulas: master formulas of the sheet keyed by shared index
+    :return: formula text
+    """
+    text = formula.text or ''
+    if formula.get('t') == 'shared':
+        index = formula.get('si')
+        if text:
+            shared_formulas[index] = (f'={text}', f'{get_column_letter(col)}{row}')
+        elif index in shared_formulas:
+            master, origin = shared_formulas[index]
+            return Translator(master, origin).translate_formula(f'{get_column_letter(col)}{row}')
+    return f'={text}'
+
+
+def _inline_text(element) -> str:
+    """
+    Joins the text of a string item, skipping phonetic runs like openpyxl does
+    :param element: <si> or <is> element
+    :return: plain text
+    """
+    parts = []
+    for child in element:
+        if child.tag == _TEXT:
+            parts.append(child.text or '')
+        elif child.tag == _RICH_RUN:
+            t = child.find(_TEXT)
+            if t is not None:
+                parts.append(t.text or '')
+    return ''.join(parts)
+
+
+def _cast_number(value: str):
+    """
+    Converts a numeric cell value to int or float the same way openpyxl does
+    :param value: text of the <v> element
+    :return: int or float
+    """
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+def _split_coordinate(coordinate: str) -> tuple:
+    """
+    Splits an A1 style coordinate into its row and column indices
+    :param coordinate: coordinate such as 'AB12'
+    :return: tuple of row, column
+    """
+    for i, char in enumerate(coordinate):
+        if char.isdigit():
+            return int(coordinate[i:]), column_index_from_string(coordinate[:i])
+    raise ValueError(f'Invalid cell coordinate {coordinate}')
@@ -0,0 +1,164 @@
+"""
+Benchmark suite for the verification pipeline
+- Generates synthetic templates at several sizes and times every stage separately: process_template_file,
+  _match_output_data, create_document, add_table (prototype renderer and cell by cell), Document.save and
+  output_formulas_to_excel
+- Peak memory of each stage is measured in a second run under tracemalloc, so the timings are not slowed by it
+- Results are written as JSON, two result files can be compared stage by stage
+
+Usage:
+    python tests/benchmark.py --sizes small medium --out results.json
+    python tests/benchmark.py --compare before.json after.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# src goes first, its __init__ module would otherwise be shadowed by the one of this package
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+
+SIZES = {
+    'small': TemplateSpec(sheets=2, formulas=500, names=20),
+    'medium': TemplateSpec(sheets=4, formulas=5000, names=200, fill_down=False),
+    'large': TemplateSpec(sheets=8, formulas=20000, names=1000, name_size=10),
+    'sparse': TemplateSpec(sheets=2, formulas=5000, names=200, sparse=50, inflated=True),
+}
+
+# add_table is timed on its own for at most this many formulas, the cell by cell build is much slower
+ADD_TABLE_FORMULAS: int = 200
+BUILD_TABLE_FORMULAS: int = 20
+
+
+def run_benchmarks(sizes: list, memory: bool = True, work_dir: str = None) -> dict:
+    """
+    Runs every stage on a synthetic template of each size
+    :param sizes: keys of SIZES
+    :param memory: also measure the peak memory of each stage
+    :param work_dir: directory for the generated files, a temporary directory when None
+    :return: results, ready to be written as JSON
+    """
+    results = {'started': datetime.now().isoformat(timespec='seconds'), 'commit': _commit(),
+               'python': platform.python_version(), 'platform': platform.platform(), 'sizes': {}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = work_dir or tmp
+        for size in sizes:
+            filename = os.path.join(work_dir, f'benchmark_{size}.xlsx')
+            generate_template(filename, SIZES[size])
+            results['sizes'][size] = {'spec': SIZES[size].to_dict(), 'file_bytes': os.path.getsize(filename),
+                                      'stages': _run_stages(filename, work_dir, memory)}
+    return results
+
+
+def _run_stages(filename: str, work_dir: str, memory: bool) -> dict:
+    from template_file import process_template_file, _match_output_data
+    from verification_document import create_document
+    from table import add_table, TableRenderer
+    from output_files import output_formulas_to_excel
+
+    empty = {'formulas': [], 'names': [], 'constants': []}
+    state = {}
+
+    def extract():
+        state['data'] = process_template_file(filename, workers=1)
+
+    def match():
+        _match_output_data(filename, state['data'])
+
+    def document():
+        state['doc'] = create_document(state['data'], 'Benchmark', 'Synthetic template')
+
+    def tables():
+        renderer = TableRenderer(create_document(empty, 'Benchmark', 'Synthetic template'))
+        for f in state['data']['formulas'][:ADD_TABLE_FORMULAS]:
+            renderer.add_table(f)
+
+    def build_tables():
+        doc = create_document(empty, 'Benchmark', 'Synthetic template')
+        for f in state['data']['formulas'][:BUILD_TABLE_FORMULAS]:
+            add_table(doc, f)
+
+    def save():
+        state['doc'].save(io.BytesIO())
+
+    def export():
+        output_formulas_to_excel(os.path.join(work_dir, 'benchmark_export.xlsx'), state['data'])
+
+    stages = {}
+    for name, stage in (('process_template_file', extract), ('_match_output_data', match),
+                        ('create_document', document), ('add_table', tables), ('add_table (cell by cell)', build_tables),
+                        ('Document.save', save),
+                        ('output_formulas_to_excel', export)):
+        start = time.perf_counter()
+        stage()
+        stages[name] = {'seconds': round(time.perf_counter() - start, 4)}
+
+        if memory:
+            tracemalloc.start()
+            stage()
+            stages[name]['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+            tracemalloc.stop()
+
+    stages['add_table']['tables'] = min(ADD_TABLE_FORMULAS, len(state['data']['formulas']))
+    stages['add_table (cell by cell)']['tables'] = min(BUILD_TABLE_FORMULAS, len(state['data']['formulas']))
+    stages['process_template_file']['formulas'] = len(state['data']['formulas'])
+    stages['process_template_file']['names'] = len(state['data']['names'])
+    return stages
+
+
+def compare(before: dict, after: dict) -> list:
+    """
+    Lines comparing two result files, the ratio is after / before (below 1 is faster or smaller)
+    """
+    lines = [f"{before.get('commit')} -> {after.get('commit')}"]
+    for size, result in after['sizes'].items():
+        old = before['sizes'].get(size)
+        if old is None:
+            continue
+        for stage, values in result['stages'].items():
+            for key in ('seconds', 'peak_mb'):
+                if key in values and key in old['stages'].get(stage, {}):
+                    was, now = old['stages'][stage][key], values[key]
+                    ratio = now / was if was else float('inf')
+                    lines.append(f'{size:>8} {stage:<26} {key:<8} {was:>10} {now:>10} {ratio:6.2f}x')
+    return lines
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the verification pipeline on synthetic templates')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=sorted(SIZES))
+    parser.add_argument('--out', help='JSON file for the results, printed when omitted')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_before, open(args.compare[1]) as f_after:
+            print('\n'.join(compare(json.load(f_before), json.load(f_after))))
+        sys.exit(0)
+
+    output = run_benchmarks(args.sizes, memory=not args.no_memory)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
@@ -0,0 +1,211 @@
+"""
+Synthetic Excel templates for benchmarking the verification pipeline
+- Writes the xlsx parts directly so formulas come with cached values (as if Excel had saved the file) and large
+  templates are generated in seconds
+- Configurable number of sheets, formulas, named ranges and their size, copied-down vs mixed formulas, sparse
+  layouts and inflated sheet dimensions
+"""
+import math
+import random
+import zipfile
+from dataclasses import dataclass, asdict
+from xml.sax.saxutils import escape
+
+_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PACKAGE_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_CONTENT_TYPES = 'http://schemas.openxmlformats.org/package/2006/content-types'
+_SHEET_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+
+# Formula patterns, {a} is the input cell of the row, {n} a named range (or SUM over it), {p} the input cell of
+# the same row on the previous sheet
+_PATTERNS = ('{a}*2+{n}', 'IF({a}>50,{a},0)', 'ROUND({a}/3,2)', 'MAX({a},{n})', '{p}+{a}')
+
+
+@dataclass
+class TemplateSpec:
+    sheets: int = 2                     # number of worksheets
+    formulas: int = 1000                # formulas in total, spread evenly over the sheets
+    names: int = 20                     # workbook level named ranges
+    name_size: int = 1                  # cells per named range (a column of this many rows)
+    fill_down: bool = True              # every formula of a sheet copied down from the first one
+    sparse: int = 1                     # rows between two formulas, > 1 spreads the cells out
+    inflated: bool = False              # sheet dimension claims the whole sheet (A1:XFD1048576)
+    seed: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def generate_template(filename: str, spec: TemplateSpec = None) -> TemplateSpec:
+    """
+    Writes a synthetic template
+    :param filename: name of the .xlsx file to write
+    :param spec: shape of the template, the defaults when None
+    :return: the spec used
+    """
+    spec = spec or TemplateSpec()
+    rng = random.Random(spec.seed)
+    sheet_names = [f'Sheet{i + 1}' for i in range(spec.sheets)]
+
+    # Named ranges: a column of name_size cells each, in column E, spread over the sheets
+    names = []
+    for i in range(spec.names):
+        sheet = i % spec.sheets
+        first = (i // spec.sheets) * spec.name_size + 1
+        values = [rng.randint(1, 20) for _ in range(spec.name_size)]
+        names.append((f'Name{i + 1}', sheet, first, values))
+
+    per_sheet = [spec.formulas // spec.sheets + (1 if i < spec.formulas % spec.sheets else 0)
+                 for i in range(spec.sheets)]
+    inputs = [[rng.randint(1, 100) for _ in range(n)] for n in per_sheet]
+
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', _content_types(spec.sheets))
+        archive.writestr('_rels/.rels', _root_relationships())
+        archive.writestr('xl/workbook.xml', _workbook(sheet_names, names, spec.name_size))
+        archive.writestr('xl/_rels/workbook.xml.rels', _workbook_relationships(spec.sheets))
+        archive.writestr('xl/styles.xml', _STYLES)
+        for s in range(spec.sheets):
+            rows = _sheet_rows(s, spec, inputs, names, sheet_names)
+            archive.writestr(f'xl/worksheets/sheet{s + 1}.xml', _worksheet(rows, spec.inflated))
+
+    return spec
+
+
+def _sheet_rows(s: int, spec: TemplateSpec, inputs: list, names: list, sheet_names: list) -> dict:
+    """
+    Builds the cells of one sheet
+    :return: dict of row -> list of (column, cell xml)
+    """
+    rows = {}
+
+    def add(row: int, col: int, xml: str):
+        rows.setdefault(row, []).append((col, xml))
+
+    for name, sheet, first, values in names:
+        if sheet == s:
+            for offset, value in enumerate(values):
+                add(first + offset, 5, _number_cell(first + offset, 5, value))
+
+    for i, value in enumerate(inputs[s]):
+        row = i * spec.sparse + 1
+        add(row, 1, _number_cell(row, 1, value))
+
+        pattern = 0 if spec.fill_down else i % len(_PATTERNS)
+        if _PATTERNS[pattern] == '{p}+{a}' and s == 0:
+            pattern = 0
+        # Copied-down formulas all use the same name, mixed ones cycle through the names
+        name, name_values = None, [0]
+        if names:
+            name, _, _, name_values = names[(s if spec.fill_down else i) % len(names)]
+        formula, cached = _formula(pattern, row, value, name, name_values, s, i, inputs, sheet_names, spec)
+        add(row, 2, _formula_cell(row, 2, formula, cached))
+
+    return rows
+
+
+def _formula(pattern: int, row: int, a: float, name, name_values: list, s: int, i: int, inputs: list,
+             sheet_names: list, spec: TemplateSpec) -> tuple:
+    """
+    Writes one formula and the value Excel would cache for it
+    :return: tuple of formula text and cached value
+    """
+    if name is None:
+        n_text, n_value = '0', 0
+    elif spec.name_size == 1:
+        n_text, n_value = name, name_values[0]
+    else:
+        n_text, n_value = f'SUM({name})', sum(name_values)
+
+    a_ref = f'A{row}'
+    previous = inputs[s - 1][i] if s > 0 and i < len(inputs[s - 1]) else 0
+    p_ref = f'{sheet_names[s - 1]}!A{i * spec.sparse + 1}' if s > 0 else '0'
+    formula = _PATTERNS[pattern].format(a=a_ref, n=n_text, p=p_ref)
+
+    if pattern == 0:
+        cached = a * 2 + n_value
+    elif pattern == 1:
+        cached = a if a > 50 else 0
+    elif pattern == 2:
+        cached = math.floor(a / 3 * 100 + 0.5) / 100
+    elif pattern == 3:
+        cached = max(a, n_value)
+    else:
+        cached = previous + a
+    return formula, cached
+
+
+def _number_cell(row: int, col: int, value) -> str:
+    return f'<c r="{_column(col)}{row}"><v>{value}</v></c>'
+
+
+def _formula_cell(row: int, col: int, formula: str, cached) -> str:
+    return f'<c r="{_column(col)}{row}"><f>{escape(formula)}</f><v>{cached}</v></c>'
+
+
+def _column(index: int) -> str:
+    letters = ''
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def _worksheet(rows: dict, inflated: bool) -> str:
+    last_row = max(rows) if rows else 1
+    dimension = 'A1:XFD1048576' if inflated else f'A1:E{last_row}'
+    parts = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="{_MAIN_NS}">'
+             f'<dimension ref="{dimension}"/><sheetData>']
+    for row in sorted(rows):
+        cells = ''.join(xml for _, xml in sorted(rows[row]))
+        parts.append(f'<row r="{row}">{cells}</row>')
+    parts.append('</sheetData></worksheet>')
+    return ''.join(parts)
+
+
+def _workbook(sheet_names: list, names: list, name_size: int) -> str:
+    sheets = ''.join(f'<sheet name="{n}" sheetId="{i + 1}" r:id="rId{i + 1}"/>' for i, n in enumerate(sheet_names))
+    defined = ''.join(f'<definedName name="{name}">{sheet_names[sheet]}!$E${first}'
+                      f'{f":$E${first + name_size - 1}" if name_size > 1 else ""}</definedName>'
+                      for name, sheet, first, _ in names)
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<workbook xmlns="{_MAIN_NS}" xmlns:r="{_REL_NS}"><sheets>{sheets}</sheets>'
+            f'{f"<definedNames>{defined}</definedNames>" if defined else ""}</workbook>')
+
+
+def _workbook_relationships(sheets: int) -> str:
+    rels = ''.join(f'<Relationship Id="rId{i + 1}" Type="{_REL_NS}/worksheet" Target="worksheets/sheet{i + 1}.xml"/>'
+                   for i in range(sheets))
+    rels += f'<Relationship Id="rId{sheets + 1}" Type="{_REL_NS}/styles" Target="styles.xml"/>'
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Relationships xmlns="{_PACKAGE_REL_NS}">{rels}</Relationships>')
+
+
+def _root_relationships() -> str:
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{_PACKAGE_REL_NS}">'
+            f'<Relationship Id="rId1" Type="{_REL_NS}/officeDocument" Target="xl/workbook.xml"/></Relationships>')
+
+
+def _content_types(sheets: int) -> str:
+    overrides = ''.join(f'<Override PartName="/xl/worksheets/sheet{i + 1}.xml" ContentType="{_SHEET_TYPE}"/>'
+                        for i in range(sheets))
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Types xmlns="{_CONTENT_TYPES}">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{overrides}</Types>')
+
+
+_STYLES = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<styleSheet xmlns="{_MAIN_NS}">'
+           '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+           '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+           '<fill><patternFill patternType="gray125"/></fill></fills>'
+           '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+           '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+           '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+           '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+           '</styleSheet>')
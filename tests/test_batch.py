@@ -0,0 +1,53 @@
+"""
+Batch verification timeouts
+- A template that never finishes reading (a FIFO nobody writes to, like a file on a stalled network share) must
+  not stop the batch: its worker is killed and replaced, the templates queued behind it are still verified
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from batch import verify_templates  # noqa: E402
+
+
+@unittest.skipUnless(hasattr(os, 'mkfifo'), 'needs named pipes')
+class TestBatchTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'templates')
+        self.out_dir = os.path.join(self.tmp.name, 'out')
+        os.makedirs(self.source)
+        # Templates are verified in name order, the hanging one first
+        os.mkfifo(os.path.join(self.source, 'a_hangs.xlsx'))
+        for name in ('b_ok.xlsx', 'c_ok.xlsx'):
+            generate_template(os.path.join(self.source, name), TemplateSpec(sheets=1, formulas=10, names=2))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hung_worker_is_replaced(self):
+        start = time.perf_counter()
+        manifest = verify_templates(self.source, self.out_dir, workers=1, timeout=2)
+        self.assertLess(time.perf_counter() - start, 30)
+
+        statuses = {os.path.basename(t['template']): t['status'] for t in manifest['templates']}
+        self.assertEqual(statuses, {'a_hangs.xlsx': 'timeout', 'b_ok.xlsx': 'ok', 'c_ok.xlsx': 'ok'})
+        self.assertEqual(manifest['failures'], 1)
+
+    def test_queued_templates_time_out(self):
+        manifest = verify_templates(self.source, self.out_dir, workers=1, timeout=5, queue_timeout=1)
+
+        statuses = {os.path.basename(t['template']): t['status'] for t in manifest['templates']}
+        self.assertEqual(statuses, {'a_hangs.xlsx': 'timeout', 'b_ok.xlsx': 'timeout', 'c_ok.xlsx': 'timeout'})
+        self.assertIn('Did not start', manifest['templates'][1]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
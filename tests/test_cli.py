@@ -0,0 +1,105 @@
+"""
+Startup budget of the command line interface
+- Every subcommand runs in a fresh interpreter on a small synthetic template, the test fails when it takes longer
+  than its time budget, imports more modules than its module budget or imports a library it does not need
+- The budgets leave room for slow machines, a subcommand that starts importing a heavy library it does not use
+  goes over them
+- A record format whose library is missing ends the export with an error status before the template is read
+"""
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+import cli  # noqa: E402
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'cli.py')
+
+# Runs the CLI in this interpreter, then reports the seconds taken and the modules imported
+_RUNNER = '''
+import io, json, os, runpy, sys, time
+from contextlib import redirect_stdout
+start = time.perf_counter()
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+status = 0
+try:
+    with redirect_stdout(io.StringIO()):
+        runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit as e:
+    status = e.code or 0
+print(json.dumps({'status': status, 'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}))
+'''
+
+# subcommand arguments -> (seconds, modules, libraries that must not be imported)
+BUDGETS = {
+    ('--help',): (0.5, 150, ('openpyxl', 'docx', 'numpy', 'pandas')),
+    ('extract', '--help'): (0.5, 150, ('openpyxl', 'docx', 'numpy', 'pandas')),
+    ('extract', '{template}'): (3.0, 550, ('docx', 'pandas')),
+    ('export', '{template}', '--out-dir', '{out_dir}'): (4.0, 550, ('docx', 'pandas')),
+    ('export', '{template}', '--out-dir', '{out_dir}', '--format', 'jsonl', '--no-evaluate'):
+        (3.0, 550, ('docx', 'pandas', 'pyarrow')),
+    ('document', '{template}', '--out-dir', '{out_dir}'): (6.0, 700, ('pandas',)),
+    ('perturb', '{template}', '--scenarios', '1000'): (4.0, 550, ('docx', 'pandas')),
+}
+
+
+class TestStartupBudget(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.template = os.path.join(cls.tmp.name, 'budget.xlsx')
+        generate_template(cls.template, TemplateSpec(sheets=2, formulas=50, names=5))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_budgets(self):
+        for arguments, (seconds, modules, excluded) in BUDGETS.items():
+            arguments = [a.format(template=self.template, out_dir=self.tmp.name) for a in arguments]
+            with self.subTest(command=' '.join(a for a in arguments if a.startswith('-') or a.isalpha())):
+                result = self.__run(arguments)
+                self.assertEqual(result['status'], 0)
+                self.assertLess(result['seconds'], seconds)
+                self.assertLessEqual(len(result['modules']), modules)
+                loaded = sorted({m.split('.')[0] for m in result['modules']} & set(excluded))
+                self.assertEqual(loaded, [], f'{arguments[0]} imports {", ".join(loaded)}')
+
+    @staticmethod
+    def __run(arguments: list) -> dict:
+        output = subprocess.run([sys.executable, '-c', _RUNNER, CLI] + arguments, capture_output=True, text=True,
+                                check=True).stdout
+        return json.loads(output.splitlines()[-1])
+
+
+@unittest.skipIf(importlib.util.find_spec('pyarrow') is not None, 'pyarrow is installed')
+class TestMissingParquet(unittest.TestCase):
+
+    def test_parquet_without_pyarrow(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, 'export.xlsx')
+            generate_template(template, TemplateSpec(sheets=1, formulas=10, names=2))
+            out_dir = os.path.join(tmp, 'out')
+            for options in ([], ['--no-evaluate']):
+                with self.subTest(options=options):
+                    output = io.StringIO()
+                    with redirect_stdout(output):
+                        status = cli.main(['export', template, '--format', 'parquet', '--out-dir', out_dir] + options)
+                    self.assertEqual(status, 1)
+                    self.assertIn('pyarrow', output.getvalue())
+                    self.assertFalse(os.path.exists(out_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Dependency graph
+- Topological order puts every precedent before the records using it, ties keep extraction order
+- Circular references are reported as cycles, the records in and downstream of them go last
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from dependency_graph import DependencyGraph  # noqa: E402
+from template_file import process_template_file  # noqa: E402
+from variable import Formula, Name, Variable  # noqa: E402
+
+
+def _formula(coordinate: str, text: str) -> Formula:
+    return Formula(sheet='Sheet', coordinate=coordinate, value=f'={text}')
+
+
+def _constant(coordinate: str, value) -> Variable:
+    return Variable(sheet='Sheet', coordinate=coordinate, value=value)
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+    def __assert_ordered(self, graph: DependencyGraph, order: list):
+        self.assertEqual(sorted(order), list(range(len(graph))))
+        position = {node: i for i, node in enumerate(order)}
+        for node, precedents in enumerate(graph.precedents):
+            for precedent in precedents:
+                self.assertLess(position[precedent], position[node], (graph.nodes[precedent], graph.nodes[node]))
+
+    def test_topological_order(self):
+        # Formulas before the cells they use, so extraction order is not dependency order
+        c1 = _formula('C1', 'B1*2')
+        b1 = _formula('B1', 'A1+Rate')
+        d1 = _formula('D1', 'SUM(A1:A3)')
+        a1, a3 = _constant('A1', 5), _constant('A3', 7)
+        rate = Name(name='Rate', sheet='Sheet', coordinate='E1', value='0.1')
+        e1 = _constant('E1', 0.1)
+        graph = DependencyGraph({'formulas': [c1, b1, d1], 'constants': [a1, a3, e1], 'names': [rate]})
+
+        order = graph.topological_order()
+        self.__assert_ordered(graph, order)
+        self.assertEqual(graph.ordered([c1, b1, d1]), [d1, b1, c1])
+        self.assertEqual(graph.upstream(c1), [b1, a1, rate, e1])
+        self.assertEqual(graph.downstream(a1), [b1, d1, c1])
+        self.assertEqual(graph.cycles(), [])
+
+    def test_cycles(self):
+        a1 = _formula('A1', 'B1+1')
+        b1 = _formula('B1', 'A1*2')
+        c1 = _formula('C1', 'A1')
+        d1 = _formula('D1', 'D1+1')
+        e1 = _formula('E1', 'F1*2')
+        f1 = _constant('F1', 3)
+        graph = DependencyGraph({'formulas': [a1, b1, c1, d1, e1], 'constants': [f1], 'names': []})
+
+        self.assertEqual(graph.cycles(), [[a1, b1], [d1]])
+        # The cycles and the formula using them cannot be ordered, they go last in node order
+        order = [graph.nodes[i] for i in graph.topological_order()]
+        self.assertEqual(order, [f1, e1, a1, b1, c1, d1])
+
+    def test_synthetic_template(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, 'graph.xlsx')
+            generate_template(template, TemplateSpec(sheets=3, formulas=90, names=6, name_size=2, fill_down=False))
+            template_data = process_template_file(template, workers=1)
+
+        graph = DependencyGraph(template_data)
+        self.assertEqual(len(graph), sum(len(template_data[k]) for k in ('formulas', 'names', 'constants')))
+        self.assertGreater(sum(map(len, graph.precedents)), len(template_data['formulas']))
+        self.__assert_ordered(graph, graph.topological_order())
+        self.assertEqual(graph.cycles(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
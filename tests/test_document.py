@@ -0,0 +1,135 @@
+"""
+Verification document equivalence
+- The document written with the tables rendered by worker processes is the one written in this process
+- Tables cloned from a prototype are the tables add_table builds cell by cell
+- A document that fails while being streamed leaves the previous file in place and no temporary file behind
+"""
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from copy import copy
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from docx import Document  # noqa: E402
+from docx_stream import StreamingDocxWriter  # noqa: E402
+from evaluator import evaluate_template  # noqa: E402
+from lxml import etree  # noqa: E402
+from table import TableRenderer, add_table  # noqa: E402
+from variable import cell_variables  # noqa: E402
+from template_file import process_template_file  # noqa: E402
+import verification_document  # noqa: E402
+
+
+def _parts(filename: str) -> dict:
+    with zipfile.ZipFile(filename) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+class TestParallelDocument(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.template = os.path.join(cls.tmp.name, 'document.xlsx')
+        generate_template(cls.template, TemplateSpec(sheets=3, formulas=60, names=4, fill_down=False))
+        cls.template_data = process_template_file(cls.template, workers=1)
+        evaluate_template(cls.template, cls.template_data)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def __write(self, name: str, workers: int, **options) -> dict:
+        filename = os.path.join(self.tmp.name, name)
+        with mock.patch.object(verification_document, 'PARALLEL_MIN_TABLES', 0), \
+                mock.patch.object(verification_document, 'RENDER_CHUNK', 7):
+            verification_document.stream_document(self.template_data, filename, 'Name', 'Description',
+                                                  workers=workers, **options)
+        return _parts(filename)
+
+    def test_parallel_equals_serial(self):
+        self.assertEqual(self.__write('parallel.docx', 3), self.__write('serial.docx', 1))
+
+    def test_parallel_equals_serial_with_margins(self):
+        # Parallel first, so the workers cannot pick up prototypes the serial run built
+        margins = (1.0, 0.75, 1.25, 0.6)
+        parallel = self.__write('parallel_margins.docx', 3, margins=margins, group=True, samples=1)
+        serial = self.__write('serial_margins.docx', 1, margins=margins, group=True, samples=1)
+        self.assertEqual(parallel, serial)
+        self.assertNotEqual(serial['word/document.xml'], self.__write('default_margins.docx', 1, group=True,
+                                                                        samples=1)['word/document.xml'])
+
+
+def _tables(formulas: list, render) -> list:
+    """The xml of the tables render adds for formulas to a document with the verification document's styles"""
+    doc = verification_document.__styled_document((4.0, 7.5))
+    for f in formulas:
+        render(doc, f)
+    return [etree.tostring(t._tbl) for t in doc.tables]
+
+
+class TestTableRenderer(unittest.TestCase):
+
+    def test_prototype_equals_add_table(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, 'tables.xlsx')
+            # Named ranges of 3 cells, so the tables have different numbers of variable rows
+            generate_template(template, TemplateSpec(sheets=2, formulas=8, names=4, name_size=3, fill_down=False))
+            template_data = process_template_file(template, workers=1)
+            evaluate_template(template, template_data)
+        # With and without the evaluator's results
+        evaluated = template_data['formulas']
+        formulas = [copy(f) for f in evaluated]
+        for f in formulas:
+            f.expected = f.passed = None
+        # A variable that could not be resolved, the renderer builds that table cell by cell
+        unresolved = copy(formulas[0])
+        unresolved.variables = formulas[0].variables + [None]
+        formulas = formulas + evaluated + [unresolved]
+        self.assertTrue(all(f.expected is not None for f in evaluated))
+        self.assertGreater(len({len(cell_variables(f.variables)) for f in formulas}), 2)
+
+        renderer = {}
+        expected = _tables(formulas, add_table)
+        cloned = _tables(formulas, lambda doc, f: renderer.setdefault(id(doc), TableRenderer(doc)).add_table(f))
+        self.assertEqual(len(cloned), len(formulas))
+        self.assertEqual(cloned, expected)
+
+
+class TestStreamingDocxWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'document.docx')
+        with open(self.filename, 'w') as f:
+            f.write('previous')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_error_keeps_previous_file(self):
+        with self.assertRaises(RuntimeError):
+            with StreamingDocxWriter(Document(), self.filename) as writer:
+                writer.add_paragraph()
+                raise RuntimeError('stopped')
+
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'previous')
+        self.assertEqual(os.listdir(self.tmp.name), ['document.docx'])
+
+    def test_success_replaces_file(self):
+        with StreamingDocxWriter(Document(), self.filename) as writer:
+            writer.add_paragraph()
+
+        self.assertEqual(len(Document(self.filename).paragraphs), 1)
+        self.assertEqual(os.listdir(self.tmp.name), ['document.docx'])
+
+
+if __name__ == '__main__':
+    unittest.main()
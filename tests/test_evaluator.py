@@ -0,0 +1,131 @@
+"""
+Formula evaluator
+- Every operator and function the evaluator supports, against the value Excel gives
+- Blank cells: 0 in arithmetic, empty text in text operations, equal to both 0 and "" in comparisons
+- A batch of copied formulas gives the same results as the formulas evaluated one at a time
+"""
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from openpyxl.utils.cell import column_index_from_string, coordinate_from_string  # noqa: E402
+from evaluator import evaluate_formulas  # noqa: E402
+from variable import Formula, Name  # noqa: E402
+
+# Cells the formulas below use, A2 and A4 are blank
+CELLS = {'A1': 5, 'A3': 7, 'A5': -2.5, 'B1': 'Text', 'B2': 'text', 'B3': 'TRUE', 'C1': True, 'C2': False,
+         'D1': 1, 'D2': 2, 'D3': 'x', 'D4': True, 'D5': 4}
+
+# formula -> value Excel gives
+CASES = {
+    # Arithmetic
+    'A1+A3': 12.0, 'A1-A3': -2.0, 'A1*A3': 35.0, 'A3/A1': 1.4, 'A1^2': 25.0, '-A1': -5.0, 'A1%': 0.05,
+    '2+3*4': 14.0, '(2+3)*4': 20.0, '"3"+1': 4.0, 'C1+1': 2.0,
+    # Text
+    'A1&"x"': '5x', 'B1&C1': 'TextTRUE', 'A5&""': '-2.5',
+    # Comparisons
+    'A1=5': True, 'A1<>5': False, 'A1<A3': True, 'A1>A3': False, 'A1<=5': True, 'A1>=6': False,
+    'B1=B2': True, 'B1<"u"': True, 'A1<"a"': True, '"a"<C2': True, 'C1>C2': True,
+    # Aggregates, text, logicals and blanks in ranges are skipped
+    'SUM(D1:D5)': 7.0, 'SUM(D1:D5,10)': 17.0, 'PRODUCT(D1:D5)': 8.0, 'MIN(D1:D5)': 1.0, 'MAX(D1:D5)': 4.0,
+    'AVERAGE(D1:D5)': 7 / 3, 'COUNT(D1:D5)': 3.0, 'MAX(B1:B2)': 0.0,
+    # Logical
+    'IF(A1>3,"big","small")': 'big', 'IF(A1>9,"big","small")': 'small', 'IF(A1>9,1)': False,
+    'IFERROR(1/0,"div")': 'div', 'IFERROR(A1,0)': 5.0, 'AND(A1>1,C1)': True, 'OR(A1>9,C2)': False,
+    'NOT(C1)': False, 'AND(D1:D5)': True, 'IF(B3,1,2)': 1.0,
+    # Math
+    'ROUND(2.675,2)': 2.68, 'ROUND(-2.5,0)': -3.0, 'ROUND(1234,-2)': 1200.0, 'ROUNDUP(1.21,1)': 1.3,
+    'ROUNDDOWN(-1.29,1)': -1.2, 'INT(-2.5)': -3.0, 'ABS(A5)': 2.5, 'SQRT(16)': 4.0, 'EXP(0)': 1.0,
+    'LN(EXP(2))': 2.0, 'LOG10(1000)': 3.0, 'MOD(-7,3)': 2.0, 'MOD(7,-3)': -2.0, 'POWER(2,10)': 1024.0,
+    'PI()': math.pi,
+    # Text functions
+    'TEXT(A5,"0.00")': '-2.50', 'TEXT(0.125,"0.0%")': '12.5%', 'TEXT(1234567,"#,##0")': '1,234,567',
+    'TEXT(A1,"General")': '5', 'CONCATENATE(B1,"-",A1)': 'Text-5', 'CONCAT(A1,C1)': '5TRUE', 'LEN(B1)': 4.0,
+    'UPPER(B2)': 'TEXT', 'LOWER(B1)': 'text',
+    # Errors
+    'A1/0': '#DIV/0!', 'SQRT(-1)': '#NUM!', 'LN(0)': '#NUM!', 'MOD(1,0)': '#DIV/0!', 'B1+1': '#VALUE!',
+    'AVERAGE(B1:B2)': '#DIV/0!', '10^400': '#NUM!', '1E300*1E300': '#NUM!', 'Missing+1': '#NAME?',
+    '0^0': '#NUM!', 'A2^0': '#NUM!', 'POWER(0,0)': '#NUM!', '0^-1': '#DIV/0!', 'POWER(A2,-2)': '#DIV/0!',
+    '(-8)^(1/3)': '#NUM!', '0^2': 0.0, 'A1^0': 1.0,
+    # Global names
+    'Rate*A1': 0.5,
+}
+
+# Blank cells, A2 and A4
+BLANKS = {
+    'A2': 0.0, 'A2+1': 1.0, 'A2*A1': 0.0, '-A2': 0.0, 'A2&"x"': 'x', 'CONCATENATE(A1,A2)': '5', 'LEN(A2)': 0.0,
+    'A2=""': True, 'A2=0': True, 'A2=A4': True, 'A2<>""': False, 'A2=C2': True, 'A2<1': True, 'A2<"a"': True,
+    'A1=""': False, 'SUM(A2)': 0.0, 'COUNT(A2)': 0.0, 'COUNT(A1,A2)': 1.0, 'IF(A2,1,2)': 2.0,
+    'NOT(A2)': True, 'IF(TRUE,A2)': 0.0, 'IF(TRUE,A2)&"x"': 'x', 'TEXT(A2,"0.0")': '0.0', 'UPPER(A2)': '',
+    'A2/1': 0.0, '1/A2': '#DIV/0!',
+}
+
+
+def _values(cells: dict) -> dict:
+    values = {}
+    for coordinate, value in cells.items():
+        column, row = coordinate_from_string(coordinate)
+        values[('Sheet', row, column_index_from_string(column))] = value
+    return values
+
+
+def _evaluate(formulas: list, cells: dict = None):
+    template_data = {'formulas': formulas, 'constants': [],
+                     'names': [Name(name='Rate', scope='Workbook', value='0.1', is_global=True)]}
+    evaluate_formulas(template_data, _values(CELLS if cells is None else cells))
+    return [f.expected for f in formulas]
+
+
+def _formula(text: str, row: int = 1) -> Formula:
+    return Formula(sheet='Sheet', value=text, row=row, col=10)
+
+
+class TestEvaluator(unittest.TestCase):
+
+    def __check(self, cases: dict):
+        for text, expected in cases.items():
+            with self.subTest(formula=text):
+                result, = _evaluate([_formula(text)])
+                if isinstance(expected, float):
+                    self.assertIsInstance(result, float)
+                    self.assertAlmostEqual(result, expected, places=12)
+                else:
+                    self.assertEqual(result, expected)
+                    self.assertIs(type(result), type(expected))
+
+    def test_operators_and_functions(self):
+        self.__check(CASES)
+
+    def test_blank_cells(self):
+        self.__check(BLANKS)
+
+    def test_batch_with_blanks(self):
+        # Copied down column J, A2 and A4 are blank: the batch mixes numbers and blanks
+        cells = {'A1': 5, 'A3': 7, 'B1': 'a', 'B2': 'b', 'B3': 'c', 'B4': 'd'}
+        for text, expected in {'A1&"x"': ['5x', 'x', '7x', 'x'], 'A1=""': [False, True, False, True],
+                               'A1+1': [6.0, 1.0, 8.0, 1.0], 'CONCATENATE(B1,A1)': ['a5', 'b', 'c7', 'd'],
+                               'COUNT(A1)': [1.0, 0.0, 1.0, 0.0], 'A1=B1': [False] * 4}.items():
+            with self.subTest(formula=text):
+                # Copies of the formula share its R1C1 form and are evaluated as one batch
+                formulas = [_formula(_shifted(text, row), row) for row in range(1, 5)]
+                self.assertEqual(_evaluate(formulas, cells), expected)
+
+    def test_batch_equals_single(self):
+        text = 'IF(A1>3,A1*2,A1&"!")'
+        cells = {'A1': 5, 'A2': 1, 'A3': 9, 'A4': 0}
+        batch = _evaluate([_formula(_shifted(text, row), row) for row in range(1, 5)], cells)
+        single = [_evaluate([_formula(_shifted(text, row), row)], cells)[0] for row in range(1, 5)]
+        self.assertEqual(batch, single)
+        self.assertEqual(batch, [10.0, '1!', 18.0, '0!'])
+
+
+def _shifted(text: str, row: int) -> str:
+    """The formula text of row 1 copied down to row"""
+    return text.replace('A1', f'A{row}').replace('B1', f'B{row}')
+
+
+if __name__ == '__main__':
+    unittest.main()
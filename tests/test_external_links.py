@@ -0,0 +1,149 @@
+"""
+Linked workbooks
+- The pool returns None for a file that is missing or not an xlsx workbook, and counts it as missing
+- Least recently used workbooks are evicted past the workbook and cell limits, a changed file is reloaded
+- The resolver finds linked workbooks by link number or file name, next to the template when moved, and does not
+  keep workbooks the pool evicted alive
+"""
+import gc
+import os
+import sys
+import tempfile
+import unittest
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import openpyxl  # noqa: E402
+from external_links import ExternalResolver, WorkbookPool  # noqa: E402
+
+
+def _workbook(filename: str, cells: dict, sheet: str = 'Stock'):
+    """Writes a workbook with one sheet holding cells, coordinate -> value"""
+    book = openpyxl.Workbook()
+    book.active.title = sheet
+    for coordinate, value in cells.items():
+        book.active[coordinate] = value
+    book.save(filename)
+
+
+class TestWorkbookPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = {}
+        for name, size in (('a', 3), ('b', 3), ('c', 5)):
+            self.files[name] = os.path.join(self.tmp.name, f'{name}.xlsx')
+            _workbook(self.files[name], {f'A{row}': row for row in range(1, size + 1)})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unreadable_files(self):
+        legacy = os.path.join(self.tmp.name, 'legacy.xlsx')
+        with open(legacy, 'wb') as f:
+            f.write(b'\xd0\xcf\x11\xe0 not a zip archive')
+        pool = WorkbookPool()
+
+        with self.assertWarns(UserWarning):
+            self.assertIsNone(pool.get(legacy))
+        self.assertIsNone(pool.get(os.path.join(self.tmp.name, 'gone.xlsx')))
+        self.assertEqual(pool.stats(), {'hits': 0, 'misses': 1, 'loads': 0, 'evictions': 0, 'missing': 2,
+                                        'workbooks': 0, 'cells': 0})
+
+    def test_stats(self):
+        pool = WorkbookPool()
+        first = pool.get(self.files['a'])
+        self.assertIs(pool.get(self.files['a']), first)
+        self.assertEqual(first.cell('STOCK', 2, 1).value, 2)
+        self.assertEqual(pool.stats(), {'hits': 1, 'misses': 1, 'loads': 1, 'evictions': 0, 'missing': 0,
+                                        'workbooks': 1, 'cells': 3})
+
+    def test_evicts_by_count(self):
+        pool = WorkbookPool(max_workbooks=2)
+        pool.get(self.files['a'])
+        pool.get(self.files['b'])
+        pool.get(self.files['a'])           # b is now the least recently used
+        pool.get(self.files['c'])
+
+        self.assertEqual(pool.stats()['evictions'], 1)
+        self.assertEqual(len(pool), 2)
+        pool.get(self.files['a'])
+        self.assertEqual(pool.stats()['loads'], 3)
+        pool.get(self.files['b'])
+        self.assertEqual(pool.stats()['loads'], 4)
+
+    def test_evicts_by_size(self):
+        pool = WorkbookPool(max_cells=7)
+        pool.get(self.files['a'])
+        pool.get(self.files['b'])
+        self.assertEqual(pool.stats()['cells'], 6)
+        pool.get(self.files['c'])           # 11 cells, a and b go
+        self.assertEqual((len(pool), pool.stats()['cells'], pool.stats()['evictions']), (1, 5, 2))
+
+        # A workbook larger than the limit on its own is still kept
+        pool = WorkbookPool(max_cells=2)
+        self.assertIsNotNone(pool.get(self.files['c']))
+        self.assertEqual(len(pool), 1)
+
+    def test_changed_file_is_reloaded(self):
+        pool = WorkbookPool()
+        old = pool.get(self.files['a'])
+        _workbook(self.files['a'], {'A1': 'changed', 'A2': 2})
+        stat = os.stat(self.files['a'])
+        os.utime(self.files['a'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        new = pool.get(self.files['a'])
+        self.assertIsNot(new, old)
+        self.assertEqual(new.cell('Stock', 1, 1).value, 'changed')
+        # The older revision is dropped, not evicted
+        self.assertEqual((len(pool), pool.stats()['cells'], pool.stats()['evictions']), (1, 2, 0))
+
+
+class TestExternalResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.template = os.path.join(self.tmp.name, 'Template.xlsx')
+        self.linked = os.path.join(self.tmp.name, 'Reagents.xlsx')
+        _workbook(self.linked, {'B2': 2.5, 'B3': 'label', 'C4': 7})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cells(self):
+        # Link 1 was recorded on another machine, the file was moved next to the template
+        links = {'1': 'file:///C:/Users/someone/Documents/Reagents.xlsx'}
+        resolver = ExternalResolver(self.template, links, WorkbookPool())
+
+        record = resolver.cell('1', 'stock', 2, 2)
+        self.assertEqual((record.name, record.value, record.output), ('[Reagents.xlsx]stock!B2', '2.5', '2.5'))
+        self.assertIs(resolver.cell('1', 'stock', 2, 2), record)
+        self.assertEqual(resolver.cell('Reagents.xlsx', 'Stock', 4, 3).output, '7')
+        self.assertEqual(resolver.files, {self.linked})
+
+        # Text, blank cells, unknown sheets and workbooks resolve to nothing
+        self.assertIsNone(resolver.cell('1', 'Stock', 3, 2))
+        self.assertIsNone(resolver.cell('1', 'Stock', 9, 9))
+        self.assertIsNone(resolver.cell('1', 'Other', 2, 2))
+        self.assertIsNone(resolver.cell('Missing.xlsx', 'Stock', 2, 2))
+
+    def test_evicted_workbook_is_freed(self):
+        other = os.path.join(self.tmp.name, 'Other.xlsx')
+        _workbook(other, {'A1': 1})
+        pool = WorkbookPool(max_workbooks=1)
+        resolver = ExternalResolver(self.template, {}, pool)
+
+        self.assertIsNotNone(resolver.cell('Reagents.xlsx', 'Stock', 2, 2))
+        workbook = weakref.ref(pool.get(self.linked))
+        pool.get(other)
+        gc.collect()
+        self.assertIsNone(workbook())
+
+        # The next lookup loads it again
+        self.assertEqual(resolver.cell('Reagents.xlsx', 'Stock', 4, 3).output, '7')
+        self.assertEqual(pool.stats()['loads'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
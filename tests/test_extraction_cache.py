@@ -0,0 +1,76 @@
+"""
+Extraction cache
+- An unchanged template is loaded from the cache
+- After a cell of one sheet is edited only that sheet is read again, the edited cell and every formula downstream
+  of it (on any sheet) are reported, and the records are the ones a full extraction gives
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from extraction_cache import process_template_revision  # noqa: E402
+from template_file import process_template_file  # noqa: E402
+
+
+def _edit_part(filename: str, part: str, old: str, new: str):
+    """Replaces text in one part of an xlsx file, the other parts are copied unchanged"""
+    edited = filename + '.edited'
+    with zipfile.ZipFile(filename) as source, zipfile.ZipFile(edited, 'w', zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            data = source.read(info)
+            if info.filename == part:
+                assert old.encode() in data
+                data = data.replace(old.encode(), new.encode())
+            target.writestr(info, data)
+    shutil.move(edited, filename)
+
+
+def _records(template_data: dict) -> list:
+    return [(r.sheet, r.coordinate, r.value, r.output) for key in ('formulas', 'constants')
+            for r in template_data[key]]
+
+
+class TestExtractionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.template = os.path.join(self.tmp.name, 'template.xlsx')
+        # Row 5 of Sheet2 and Sheet3 holds Sheet1!A5+A5 and Sheet2!A5+A5
+        generate_template(self.template, TemplateSpec(sheets=3, formulas=30, names=3, fill_down=False))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unchanged_template(self):
+        first, changes = process_template_revision(self.template, self.cache_dir)
+        self.assertTrue(changes.full)
+        second, changes = process_template_revision(self.template, self.cache_dir)
+        self.assertTrue(changes.cached)
+        self.assertFalse(changes)
+        self.assertEqual(_records(second), _records(first))
+
+    def test_edited_sheet(self):
+        process_template_revision(self.template, self.cache_dir)
+        _edit_part(self.template, 'xl/worksheets/sheet2.xml', '<c r="A5"><v>13</v></c>', '<c r="A5"><v>14</v></c>')
+
+        template_data, changes = process_template_revision(self.template, self.cache_dir)
+        self.assertFalse(changes.cached or changes.full)
+        self.assertEqual(changes.reused_sheets, ['Sheet1', 'Sheet3'])
+        self.assertEqual(changes.modified, [('Sheet2', 'A5')])
+        self.assertEqual((changes.added, changes.removed, changes.names), ([], [], []))
+        self.assertEqual([(f.sheet, f.coordinate) for f in changes.affected], [('Sheet2', 'B5'), ('Sheet3', 'B5')])
+
+        self.assertEqual(_records(template_data), _records(process_template_file(self.template, workers=1)))
+        self.assertIn(('Sheet2', 'A5', '14', '14'), _records(template_data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Formula groups
+- Formulas copied down a column collapse into one group, a different formula in between, another column or
+  another sheet starts a new group, formulas that cannot be parsed stay on their own
+- Samples are spread evenly over the group after the representative and always include the last member
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from formula_groups import group_formulas  # noqa: E402
+from variable import Formula  # noqa: E402
+
+
+def _formulas(cells: list) -> list:
+    return [Formula(sheet=sheet, coordinate=coordinate, value=value) for sheet, coordinate, value in cells]
+
+
+class TestFormulaGroups(unittest.TestCase):
+
+    def test_groups(self):
+        # Row by row, as the formulas are extracted
+        formulas = _formulas([('S', 'B1', '=A1*2'), ('S', 'C1', '=B1*2'), ('S', 'B2', '=A2*2'), ('S', 'C2', '=B2*2'),
+                              ('S', 'B3', '=A3*2'), ('S', 'B4', '=A4*2'), ('S', 'B5', '=A5+1'),
+                              ('S', 'B6', '=A6*2'), ('S', 'B7', '=A7*2'), ('S', 'B8', '=$A$1*2'),
+                              ('S', 'B9', '=SUM('), ('S', 'B10', '=SUM('), ('T', 'B1', '=A1*2'), ('T', 'B2', '=A2*2')])
+        # B1 and C1 have the same R1C1 form, the columns are still grouped apart
+        self.assertEqual(formulas[0].parsed.r1c1, formulas[1].parsed.r1c1)
+        groups = group_formulas(formulas)
+
+        self.assertEqual([(g.sheet, g.coordinate, len(g)) for g in groups],
+                         [('S', 'B1:B4', 4), ('S', 'C1:C2', 2), ('S', 'B5', 1), ('S', 'B6:B7', 2), ('S', 'B8', 1),
+                          ('S', 'B9', 1), ('S', 'B10', 1), ('T', 'B1:B2', 2)])
+        self.assertCountEqual([id(f) for g in groups for f in g], map(id, formulas))
+        self.assertIs(groups[0].representative, formulas[0])
+        self.assertEqual([f.coordinate for f in groups[0]], ['B1', 'B2', 'B3', 'B4'])
+
+    def test_samples(self):
+        group, = group_formulas(_formulas([('S', f'B{r}', f'=A{r}*2') for r in range(1, 11)]))
+        self.assertEqual(group.coordinate, 'B1:B10')
+        for count, rows in {
+            0: [],
+            1: [10],
+            3: [4, 7, 10],
+            4: [3, 5, 7, 10],
+            9: list(range(2, 11)),
+            20: list(range(2, 11)),
+        }.items():
+            with self.subTest(count=count):
+                self.assertEqual([f.row for f in group.samples(count)], rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Formula parser
+- Sheet, external workbook, whole row/column, structured (table) and union references and array constants
+- The R1C1 form is the same for every copy of a filled-down formula, copies share their parse result
+- Unreadable formulas raise FormulaError
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from formula_parser import (Array, FormulaError, Number, TableReference, Union_, parse_formula,  # noqa: E402
+                            to_r1c1)
+
+# (formula, row, col) -> (R1C1 form, references as A1 text from the formula's cell)
+REFERENCES = {
+    ('Sheet2!B3+A1', 5, 3): ('Sheet2!R[-2]C[-1]+R[-4]C[-2]', ['Sheet2!B3', 'A1']),
+    ("'My Sheet'!$A$1*2", 1, 1): ("'My Sheet'!R1C1*2.0", ["'My Sheet'!A1"]),
+    ('SUM(Data!$B$2:B10)', 4, 2): ('SUM(Data!R2C2:R[6]C[0])', ['Data!B2:B10']),
+    ('[1]Stock!B2+[Reagents.xlsx]Stock!$C$4', 2, 2):
+        ('[1]Stock!R[0]C[0]+[Reagents.xlsx]Stock!R4C3', ['[1]Stock!B2', '[Reagents.xlsx]Stock!C4']),
+    ('SUM(A:A)+SUM(2:3)', 1, 1): ('SUM(C[0]:C[0])+SUM(R[1]:R[2])', ['A:A', '2:3']),
+    ('SUM((A1,B2:C3))', 1, 1): ('SUM((R[0]C[0],R[1]C[1]:R[2]C[2]))', ['A1', 'B2:C3']),
+}
+
+
+class TestFormulaParser(unittest.TestCase):
+
+    def test_references(self):
+        for (text, row, col), (r1c1, references) in REFERENCES.items():
+            with self.subTest(formula=text):
+                parsed = parse_formula(text, row, col)
+                self.assertEqual(parsed.r1c1, r1c1)
+                self.assertEqual([r.a1(row, col) for r in parsed.references], references)
+
+    def test_external_references(self):
+        linked, named = parse_formula('[1]Stock!B2+[Reagents.xlsx]Stock!$C$4', 2, 2).references
+        self.assertEqual((linked.book, linked.sheet, linked.anchor(2, 2)), ('1', 'Stock', (2, 2, 2, 2)))
+        self.assertEqual((named.book, named.sheet, named.anchor(9, 9)), ('Reagents.xlsx', 'Stock', (4, 3, 4, 3)))
+        self.assertTrue(linked.is_cell() and named.is_cell())
+
+    def test_structured_references(self):
+        parsed = parse_formula('SUM(Table1[Col])+[@Price]*Table1[[#Totals],[Col]]')
+        self.assertEqual(parsed.tables, [TableReference('Table1', '[Col]'), TableReference(None, '[@Price]'),
+                                         TableReference('Table1', '[[#Totals],[Col]]')])
+        self.assertEqual(parsed.references, [])
+        self.assertEqual(parsed.built_ins, ['SUM'])
+
+    def test_names(self):
+        parsed = parse_formula('Rate*Sheet2!Named+Rate')
+        self.assertEqual(parsed.names, ['Rate', 'Named'])
+        self.assertEqual(parsed.references, [])
+
+    def test_arrays_and_unions(self):
+        parsed = parse_formula('{1,2;3,4}')
+        self.assertEqual(parsed.ast, Array(((Number(1.0), Number(2.0)), (Number(3.0), Number(4.0)))))
+        self.assertEqual(parsed.r1c1, '{1.0,2.0;3.0,4.0}')
+        self.assertIsInstance(parse_formula('SUM((A1,B2:C3))').ast.args[0], Union_)
+
+    def test_copies_share_r1c1(self):
+        self.assertEqual(to_r1c1('B2*$A$1', 2, 1), to_r1c1('=B3*$A$1', 3, 1))
+        self.assertIs(parse_formula('B2*2', 2, 1), parse_formula('B3*2', 3, 1))
+        self.assertNotEqual(to_r1c1('B2*$A$1', 2, 1), to_r1c1('B2*$A$1', 3, 1))
+
+    def test_errors(self):
+        for text in ('A1+', 'SUM(A1:B2', '(1+2))'):
+            with self.subTest(formula=text):
+                with self.assertRaises(FormulaError):
+                    parse_formula(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Instrumentation hooks
+- Without observers stage() hands out one shared do-nothing context manager and count() does nothing
+- A registered observer is told when every stage starts and ends, with its path, wall time and peak memory, and
+  receives the counts made in the running stage; stages of other threads have their own paths
+- The recorder aggregates the stages and gives collapsed stacks, tracemalloc is stopped with the last observer
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import instrumentation  # noqa: E402
+from instrumentation import Observer, add_observer, count, enabled, recording, remove_observer, stage  # noqa: E402
+
+
+class _Events(Observer):
+
+    def __init__(self):
+        self.events = []
+
+    def stage_started(self, path: tuple):
+        self.events.append(('started', path))
+
+    def stage_ended(self, path: tuple, seconds: float, peak_bytes):
+        self.events.append(('ended', path, seconds, peak_bytes))
+
+    def counted(self, path: tuple, name: str, n: int):
+        self.events.append(('counted', path, name, n))
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_without_observers(self):
+        self.assertFalse(enabled())
+        self.assertIs(stage('outer'), stage('inner'))
+        with stage('outer') as outer:
+            with stage('inner'):
+                self.assertEqual(instrumentation._stack(), [])
+                self.assertIsNone(count('cells', 3))
+        self.assertFalse(hasattr(outer, 'path'))
+
+    def test_observer(self):
+        observer = _Events()
+        add_observer(observer)
+        try:
+            self.assertTrue(enabled())
+            count('before')
+            with stage('outer'):
+                with stage('inner'):
+                    time.sleep(0.01)
+                    count('cells', 3)
+                with self.assertRaises(ValueError):
+                    with stage('failing'):
+                        raise ValueError()
+
+                def other_thread():
+                    with stage('thread'):
+                        count('cells')
+
+                thread = threading.Thread(target=other_thread)
+                thread.start()
+                thread.join()
+        finally:
+            remove_observer(observer)
+        count('after')
+        with stage('after'):
+            pass
+
+        events = [e[:2] if e[0] != 'counted' else e for e in observer.events]
+        self.assertEqual(events, [('counted', (), 'before', 1),
+                                  ('started', ('outer',)),
+                                  ('started', ('outer', 'inner')),
+                                  ('counted', ('outer', 'inner'), 'cells', 3),
+                                  ('ended', ('outer', 'inner')),
+                                  ('started', ('outer', 'failing')),
+                                  ('ended', ('outer', 'failing')),
+                                  ('started', ('thread',)),
+                                  ('counted', ('thread',), 'cells', 1),
+                                  ('ended', ('thread',)),
+                                  ('ended', ('outer',))])
+        ended = {e[1]: e[2:] for e in observer.events if e[0] == 'ended'}
+        self.assertGreaterEqual(ended[('outer', 'inner')][0], 0.01)
+        self.assertGreaterEqual(ended[('outer',)][0], ended[('outer', 'inner')][0])
+        self.assertEqual({peak for _, peak in ended.values()}, {None})
+
+    def test_recorder(self):
+        tracing = tracemalloc.is_tracing()
+        with recording(memory=True) as recorder:
+            for _ in range(2):
+                with stage('outer'):
+                    with stage('allocate'):
+                        data = bytearray(1 << 20)
+                        count('bytes', len(data))
+                        del data
+        self.assertEqual(tracemalloc.is_tracing(), tracing)
+        self.assertFalse(enabled())
+
+        stages = recorder.to_dict()
+        self.assertEqual(list(stages), ['outer', 'outer;allocate'])
+        allocate = stages['outer;allocate']
+        self.assertEqual((allocate['calls'], allocate['counters']), (2, {'bytes': 2 << 20}))
+        self.assertGreaterEqual(allocate['peak_bytes'], 1 << 20)
+        self.assertGreaterEqual(stages['outer']['peak_bytes'], allocate['peak_bytes'])
+        self.assertEqual([line.rsplit(' ', 1)[0] for line in recorder.collapsed().splitlines()],
+                         ['outer', 'outer;allocate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
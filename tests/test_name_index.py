@@ -0,0 +1,235 @@
+"""
+Name matching
+- The index names records, resolves formula variables and records the formulas using each name exactly as a scan
+  over every named range and record does (the matching before the index), with names that overlap each other,
+  names over the inputs and formulas and names on other sheets
+- A formula is listed once among the users of a name, whether it uses the name several times or through a range
+- The range index finds the ranges covering a cell or overlapping a range, ranges crossing bucket boundaries
+  included, in the order they were added
+- Structured references resolve to the rows and columns of their table: special items, this row, single columns,
+  column ranges, unqualified references from inside a table, unknown tables, columns and special items
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from formula_parser import TableReference  # noqa: E402
+from name_index import NameIndex, RangeIndex, TableIndex, _parse_specifier  # noqa: E402
+from template_file import _match_items, process_template_file  # noqa: E402
+from variable import ExcelTable, Formula, Name  # noqa: E402
+
+
+def _key(v) -> tuple:
+    return type(v).__name__, v.name, v.sheet, v.row, v.col
+
+
+def _scan_name(named_ranges: list, sheet: str, row: int, col: int):
+    """First named range defined over a cell, found by checking every named range"""
+    return next((n for n in named_ranges if n.contains(sheet, row, col)), None)
+
+
+def _scan_variables(formula: Formula, named_ranges: list, records: list) -> list:
+    """Variables of a formula: named ranges by name in definition order, then the referenced cells"""
+    variables = [n for n in named_ranges if n.name in formula.parsed.names]
+    for ref in formula.parsed.references:
+        if not ref.is_cell():
+            continue
+        row, col, _, _ = ref.anchor(formula.row, formula.col)
+        sheet = ref.sheet or formula.sheet
+        n = _scan_name(named_ranges, sheet, row, col)
+        if n is not None and any(n is v for v in variables):
+            continue
+        v = n.cell_at(row, col) if n is not None else next(
+            (r for r in records if (r.sheet, r.row, r.col) == (sheet, row, col)), None)
+        if v is not None and _key(v) not in map(_key, variables):
+            variables.append(v)
+    return variables
+
+
+def _scan_names_used(formula: Formula, named_ranges: list) -> set:
+    """Names a formula uses: those of its variables and those of the named ranges its ranges overlap"""
+    used = {v.name for v in formula.variables}
+    for ref in formula.parsed.references:
+        if ref.is_cell():
+            continue
+        row1, col1, row2, col2 = ref.anchor(formula.row, formula.col)
+        for n in named_ranges:
+            if (n.row is not None and n.sheet == (ref.sheet or formula.sheet)
+                    and (row1 is None or (row1 <= n.last_row and n.row <= row2))
+                    and (col1 is None or (col1 <= n.last_col and n.col <= col2))):
+                used.add(n.name)
+    return used
+
+
+class TestNameMatching(unittest.TestCase):
+
+    def test_index_equals_scan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, 'names.xlsx')
+            generate_template(template, TemplateSpec(sheets=2, formulas=24, names=4, name_size=3, fill_down=False))
+            template_data = process_template_file(template, workers=1)
+
+        # Sheet1!E1:E3 is Name1 and E4:E6 Name3, Sheet2!E1:E3 Name2
+        template_data['names'] += [
+            Name(name='Block', sheet='Sheet1', row=2, col=5, last_row=5, last_col=5, scope='Workbook'),
+            Name(name='Corner', sheet='Sheet1', row=1, col=1, last_row=2, last_col=2, scope='Workbook'),
+            Name(name='Inputs', sheet='Sheet2', row=2, col=1, last_row=5, last_col=1, scope='Workbook'),
+            Name(name='Rate', sheet='Sheet2', coordinate='B3', value='0.5', scope='Workbook'),
+        ]
+        template_data['formulas'] += [
+            Formula(sheet='Sheet2', coordinate='C1', value='=SUM(Sheet1!E2:E5)+Block+Rate+A3+Sheet1!E2'),
+            Formula(sheet='Sheet2', coordinate='C2', value='=SUM(A:A)*Name1+Sheet1!A2+B3'),
+        ]
+        _match_items(template_data)
+
+        named_ranges = template_data['names']
+        records = template_data['constants'] + template_data['formulas']
+        for r in records:
+            with self.subTest(record=f'{r.sheet}!{r.coordinate}'):
+                n = _scan_name(named_ranges, r.sheet, r.row, r.col)
+                self.assertEqual(r.name, n.name if n is not None else r.coordinate)
+
+        users = {}
+        for f in template_data['formulas']:
+            with self.subTest(formula=f'{f.sheet}!{f.coordinate}'):
+                self.assertEqual(list(map(_key, f.variables)),
+                                 list(map(_key, _scan_variables(f, named_ranges, records))))
+            for name in _scan_names_used(f, named_ranges):
+                users.setdefault(name, []).append(f)
+
+        index = NameIndex(named_ranges, records)
+        index.add_usages(template_data['formulas'])
+        self.assertEqual({name: list(map(_key, u)) for name, u in index.used_by.items()},
+                         {name: list(map(_key, u)) for name, u in users.items()})
+        for n in named_ranges:
+            self.assertEqual(n.is_used, n.name in users, n.name)
+
+        # Every kind of match is exercised
+        self.assertLessEqual({'Block', 'Corner', 'Inputs', 'Rate'}, {n.name for n in named_ranges if n.is_used})
+        self.assertIn('Corner', {r.name for r in template_data['constants']})
+        self.assertIn('Corner', {r.name for r in template_data['formulas']})
+
+    def test_users_listed_once(self):
+        rate = Name(name='Rate', sheet='S', coordinate='B3', value='0.5', scope='Workbook')
+        first = Formula(sheet='S', coordinate='C1', value='=Rate*2+Rate+SUM(B1:B5)+B3')
+        second = Formula(sheet='S', coordinate='C2', value='=SUM(A1:B4)')
+        index = NameIndex([rate])
+        for f in (first, second):
+            f.update_variables(index)
+        index.add_usages([first, second])
+
+        self.assertEqual([_key(v) for v in first.variables], [_key(rate)])
+        self.assertEqual([id(f) for f in index.used_by['Rate']], [id(first), id(second)])
+
+
+class TestRangeIndex(unittest.TestCase):
+
+    def setUp(self):
+        rows = RangeIndex.BUCKET_ROWS
+        self.index = RangeIndex()
+        self.ranges = {
+            'first bucket': ('S', 1, 1, 10, 2),
+            'last row of a bucket': ('S', rows - 1, 1, rows - 1, 1),
+            'crosses one boundary': ('S', rows - 2, 2, rows + 2, 3),
+            'spans three buckets': ('S', 5, 3, 2 * rows + 5, 3),
+            'other sheet': ('T', 1, 1, 3 * rows, 3),
+        }
+        for item, bounds in self.ranges.items():
+            self.index.add(*bounds, item)
+
+    def test_covering(self):
+        rows = RangeIndex.BUCKET_ROWS
+        for cell, expected in {
+            ('S', 1, 1): ['first bucket'],
+            ('S', 5, 3): ['spans three buckets'],
+            ('S', rows - 1, 1): ['last row of a bucket'],
+            ('S', rows - 1, 2): ['crosses one boundary'],
+            ('S', rows, 3): ['crosses one boundary', 'spans three buckets'],
+            ('S', rows + 2, 2): ['crosses one boundary'],
+            ('S', rows + 3, 2): [],
+            ('S', 2 * rows + 5, 3): ['spans three buckets'],
+            ('S', 2 * rows + 6, 3): [],
+            ('T', 2 * rows, 2): ['other sheet'],
+            ('U', 1, 1): [],
+        }.items():
+            with self.subTest(cell=cell):
+                self.assertEqual(self.index.covering(*cell), expected)
+
+    def test_overlapping(self):
+        rows = RangeIndex.BUCKET_ROWS
+        for area, expected in {
+            ('S', rows + 1, 1, rows + 1, 3): ['crosses one boundary', 'spans three buckets'],
+            ('S', 3 * rows, 1, 1, 1): ['first bucket', 'last row of a bucket'],
+            ('S', None, 2, None, 2): ['first bucket', 'crosses one boundary'],
+            ('S', 2 * rows, None, 2 * rows, None): ['spans three buckets'],
+            ('S', 11, 1, rows - 2, 1): [],
+            ('T', 1, 4, 10, 5): [],
+        }.items():
+            with self.subTest(area=area):
+                self.assertEqual(self.index.overlapping(*area), expected)
+
+    def test_len(self):
+        self.assertEqual(len(self.index), len(self.ranges))
+
+
+class TestTableIndex(unittest.TestCase):
+    # Sales: header row 2, data rows 3 to 9, totals row 10, Region/Units/Price in columns B/C/D
+    # Other: no header or totals row, data rows 2 to 5 in columns F/G
+    TABLES = [ExcelTable('Sales', 'S', 'B2:D10', totals_rows=1, columns=['Region', 'Units', 'Price']),
+              ExcelTable('Other', 'S', 'F2:G5', header_rows=0, columns=['X', 'Y'])]
+
+    def test_resolve(self):
+        index = TableIndex(self.TABLES)
+        for (table, specifier, cell), expected in {
+            ('Sales', '[#Headers]', ('S', 1, 1)): ('S', 2, 2, 2, 4),
+            ('Sales', '[#Totals]', ('S', 1, 1)): ('S', 10, 2, 10, 4),
+            ('Sales', '[#Data]', ('S', 1, 1)): ('S', 3, 2, 9, 4),
+            ('Sales', '[#All]', ('S', 1, 1)): ('S', 2, 2, 10, 4),
+            ('Sales', '[Units]', ('S', 1, 1)): ('S', 3, 3, 9, 3),
+            ('sales', '[units]', ('S', 1, 1)): ('S', 3, 3, 9, 3),
+            ('Sales', '[[#All],[Units]]', ('S', 1, 1)): ('S', 2, 3, 10, 3),
+            ('Sales', '[[#Headers],[#Data],[Price]]', ('S', 1, 1)): ('S', 2, 4, 9, 4),
+            ('Sales', '[[Region]:[Units]]', ('S', 1, 1)): ('S', 3, 2, 9, 3),
+            ('Sales', '[[Price]:[Region]]', ('S', 1, 1)): ('S', 3, 2, 9, 4),
+            ('Sales', '[@Units]', ('S', 5, 8)): ('S', 5, 3, 5, 3),
+            ('Sales', '[[#This Row],[Region]:[Price]]', ('S', 5, 8)): ('S', 5, 2, 5, 4),
+            (None, '[@Price]', ('S', 4, 4)): ('S', 4, 4, 4, 4),
+            (None, '[Y]', ('S', 3, 6)): ('S', 2, 7, 5, 7),
+            ('Other', '[#Data]', ('S', 1, 1)): ('S', 2, 6, 5, 7),
+            # Nothing to point to
+            ('Sales', '[@Units]', ('S', 10, 8)): None,
+            ('Sales', '[@Units]', ('T', 5, 8)): None,
+            ('Sales', '[Unknown]', ('S', 1, 1)): None,
+            ('Sales', '[[Region]:[Unknown]]', ('S', 1, 1)): None,
+            ('Sales', '[[#Bogus],[Units]]', ('S', 1, 1)): None,
+            ('Other', '[#Headers]', ('S', 1, 1)): None,
+            ('Other', '[#Totals]', ('S', 1, 1)): None,
+            ('Missing', '[Units]', ('S', 1, 1)): None,
+            (None, '[Units]', ('S', 1, 1)): None,
+        }.items():
+            with self.subTest(table=table, specifier=specifier, cell=cell):
+                self.assertEqual(index.resolve(TableReference(table, specifier), *cell), expected)
+
+    def test_parse_specifier(self):
+        for specifier, expected in {
+            '[Units]': ((), 'Units', 'Units'),
+            '[@Units]': (('#THIS ROW',), 'Units', 'Units'),
+            '[@[Unit Price]]': (('#THIS ROW',), 'Unit Price', 'Unit Price'),
+            '[[#This  Row],[Units]]': (('#THIS ROW',), 'Units', 'Units'),
+            '[#all]': (('#ALL',), None, None),
+            '[[#Headers],[Region]:[Price]]': (('#HEADERS',), 'Region', 'Price'),
+            "[Total '# Sold]": ((), 'Total # Sold', 'Total # Sold'),
+            "[['[Note']]]": ((), '[Note]', '[Note]'),
+            '[]': ((), None, None),
+        }.items():
+            with self.subTest(specifier=specifier):
+                self.assertEqual(_parse_specifier(specifier), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
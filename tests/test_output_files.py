@@ -0,0 +1,55 @@
+"""
+Formulas workbook
+- One sheet each for the formulas, names and constants, nothing else of the template data
+- An index column and one column per record field, variables written by name
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import openpyxl  # noqa: E402
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from output_files import output_formulas_to_excel  # noqa: E402
+from template_file import process_template_file  # noqa: E402
+
+
+class TestFormulasWorkbook(unittest.TestCase):
+
+    def test_sheets_and_rows(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, 'template.xlsx')
+            generate_template(template, TemplateSpec(sheets=2, formulas=12, names=3))
+            template_data = process_template_file(template, workers=1)
+            filename = os.path.join(tmp, 'formulas and names.xlsx')
+            with open(filename, 'w') as f:
+                f.write('replaced')
+
+            output_formulas_to_excel(filename, template_data)
+            book = openpyxl.load_workbook(filename, read_only=True)
+            rows = {sheet: [list(r) for r in book[sheet].iter_rows(values_only=True)] for sheet in book.sheetnames}
+            book.close()
+
+        self.assertEqual(list(rows), ['formulas', 'names', 'constants'])
+        for key, sheet_rows in rows.items():
+            with self.subTest(sheet=key):
+                records = template_data[key]
+                self.assertEqual(sheet_rows[0], [None] + list(records[0].fields))
+                self.assertEqual([r[0] for r in sheet_rows[1:]], list(range(len(records))))
+
+        header = rows['formulas'][0]
+        first = dict(zip(header, rows['formulas'][1]))
+        formula = template_data['formulas'][0]
+        self.assertEqual((first['sheet'], first['coordinate'], first['value']),
+                         (formula.sheet, formula.coordinate, formula.value))
+        self.assertEqual(first['variables'], ', '.join(v.name for v in formula.variables))
+        column = rows['constants'][0].index('coordinate')
+        self.assertEqual([r[column] for r in rows['constants'][1:]],
+                         [c.coordinate for c in template_data['constants']])
+
+
+if __name__ == '__main__':
+    unittest.main()
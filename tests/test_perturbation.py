@@ -0,0 +1,79 @@
+"""
+What-if testing
+- A formula turning into an Excel error in some scenarios is reported with those scenarios
+- A formula differing from its declared expectation is reported with its results and the expected ones
+- The given mode of the command line runs one scenario per given value
+"""
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+import cli  # noqa: E402
+from perturbation import perturb_formulas  # noqa: E402
+from variable import Formula, Variable  # noqa: E402
+
+
+def _template() -> tuple:
+    """Template data and cached values: A1 and A2 are inputs, B1:B3 formulas using them"""
+    constants = [Variable(sheet='S', coordinate='A1', value=4, output='4'),
+                 Variable(sheet='S', coordinate='A2', value=3, output='3')]
+    formulas = [Formula(sheet='S', coordinate='B1', value='=10/A1', output='2.5'),
+                Formula(sheet='S', coordinate='B2', value='=A1*A2', output='12'),
+                Formula(sheet='S', coordinate='B3', value='=A1+A2', output='7')]
+    values = {('S', 1, 1): 4, ('S', 2, 1): 3, ('S', 1, 2): 2.5, ('S', 2, 2): 12, ('S', 3, 2): 7}
+    return {'formulas': formulas, 'constants': constants, 'names': []}, values
+
+
+class TestPerturbation(unittest.TestCase):
+
+    def test_findings(self):
+        template_data, values = _template()
+        report = perturb_formulas(template_data, values, mode='given', given={'S!A1': [0, 1.5, 2, 4]},
+                                  expectations={'S!B2': 'A2*A1', 'S!B3': 'A1*A2'})
+
+        self.assertEqual((report.scenarios, list(report.inputs), report.evaluated), (4, ['S!A1'], 3))
+        findings = {f.label: f for f in report.findings}
+        self.assertEqual(sorted(findings), ['S!B1', 'S!B3'])
+
+        error = findings['S!B1']
+        self.assertEqual((error.kind, error.scenarios, error.results), ('error', [0], ['#DIV/0!']))
+
+        mismatch = findings['S!B3']
+        self.assertEqual((mismatch.kind, mismatch.scenarios), ('mismatch', [0, 2, 3]))
+        self.assertEqual((mismatch.results, mismatch.expected), ([3.0, 5.0, 7.0], [0.0, 6.0, 12.0]))
+
+    def test_errors_excel_gave_are_not_reported(self):
+        template_data, values = _template()
+        values[('S', 1, 1)], values[('S', 1, 2)] = 0, '#DIV/0!'
+        report = perturb_formulas(template_data, values, mode='given', given={'S!A1': [0, 1]})
+        self.assertEqual(report.findings, [])
+
+    def test_given_mode_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            template = os.path.join(tmp, 'perturb.xlsx')
+            generate_template(template, TemplateSpec(sheets=1, formulas=5, names=1, fill_down=False))
+            report_file = os.path.join(tmp, 'report.json')
+            arguments = ['perturb', template, '--mode', 'given', '--given', 'Sheet1!A1=0,1,2',
+                         '--expect', 'Sheet1!B1=A1*3', '--report', report_file]
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(cli.main(arguments), 0)
+                # The given mode without values is refused
+                self.assertEqual(cli.main(arguments[:4]), 1)
+            with open(report_file) as f:
+                report = json.load(f)
+
+        self.assertEqual((report['scenarios'], report['inputs']), (3, ['Sheet1!A1']))
+        finding, = report['findings']
+        self.assertEqual((finding['label'], finding['kind']), ('Sheet1!B1', 'mismatch'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Pipelined document
+- The document written while the template is read is the one stream_document writes after process_template_file,
+  with sheets read in this process or by worker processes, one test per formula or per group
+- An error reading a sheet in the producer thread reaches the caller, an error writing the tests stops the producer,
+  neither leaves the pipeline waiting on its queue
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from template_file import process_template_file  # noqa: E402
+from verification_document import stream_document  # noqa: E402
+import pipeline  # noqa: E402
+
+
+def _parts(filename: str) -> dict:
+    with zipfile.ZipFile(filename) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+class TestPipeline(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.template = os.path.join(cls.tmp.name, 'pipeline.xlsx')
+        # Mixed formulas, the later sheets refer to the earlier ones
+        generate_template(cls.template, TemplateSpec(sheets=4, formulas=60, names=6, fill_down=False))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def __run(self, function, *args, **kwargs):
+        """Runs function in a thread, fails if it has not returned after a minute"""
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = function(*args, **kwargs)
+            except BaseException as e:
+                outcome['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'the pipeline hangs')
+        return outcome
+
+    def test_pipeline_equals_serial(self):
+        for case, (workers, options) in {
+            'one test per formula': (1, {}),
+            'groups': (1, {'group': True, 'samples': 1}),
+            'worker processes': (2, {}),
+        }.items():
+            with self.subTest(case=case):
+                serial = os.path.join(self.tmp.name, 'serial.docx')
+                piped = os.path.join(self.tmp.name, 'piped.docx')
+                stream_document(process_template_file(self.template, workers=1), serial, 'Name', 'Description',
+                                **options)
+                with mock.patch.object(pipeline, 'PARALLEL_MIN_BYTES', 0):
+                    template_data = pipeline.pipeline_document(self.template, piped, 'Name', 'Description',
+                                                               workers=workers, queue_size=1, **options)
+                self.assertEqual(len(template_data['formulas']), 60)
+                self.assertEqual(_parts(piped), _parts(serial))
+
+    def test_read_error_reaches_caller(self):
+        read = pipeline._read_sheet_records
+
+        def fail_on_third_sheet(reader, sheet_name, targets):
+            if sheet_name == 'Sheet3':
+                raise ValueError(f'cannot read {sheet_name}')
+            return read(reader, sheet_name, targets)
+
+        filename = os.path.join(self.tmp.name, 'failed.docx')
+        with mock.patch.object(pipeline, '_read_sheet_records', fail_on_third_sheet):
+            outcome = self.__run(pipeline.pipeline_document, self.template, filename, 'Name', 'Description',
+                                 workers=1, queue_size=1)
+        self.assertIsInstance(outcome.get('error'), ValueError)
+        self.assertEqual(str(outcome['error']), 'cannot read Sheet3')
+        self.assertFalse(os.path.exists(filename))
+
+    def test_write_error_stops_producer(self):
+        def write(tests):
+            next(tests)
+            raise RuntimeError('cannot write')
+
+        outcome = self.__run(pipeline.run_pipeline, self.template, write, workers=1, queue_size=1)
+        self.assertIsInstance(outcome.get('error'), RuntimeError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Verification service
+- Requests with a Host or Origin that is not this machine, a body that is not JSON, unknown options, or outputs
+  outside the output root are rejected
+- A request within the rules writes its outputs under the output root, the counts of the status add up
+"""
+import http.client
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+import service  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind((service.HOST, 0))
+        return s.getsockname()[1]
+
+
+class TestService(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.root = os.path.join(cls.tmp.name, 'root')
+        cls.template = os.path.join(cls.root, 'Service.xlsx')
+        os.makedirs(cls.root)
+        generate_template(cls.template, TemplateSpec(sheets=1, formulas=10, names=2))
+
+        cls.port = _free_port()
+        cls.server = threading.Thread(target=service.serve, daemon=True,
+                                      args=(os.path.join(cls.tmp.name, 'cache'), service.HOST, cls.port),
+                                      kwargs={'quiet': True, 'output_root': cls.root})
+        cls.server.start()
+        # Waits for the service to listen, it imports the pipeline first
+        for _ in range(600):
+            try:
+                cls.request('GET', '/status')
+                break
+            except ConnectionError:
+                threading.Event().wait(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.request('POST', '/shutdown', {})
+        cls.server.join(10)
+        cls.tmp.cleanup()
+
+    @classmethod
+    def request(cls, method: str, path: str, body=None, **headers) -> tuple:
+        """:return: tuple of the status and the answer"""
+        headers.setdefault('Content-Type', 'application/json')
+        connection = http.client.HTTPConnection(service.HOST, cls.port, timeout=60)
+        try:
+            connection.request(method, path, body=None if body is None else json.dumps(body).encode(),
+                               headers=headers)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read() or b'{}')
+        finally:
+            connection.close()
+
+    def test_rejected_requests(self):
+        body = {'template': self.template, 'outputs': ['xlsx']}
+        outside = os.path.join(self.tmp.name, 'outside')
+        for case, (status, request) in {
+            'other host': (403, dict(body=body, Host='example.com')),
+            'cross origin': (403, dict(body=body, Origin='https://example.com')),
+            'not json': (415, dict(body=body, **{'Content-Type': 'text/plain'})),
+            'unknown option': (400, dict(body=dict(body, debug=True))),
+            'outside the root': (403, dict(body=dict(body, out_dir=outside))),
+            'name with a directory': (403, dict(body=dict(body, name='../../escaped'))),
+            'absolute name': (403, dict(body=dict(body, name=os.path.join(outside, 'escaped')))),
+        }.items():
+            with self.subTest(case=case):
+                answer_status, answer = self.request('POST', '/verify', **request)
+                self.assertEqual(answer_status, status)
+                self.assertIn('error', answer)
+        self.assertFalse(os.path.exists(outside))
+        written = [f for _, _, files in os.walk(self.tmp.name) for f in files if 'escaped' in f]
+        self.assertEqual(written, [])
+
+    def test_verify(self):
+        before = self.request('GET', '/status')[1]
+        out_dir = os.path.join(self.root, 'out')
+        status, answer = self.request('POST', '/verify', {'template': self.template, 'out_dir': out_dir,
+                                                          'outputs': ['docx', 'xlsx'], 'name': 'Checked'})
+        self.assertEqual(status, 200, answer)
+        self.assertEqual(answer['formulas'], 10)
+        for filename in answer['files'].values():
+            self.assertTrue(os.path.isfile(filename))
+            self.assertEqual(os.path.dirname(filename), out_dir)
+            self.assertIn('Checked', os.path.basename(filename))
+
+        after = self.request('GET', '/status')[1]
+        self.assertEqual((after['requests'], after['failures']), (before['requests'] + 1, before['failures']))
+
+
+if __name__ == '__main__':
+    unittest.main()
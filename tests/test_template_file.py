@@ -0,0 +1,67 @@
+"""
+Template extraction equivalence
+- The streaming reader finds the records openpyxl finds, for dense, copied-down templates and for sparse ones
+  whose sheet dimensions claim the whole sheet
+- Sheets read by a pool of worker processes give the records and cached values of sheets read one by one
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import TemplateSpec, generate_template  # noqa: E402
+from template_file import process_template_file  # noqa: E402
+import template_file  # noqa: E402
+
+SPECS = {
+    'dense': TemplateSpec(sheets=3, formulas=60, names=4),
+    'sparse': TemplateSpec(sheets=2, formulas=40, names=3, name_size=3, fill_down=False, sparse=7, inflated=True),
+}
+
+
+def _records(template_data: dict) -> dict:
+    """The fields of every record, variables by their text"""
+    return {key: [{f: str(getattr(r, f)) if f == 'variables' else getattr(r, f) for f in r.fields}
+                  for r in template_data[key]]
+            for key in ('formulas', 'names', 'constants')}
+
+
+class TestTemplateExtraction(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.templates = {}
+        for name, spec in SPECS.items():
+            cls.templates[name] = os.path.join(cls.tmp.name, f'{name}.xlsx')
+            generate_template(cls.templates[name], spec)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_streaming_equals_openpyxl(self):
+        for name, filename in self.templates.items():
+            with self.subTest(template=name):
+                streamed = _records(process_template_file(filename, workers=1))
+                loaded = _records(process_template_file(filename, single_pass=False))
+                self.assertTrue(streamed['formulas'])
+                self.assertEqual(streamed, loaded)
+
+    def test_parallel_equals_serial(self):
+        for name, filename in self.templates.items():
+            with self.subTest(template=name):
+                serial = process_template_file(filename, workers=1)
+                # Every template is large enough for the worker pool
+                with mock.patch.object(template_file, 'PARALLEL_MIN_BYTES', 0):
+                    parallel = process_template_file(filename, workers=2)
+                self.assertEqual(_records(parallel), _records(serial))
+                self.assertEqual(parallel['values'], serial['values'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Records
+- A named range over several cells expands to one record per cell, row by row, with the contents of its cells;
+  the record of a cell is created once, on first use, and shares the range's use flag
+- Records are equal and hash alike when they sit in the same cell, global names when they have the same name
+- Records survive a pickle round trip with every field, a formula with its parsed formula and resolved variables
+"""
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from name_index import NameIndex  # noqa: E402
+from variable import Formula, Name, Variable  # noqa: E402
+from workbook_reader import CellData  # noqa: E402
+
+
+class TestNamedRange(unittest.TestCase):
+
+    def setUp(self):
+        cells = {(2, 2): CellData(2, 2, 5, 5), (3, 3): CellData(3, 3, '=B2*2', 10), (9, 9): CellData(9, 9, 1, 1)}
+        self.name = Name(name='Block', sheet='S', row=2, col=2, last_row=3, last_col=3, value='B2:C3',
+                         scope='Workbook', cells=cells)
+
+    def test_expand(self):
+        cells = self.name.expand()
+        self.assertEqual([c.coordinate for c in cells], ['B2', 'C2', 'B3', 'C3'])
+        self.assertEqual({(c.name, c.sheet, c.scope) for c in cells}, {('Block', 'S', 'Workbook')})
+        self.assertEqual([(c.value, c.output) for c in cells],
+                         [('5', '5'), ('None', 'None'), ('None', 'None'), ('B2*2', '10')])
+        self.assertFalse(any(c.is_range for c in cells))
+
+    def test_cell_at(self):
+        cell = self.name.cell_at(3, 3)
+        self.assertIs(self.name.cell_at(3, 3), cell)
+        self.assertIs(self.name.expand()[3], cell)
+        self.assertEqual((cell.coordinate, cell.value, cell.output), ('C3', 'B2*2', '10'))
+
+        index = NameIndex([self.name])
+        formula = Formula(sheet='S', coordinate='A1', value='=SUM(Block)')
+        formula.update_variables(index)
+        index.add_usages([formula])
+        self.name.set_is_used(index)
+        self.assertTrue(cell.is_used)
+
+    def test_single_cell(self):
+        single = Name(name='Rate', sheet='S', coordinate='A1', value='0.5')
+        self.assertFalse(single.is_range)
+        self.assertEqual(single.expand(), [single])
+        self.assertIs(single.cell_at(1, 1), single)
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_equality(self):
+        constant = Variable(name='Rate', sheet='S', coordinate='B3', value=0.5, output='0.5')
+        formula = Formula(sheet='S', row=3, col=2, value='=A1*2')
+        name = Name(name='Rate', sheet='S', coordinate='B3', value='0.5')
+        other_sheet = Variable(sheet='T', coordinate='B3', value=0.5)
+        other_cell = Variable(sheet='S', coordinate='B4', value=0.5)
+        global_name = Name(name='Rate', value='0.5', is_global=True)
+
+        self.assertTrue(constant == formula == name)
+        self.assertEqual(len({constant, formula, name}), 1)
+        self.assertNotEqual(constant, other_sheet)
+        self.assertNotEqual(constant, other_cell)
+        self.assertNotEqual(name, global_name)
+        self.assertEqual(global_name, Name(name='Rate', value='1', is_global=True))
+        self.assertNotEqual(global_name, Name(name='Other', value='0.5', is_global=True))
+        self.assertEqual(len({constant, other_sheet, other_cell, global_name}), 4)
+        self.assertNotEqual(constant, ('S', 3, 2))
+
+    def test_pickle(self):
+        index = NameIndex([self.__name()], [Variable(sheet='S', coordinate='A1', value=4, output='4')])
+        formula = Formula(sheet='S', coordinate='C1', value='=A1*SUM(Block)', output='40')
+        formula.update_variables(index)
+        formula.expected, formula.passed = 40.0, True
+
+        for record in [formula, *formula.variables]:
+            with self.subTest(record=repr(record)):
+                copy = pickle.loads(pickle.dumps(record))
+                self.assertIsNot(copy, record)
+                self.assertIs(type(copy), type(record))
+                self.assertEqual(copy, record)
+                self.assertEqual(hash(copy), hash(record))
+                self.assertEqual(repr(copy), repr(record))
+        copy = pickle.loads(pickle.dumps(formula))
+        self.assertEqual(vars(copy.parsed), vars(formula.parsed))
+        self.assertEqual(copy.variables[0].cell_at(3, 3).output, '10')
+
+    @staticmethod
+    def __name() -> Name:
+        return Name(name='Block', sheet='S', row=2, col=2, last_row=3, last_col=3, value='B2:C3',
+                    cells={(3, 3): CellData(3, 3, '=B2*2', 10)})
+
+
+if __name__ == '__main__':
+    unittest.main()